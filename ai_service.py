@@ -8,9 +8,15 @@ import requests
 import uuid
 import hmac
 import hashlib
+import threading
+import importlib
 from http import HTTPStatus
-from typing import Dict, Any, Optional, List
-from zai import ZhipuAiClient
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Dict, Any, Optional, List, Callable
+
+from llm_cache import prompt_cache, text_cache, make_key, TEXT_CACHE_ENDPOINTS
+import metrics
+import tracing
 
 # 配置日志
 # logging.basicConfig(
@@ -19,15 +25,54 @@ from zai import ZhipuAiClient
 # )
 logger = logging.getLogger("AIService")
 
-# 尝试导入 dashscope (仅用于阿里云)
-try:
+# ============================================================
+#  Provider SDK 延迟加载
+# ============================================================
+# dashscope / zai 体积较大，启动时不导入，只在对应 provider 第一次被调用时加载
+# (未配置阿里云/智谱的部署完全不加载)。打包时 PyInstaller 仍能从函数内的 import 语句分析到依赖
+
+class LazySDK:
+    """首次 get() 时调用 loader 导入 SDK 并缓存；未安装时返回 None (只告警一次)"""
+    def __init__(self, name, loader):
+        self.name = name
+        self._loader = loader
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._sdk = None
+
+    def get(self):
+        if self._loaded: return self._sdk
+        with self._lock:
+            if not self._loaded:
+                started = time.time()
+                try:
+                    self._sdk = self._loader()
+                    logger.info(f"{self.name} SDK loaded in {(time.time() - started) * 1000:.0f}ms")
+                except ImportError:
+                    logger.warning(f"{self.name} SDK not found. Related features will be disabled.")
+                self._loaded = True
+        return self._sdk
+
+def _load_dashscope():
     import dashscope
     from dashscope import ImageSynthesis, VideoSynthesis, MultiModalConversation, Generation
-    from dashscope.audio.tts import SpeechSynthesizer 
-    DASHSCOPE_AVAILABLE = True
-except ImportError:
-    DASHSCOPE_AVAILABLE = False
-    logger.warning("DashScope SDK not found. Aliyun features will be disabled.")
+    from dashscope.audio.tts import SpeechSynthesizer
+    return type('DashScopeSDK', (), {
+        'dashscope': dashscope, 'ImageSynthesis': ImageSynthesis, 'VideoSynthesis': VideoSynthesis,
+        'MultiModalConversation': MultiModalConversation, 'Generation': Generation, 'SpeechSynthesizer': SpeechSynthesizer,
+    })
+
+def _load_zai():
+    from zai import ZhipuAiClient
+    return ZhipuAiClient
+
+DASHSCOPE = LazySDK('DashScope', _load_dashscope)
+ZAI = LazySDK('Zhipu (zai)', _load_zai)
+
+def _zhipu_client(api_key):
+    client_cls = ZAI.get()
+    if client_cls is None: raise RuntimeError("zai SDK not installed")
+    return client_cls(api_key=api_key)
 
 # --- 通用工具 ---
 
@@ -74,20 +119,88 @@ def _safe_log_payload(payload: Dict) -> str:
 #  Provider Handlers (不同提供商的实现)
 # ============================================================
 
+def instrumented(provider):
+    """
+    handler 类装饰器：公开方法与轮询方法 (_wait_*) 计时，并按返回结果统计成功/失败；
+    在任务 trace 中记录为 "{provider}.{方法名}" span，轮询方法记为 "{provider}.poll"
+    """
+    def decorator(cls):
+        include = [n for n in vars(cls) if n.startswith('_wait_') or n == '_retrieve_file']
+        names = {n: f"{provider}.poll" for n in include if n.startswith('_wait_')}
+        cls = metrics.instrument(metrics.PROVIDER_CALL_SECONDS, include=include, outcomes=metrics.PROVIDER_CALLS, provider=provider)(cls)
+        return tracing.instrument(provider, include=include, names=names)(cls)
+    return decorator
+
+
+class _TracedHTTP:
+    """
+    requests.get / post 的薄包装：在任务 trace 中为每次 provider HTTP 调用记录一个 span
+    轮询方法 ("*.poll" span) 内的请求记为 provider.poll，其余记为 provider.submit；URL 不含 query
+    """
+    @staticmethod
+    def _call(method, func, url, **kwargs):
+        parent = tracing.current_span()
+        if parent is None:
+            return func(url, **kwargs)
+        name = 'provider.poll' if parent.name.endswith('.poll') else 'provider.submit'
+        with tracing.span(name, **{'http.method': method, 'http.url': url.split('?')[0]}) as s:
+            resp = func(url, **kwargs)
+            s.set(**{'http.status_code': resp.status_code})
+            return resp
+
+    def get(self, url, **kwargs): return self._call('GET', requests.get, url, **kwargs)
+    def post(self, url, **kwargs): return self._call('POST', requests.post, url, **kwargs)
+
+http = _TracedHTTP()
+
+# ============================================================
+#  Provider 注册表
+# ============================================================
+# provider type → handler 类，内置 handler 用 @register_provider 登记。
+# 第三方 provider 写在独立模块中，同样用 @ai_service.register_provider('xxx') 登记，
+# 并通过环境变量 PROVIDER_PLUGINS=模块1,模块2 声明，首次遇到未登记的 type 时才导入
+PROVIDERS = {}
+PROVIDER_PLUGINS = [m.strip() for m in os.getenv('PROVIDER_PLUGINS', '').split(',') if m.strip()]
+_plugins_lock = threading.Lock()
+_plugins_loaded = False
+
+def register_provider(*provider_types):
+    def decorator(cls):
+        for provider_type in provider_types:
+            PROVIDERS[provider_type] = cls
+        return cls
+    return decorator
+
+def _load_plugins():
+    global _plugins_loaded
+    with _plugins_lock:
+        if _plugins_loaded: return
+        for module in PROVIDER_PLUGINS:
+            try:
+                importlib.import_module(module)
+                logger.info(f"Provider plugin loaded: {module}")
+            except Exception as e:
+                logger.error(f"Provider plugin {module} failed to load: {e}")
+        _plugins_loaded = True
+
+@register_provider('aliyun')
+@instrumented('aliyun')
 class AliyunHandler:
     @staticmethod
     def generate_text(messages, config):
-        if not DASHSCOPE_AVAILABLE: return {'success': False, 'error_msg': "DashScope SDK not installed"}
+        ds = DASHSCOPE.get()
+        if ds is None: return {'success': False, 'error_msg': "DashScope SDK not installed"}
         api_key = config.get('api_key') or os.getenv("DASHSCOPE_API_KEY")
         model = config.get('model_name') or 'qwen-plus'
         
         logger.info(f"[Aliyun] Text Gen Request. Model: {model}, Msg Count: {len(messages)}")
         try:
-            rsp = Generation.call(api_key=api_key, model=model, messages=messages, result_format='message')
+            rsp = ds.Generation.call(api_key=api_key, model=model, messages=messages, result_format='message')
             if rsp.status_code == HTTPStatus.OK:
                 content = rsp.output.choices[0].message.content
                 logger.info(f"[Aliyun] Text Gen Success. Length: {len(content)}")
-                return {'success': True, 'content': content}
+                usage = getattr(rsp, 'usage', None) or {}
+                return {'success': True, 'content': content, 'tokens': (usage.get('input_tokens') or 0) + (usage.get('output_tokens') or 0)}
             
             logger.error(f"[Aliyun] Text Gen Failed. Code: {rsp.code}, Msg: {rsp.message}")
             return {'success': False, 'error_msg': rsp.message}
@@ -95,15 +208,34 @@ class AliyunHandler:
             logger.exception(f"[Aliyun] Text Gen Exception")
             return {'success': False, 'error_msg': str(e)}
 
+    @staticmethod
+    def generate_text_stream(messages, config):
+        """流式文本生成，逐段 yield 增量文本，出错时抛异常"""
+        ds = DASHSCOPE.get()
+        if ds is None: raise RuntimeError("DashScope SDK not installed")
+        api_key = config.get('api_key') or os.getenv("DASHSCOPE_API_KEY")
+        model = config.get('model_name') or 'qwen-plus'
+
+        logger.info(f"[Aliyun] Text Stream Request. Model: {model}, Msg Count: {len(messages)}")
+        responses = ds.Generation.call(api_key=api_key, model=model, messages=messages, result_format='message',
+                                    stream=True, incremental_output=True)
+        for rsp in responses:
+            if rsp.status_code != HTTPStatus.OK:
+                logger.error(f"[Aliyun] Text Stream Failed. Code: {rsp.code}, Msg: {rsp.message}")
+                raise RuntimeError(rsp.message)
+            delta = rsp.output.choices[0].message.content
+            if delta: yield delta
+
     @staticmethod
     def generate_image(prompt, media_manager, config, entity_id=None):
-        if not DASHSCOPE_AVAILABLE: return {'success': False, 'error_msg': "DashScope SDK not installed"}
+        ds = DASHSCOPE.get()
+        if ds is None: return {'success': False, 'error_msg': "DashScope SDK not installed"}
         api_key = config.get('api_key')
         model = config.get('model_name') or 'qwen-image-plus'
         
         logger.info(f"[Aliyun] Image Gen Request. Model: {model}, Prompt: {prompt[:50]}...")
         try:
-            rsp = MultiModalConversation.call(
+            rsp = ds.MultiModalConversation.call(
                 api_key=api_key, model=model, messages=[{"role": "user", "content": [{"text": prompt}]}],
                 result_format='message'
             )
@@ -129,7 +261,8 @@ class AliyunHandler:
 
     @staticmethod
     def generate_video(prompt, media_manager, config, start_img=None, end_img=None, entity_id=None):
-        if not DASHSCOPE_AVAILABLE: return {'success': False, 'error_msg': "DashScope SDK not installed"}
+        ds = DASHSCOPE.get()
+        if ds is None: return {'success': False, 'error_msg': "DashScope SDK not installed"}
         api_key = config.get('api_key')
         model = config.get('model_name') or 'wanx2.1-kf2v-plus'
         
@@ -147,7 +280,7 @@ class AliyunHandler:
         
         try:
             logger.info(f"[Aliyun] Video Params: {_safe_log_payload(params)}")
-            rsp = VideoSynthesis.call(api_key=api_key, **params)
+            rsp = ds.VideoSynthesis.call(api_key=api_key, **params)
             if rsp.status_code == HTTPStatus.OK:
                 video_url = rsp.output.video_url
                 logger.info(f"[Aliyun] Video Gen Success. TaskID: {rsp.output.task_id}, URL: {video_url}")
@@ -164,17 +297,18 @@ class AliyunHandler:
 
     @staticmethod
     def generate_voice(text, media_manager, config, entity_id=None):
-        if not DASHSCOPE_AVAILABLE: return {'success': False, 'error_msg': "DashScope SDK not installed"}
+        ds = DASHSCOPE.get()
+        if ds is None: return {'success': False, 'error_msg': "DashScope SDK not installed"}
         api_key = config.get('api_key')
         model = config.get('model_name') or 'qwen3-tts-flash'
         
         logger.info(f"[Aliyun] Voice Gen Request. Model: {model}, Text Len: {len(text)}")
         base_url = config.get('base_url', '')
         if base_url:
-            dashscope.base_http_api_url = base_url
+            ds.dashscope.base_http_api_url = base_url
 
         try:
-            rsp = SpeechSynthesizer.call(model=model, api_key=api_key, text=text, format='mp3')
+            rsp = ds.SpeechSynthesizer.call(model=model, api_key=api_key, text=text, format='mp3')
             if rsp.status_code == HTTPStatus.OK:
                 if hasattr(rsp, 'get_audio_data'):
                     audio_data = rsp.get_audio_data()
@@ -198,7 +332,8 @@ class AliyunHandler:
         使用 ImageSynthesis.call 和 wan2.5-i2i-preview 模型
         支持 Base64 编码的图片输入
         """
-        if not DASHSCOPE_AVAILABLE: 
+        ds = DASHSCOPE.get()
+        if ds is None:
             return {'success': False, 'error_msg': "DashScope SDK not installed"}
         
         api_key = config.get('api_key')
@@ -231,13 +366,13 @@ class AliyunHandler:
         # 如果有自定义 Base URL (例如新加坡节点)
         base_url = config.get('base_url')
         if base_url:
-            dashscope.base_http_api_url = base_url
+            ds.dashscope.base_http_api_url = base_url
 
         try:
             logger.info(f"[Aliyun] Calling ImageSynthesis.call with model={model}, images_count={len(images_input)}")
             
             # 调用 DashScope 图像合成接口
-            rsp = ImageSynthesis.call(
+            rsp = ds.ImageSynthesis.call(
                 api_key=api_key,
                 model=model,
                 prompt=prompt,
@@ -275,7 +410,8 @@ class AliyunHandler:
         Returns:
             dict: API 响应结果
         """
-        if not DASHSCOPE_AVAILABLE:
+        ds = DASHSCOPE.get()
+        if ds is None:
             return {'success': False, 'error_msg': "DashScope SDK not installed"}
 
         api_key = config.get('api_key') or os.getenv("DASHSCOPE_API_KEY")
@@ -299,7 +435,7 @@ class AliyunHandler:
 
         try:
             # 调用 DashScope
-            rsp = MultiModalConversation.call(
+            rsp = ds.MultiModalConversation.call(
                 api_key=api_key,
                 model=model,
                 messages=messages,
@@ -325,6 +461,8 @@ class AliyunHandler:
             logger.exception("[Visual Analysis] Exception")
             return {'success': False, 'error_msg': str(e)}
     
+@register_provider('siliconflow', 'runninghub')
+@instrumented('openai_compatible')
 class OpenAICompatibleHandler:
     @staticmethod
     def _get_headers(config):
@@ -345,12 +483,12 @@ class OpenAICompatibleHandler:
         
         logger.info(f"[OpenAI-Compat] Text Req: URL={url}, Model={payload['model']}")
         try:
-            resp = requests.post(url, json=payload, headers=OpenAICompatibleHandler._get_headers(config), timeout=60)
+            resp = http.post(url, json=payload, headers=OpenAICompatibleHandler._get_headers(config), timeout=60)
             if resp.status_code == 200:
                 data = resp.json()
                 content = data['choices'][0]['message']['content']
                 logger.info(f"[OpenAI-Compat] Text Success. Length: {len(content)}")
-                return {'success': True, 'content': content}
+                return {'success': True, 'content': content, 'tokens': (data.get('usage') or {}).get('total_tokens', 0)}
             
             logger.error(f"[OpenAI-Compat] Text Fail: {resp.status_code} - {resp.text[:200]}")
             return {'success': False, 'error_msg': resp.text}
@@ -358,6 +496,31 @@ class OpenAICompatibleHandler:
             logger.exception("[OpenAI-Compat] Text Exception")
             return {'success': False, 'error_msg': str(e)}
 
+    @staticmethod
+    def generate_text_stream(messages, config):
+        """SSE 流式文本生成，逐段 yield 增量文本，出错时抛异常"""
+        base_url = config.get('base_url', 'https://api.siliconflow.cn/v1')
+        url = f"{base_url.rstrip('/')}/chat/completions"
+        payload = {
+            "model": config.get('model_name', 'Qwen/Qwen2.5-7B-Instruct'),
+            "messages": messages,
+            "stream": True
+        }
+
+        logger.info(f"[OpenAI-Compat] Text Stream Req: URL={url}, Model={payload['model']}")
+        with http.post(url, json=payload, headers=OpenAICompatibleHandler._get_headers(config), timeout=60, stream=True) as resp:
+            if resp.status_code != 200:
+                logger.error(f"[OpenAI-Compat] Text Stream Fail: {resp.status_code} - {resp.text[:200]}")
+                raise RuntimeError(resp.text)
+            resp.encoding = 'utf-8'
+            for line in resp.iter_lines(decode_unicode=True):
+                if not line or not line.startswith('data:'): continue
+                data = line[5:].strip()
+                if data == '[DONE]': break
+                choices = json.loads(data).get('choices') or []
+                delta = (choices[0].get('delta') or {}).get('content') if choices else None
+                if delta: yield delta
+
     @staticmethod
     def generate_image(prompt, media_manager, config, entity_id=None):
         base_url = config.get('base_url', 'https://api.siliconflow.cn/v1')
@@ -371,7 +534,7 @@ class OpenAICompatibleHandler:
         logger.info(f"[OpenAI-Compat] Image Req: URL={url}, Model={payload['model']}")
         
         try:
-            resp = requests.post(url, json=payload, headers=OpenAICompatibleHandler._get_headers(config), timeout=120)
+            resp = http.post(url, json=payload, headers=OpenAICompatibleHandler._get_headers(config), timeout=120)
             if resp.status_code == 200:
                 data = resp.json()
                 if data.get('data'):
@@ -393,6 +556,8 @@ class OpenAICompatibleHandler:
         """
         return {'success': False, 'error_msg': "OpenAI Compatible API (SiliconFlow/RunningHub) fusion/i2i generation not implemented or supported via generic endpoints."}
     
+@register_provider('comfyui')
+@instrumented('comfyui')
 class ComfyUIHandler:
     @staticmethod
     def generate_image(prompt, media_manager, config, entity_id=None):
@@ -407,10 +572,17 @@ class ComfyUIHandler:
         """
         return {'success': False, 'error_msg': "ComfyUI i2i/fusion generation requires complex workflow logic and is not implemented yet."}
     
+@register_provider('mock')
+@instrumented('mock')
 class MockHandler:
     @staticmethod
     def generate_text(messages, config): return {'success': True, 'content': "Mock Text Response"}
     @staticmethod
+    def generate_text_stream(messages, config):
+        content = MockHandler.generate_text(messages, config)['content']
+        for i in range(0, len(content), 16):
+            yield content[i:i + 16]
+    @staticmethod
     def generate_image(prompt, media_manager, config, entity_id=None):
         time.sleep(1)
         mock_url = "https://placehold.co/600x400/2c3e50/ffffff?text=Mock+Image"
@@ -431,6 +603,8 @@ class MockHandler:
         saved_url = media_manager.download_from_url(mock_url, 'image', entity_id)
         return {'success': True, 'url': saved_url or mock_url}
 
+@register_provider('vidu')
+@instrumented('vidu')
 class ViduHandler:
     """
     VIDU API Handler
@@ -452,12 +626,13 @@ class ViduHandler:
         base_url = config.get('base_url', 'https://api.vidu.com')
         url = f"{base_url.rstrip('/')}/ent/v2/tasks/{task_id}/creations" 
         headers = ViduHandler._get_headers(config)
+        poll_interval = float(config.get('poll_interval', 5))
         
         logger.info(f"[VIDU] Waiting for task {task_id}...")
         start_time = time.time()
         while time.time() - start_time < max_wait:
             try:
-                resp = requests.get(url, headers=headers, timeout=30)
+                resp = http.get(url, headers=headers, timeout=30)
                 if resp.status_code == 200:
                     data = resp.json()
                     state = data.get('state')
@@ -474,13 +649,13 @@ class ViduHandler:
                     elif state == 'failed':
                         logger.error(f"[VIDU] Task {task_id} Failed. ErrCode: {err_code}")
                         return {'success': False, 'error_msg': f"Failed: {data.get('err_code')}"}
-                    time.sleep(5)
+                    time.sleep(poll_interval)
                 else:
                     logger.warning(f"[VIDU] Unknown state: {state}")
-                    time.sleep(5)
+                    time.sleep(poll_interval)
             except Exception as e:
                 logger.error(f"[VIDU] Query error: {e}")
-                time.sleep(5)
+                time.sleep(poll_interval)
         
         return {'success': False, 'error_msg': f'Timeout after {max_wait}s waiting for result'}
 
@@ -519,7 +694,7 @@ class ViduHandler:
         
         try:
             url = f"{base_url.rstrip('/')}/ent/v2/start-end2video"
-            resp = requests.post(url, json=payload, headers=ViduHandler._get_headers(config), timeout=60)
+            resp = http.post(url, json=payload, headers=ViduHandler._get_headers(config), timeout=60)
             
             if resp.status_code in [200, 201]:
                 task_id = resp.json().get('task_id')
@@ -541,7 +716,7 @@ class ViduHandler:
         }
         try:
             url = f"{config.get('base_url', 'https://api.vidu.com').rstrip('/')}/ent/v2/reference2image"
-            resp = requests.post(url, json=payload, headers=ViduHandler._get_headers(config), timeout=60)
+            resp = http.post(url, json=payload, headers=ViduHandler._get_headers(config), timeout=60)
             if resp.status_code in [200, 201]:
                 data = resp.json()
                 task_id = data.get('task_id')
@@ -598,7 +773,7 @@ class ViduHandler:
         }
         try:
             url = f"{config.get('base_url', 'https://api.vidu.com').rstrip('/')}/ent/v2/reference2image"
-            resp = requests.post(url, json=payload, headers=ViduHandler._get_headers(config), timeout=60)
+            resp = http.post(url, json=payload, headers=ViduHandler._get_headers(config), timeout=60)
             if resp.status_code in [200, 201]:
                 data = resp.json()
                 task_id = data.get('task_id')
@@ -611,6 +786,8 @@ class ViduHandler:
             logger.exception("[VIDU] Fusion generation failed")
             return {'success': False, 'error_msg': str(e)}
 
+@register_provider('jimeng')
+@instrumented('jimeng')
 class JimengHandler:
     """
     即梦 (Volcengine) API Handler
@@ -625,7 +802,8 @@ class JimengHandler:
     # 火山引擎配置常量
     HOST = 'visual.volcengineapi.com'
     REGION = 'cn-north-1'
-    ENDPOINT = 'https://visual.volcengineapi.com'
+    # 可通过环境变量指向本地桩服务 (benchmarks/stub_provider.py)，签名中的 HOST 不变
+    ENDPOINT = os.getenv('JIMENG_ENDPOINT', 'https://visual.volcengineapi.com')
     SERVICE = 'cv'
     METHOD = 'POST'
     
@@ -738,7 +916,7 @@ class JimengHandler:
             headers, request_url = JimengHandler._sign_request(access_key, secret_key, req_body, action='CVSync2AsyncSubmitTask')
             logger.info(f"[Jimeng] Submitting T2I task. Model: {model}, Prompt: {prompt[:30]}...")
 
-            resp = requests.post(request_url, headers=headers, data=req_body, timeout=60)
+            resp = http.post(request_url, headers=headers, data=req_body, timeout=60)
             if resp.status_code != 200: return {'success': False, 'error_msg': f"Submit failed: {resp.text}"}
             
             data = resp.json()
@@ -748,12 +926,13 @@ class JimengHandler:
             task_id = data.get('data', {}).get('task_id')
             if not task_id: return {'success': False, 'error_msg': "No task_id returned"}
             
-            return JimengHandler._wait_for_t2i_result(task_id, model, access_key, secret_key, media_manager, entity_id)
+            return JimengHandler._wait_for_t2i_result(task_id, model, access_key, secret_key, media_manager, entity_id,
+                                                      poll_interval=float(config.get('poll_interval', 2)))
         except Exception as e:
             return {'success': False, 'error_msg': str(e)}
 
     @staticmethod
-    def _wait_for_t2i_result(task_id, req_key, access_key, secret_key, media_manager, entity_id, max_wait=600):
+    def _wait_for_t2i_result(task_id, req_key, access_key, secret_key, media_manager, entity_id, max_wait=600, poll_interval=2):
         """
         轮询文生图结果
         Action: CVSync2AsyncGetResult
@@ -764,7 +943,7 @@ class JimengHandler:
         while time.time() - start_time < max_wait:
             try:
                 headers, request_url = JimengHandler._sign_request(access_key, secret_key, req_body_str, action='CVSync2AsyncGetResult')
-                resp = requests.post(request_url, headers=headers, data=req_body_str, timeout=30)
+                resp = http.post(request_url, headers=headers, data=req_body_str, timeout=30)
                 
                 if resp.status_code == 200:
                     data = resp.json()
@@ -785,22 +964,22 @@ class JimengHandler:
                                 return {'success': True, 'url': saved_url}
                             return {'success': False, 'error_msg': "No image data returned"}
                         elif status in ['in_queue', 'generating']:
-                            time.sleep(2)
+                            time.sleep(poll_interval)
                         elif status in ['not_found', 'expired']:
                              logger.warning(f"[Jimeng] Task {task_id} status: {status}")
                              return {'success': False, 'error_msg': f"Task status: {status}"}
                         else:
-                            time.sleep(2)
+                            time.sleep(poll_interval)
                     else:
                         logger.error(f"[Jimeng] Query Error: {data.get('message')}")
                         return {'success': False, 'error_msg': f"Query failed (code={data.get('code')}): {data.get('message')}"}
                 else:
                     logger.warning(f"[Jimeng] Query HTTP Error: {resp.status_code}")
-                    time.sleep(2)
+                    time.sleep(poll_interval)
                     
             except Exception as e:
                 logger.error(f"[Jimeng] Polling error: {e}")
-                time.sleep(2)
+                time.sleep(poll_interval)
                 
         return {'success': False, 'error_msg': "Timeout waiting for T2I result"}
     
@@ -836,7 +1015,7 @@ class JimengHandler:
             req_body = json.dumps(body_params)
             headers, request_url = JimengHandler._sign_request(access_key, secret_key, req_body, action='CVSync2AsyncSubmitTask')
             logger.info(f"[Jimeng] Creating video task with model: {model}")
-            resp = requests.post(request_url, headers=headers, data=req_body, timeout=60)
+            resp = http.post(request_url, headers=headers, data=req_body, timeout=60)
             
             if resp.status_code != 200: return {'success': False, 'error_msg': f"Submit failed: {resp.text}"}
             
@@ -848,13 +1027,14 @@ class JimengHandler:
             if not task_id: return {'success': False, 'error_msg': "No task_id returned"}
             
             logger.info(f"[Jimeng] Video task submitted: {task_id}")
-            return JimengHandler._wait_for_video_result(task_id, model, access_key, secret_key, media_manager, entity_id)
+            return JimengHandler._wait_for_video_result(task_id, model, access_key, secret_key, media_manager, entity_id,
+                                                        poll_interval=float(config.get('poll_interval', 5)))
         except Exception as e:
             logger.exception("[Jimeng] Video generation failed")
             return {'success': False, 'error_msg': str(e)}
 
     @staticmethod
-    def _wait_for_video_result(task_id, req_key, access_key, secret_key, media_manager, entity_id, max_wait=600):
+    def _wait_for_video_result(task_id, req_key, access_key, secret_key, media_manager, entity_id, max_wait=600, poll_interval=5):
         """
         轮询视频结果 (Jimeng Video 3.0)
         Action: CVSync2AsyncGetResult
@@ -865,7 +1045,7 @@ class JimengHandler:
         while time.time() - start_time < max_wait:
             try:
                 headers, request_url = JimengHandler._sign_request(access_key, secret_key, req_body_str, action='CVSync2AsyncGetResult')
-                resp = requests.post(request_url, headers=headers, data=req_body_str, timeout=30)
+                resp = http.post(request_url, headers=headers, data=req_body_str, timeout=30)
                 if resp.status_code == 200:
                     data = resp.json()
                     if data.get('code') == 10000:
@@ -877,19 +1057,19 @@ class JimengHandler:
                                 return {'success': True, 'url': saved_url}
                             return {'success': False, 'error_msg': "No video URL"}
                         elif status in ['in_queue', 'generating']:
-                            time.sleep(5)
+                            time.sleep(poll_interval)
                         else:
-                            time.sleep(5)
+                            time.sleep(poll_interval)
                     else:
                         # 业务错误 (如审核不通过)
                         logger.error(f"[Jimeng] Query Fail: {data.get('message')}")
                         return {'success': False, 'error_msg': f"Query failed (code={resp.status_code}): {data.get('message')}"}
                 else:
-                    time.sleep(5)
+                    time.sleep(poll_interval)
                     
             except Exception as e:
                 logger.error(f"[Jimeng] Polling error: {e}")
-                time.sleep(5)
+                time.sleep(poll_interval)
                 
         return {'success': False, 'error_msg': "Timeout waiting for video result"} 
     
@@ -936,7 +1116,7 @@ class JimengHandler:
             headers, request_url = JimengHandler._sign_request(access_key, secret_key, req_body_str, action='CVSync2AsyncSubmitTask')
             
             logger.info(f"[Jimeng] Submitting i2i task. Prompt: {prompt[:30]}...")
-            resp = requests.post(request_url, headers=headers, data=req_body_str, timeout=60)
+            resp = http.post(request_url, headers=headers, data=req_body_str, timeout=60)
             
             if resp.status_code != 200: return {'success': False, 'error_msg': f"Submit failed: {resp.text}"}
             
@@ -945,13 +1125,14 @@ class JimengHandler:
             if not task_id: return {'success': False, 'error_msg': "No task_id returned"}
             
             logger.info(f"[Jimeng] i2i task submitted. Task ID: {task_id}")
-            return JimengHandler._wait_for_i2i_result(task_id, access_key, secret_key, media_manager, entity_id)
+            return JimengHandler._wait_for_i2i_result(task_id, access_key, secret_key, media_manager, entity_id,
+                                                      poll_interval=float(config.get('poll_interval', 2)))
         except Exception as e:
             logger.exception("[Jimeng] Fusion failed")
             return {'success': False, 'error_msg': str(e)}
             
     @staticmethod
-    def _wait_for_i2i_result(task_id, access_key, secret_key, media_manager, entity_id, max_wait=600):
+    def _wait_for_i2i_result(task_id, access_key, secret_key, media_manager, entity_id, max_wait=600, poll_interval=2):
         """
         轮询图生图结果
         """
@@ -962,7 +1143,7 @@ class JimengHandler:
         while time.time() - start_time < max_wait:
             try:
                 headers, request_url = JimengHandler._sign_request(access_key, secret_key, req_body_str, action='CVSync2AsyncGetResult')
-                resp = requests.post(request_url, headers=headers, data=req_body_str, timeout=30)
+                resp = http.post(request_url, headers=headers, data=req_body_str, timeout=30)
                 if resp.status_code == 200:
                     data = resp.json()
                     if data.get('code') == 10000:
@@ -981,22 +1162,24 @@ class JimengHandler:
                                 return {'success': True, 'url': saved_url}
                             return {'success': False, 'error_msg': "No data"}
                         elif status in ['in_queue', 'generating']:
-                            time.sleep(2)
+                            time.sleep(poll_interval)
                         else:
-                             time.sleep(2)
+                             time.sleep(poll_interval)
                     else:
-                        time.sleep(2)
+                        time.sleep(poll_interval)
                 else:
                     logger.warning(f"[Jimeng] Query HTTP Error: {resp.status_code}")
-                    time.sleep(2)
+                    time.sleep(poll_interval)
 
             except Exception as e:
                 logger.error(f"[Jimeng] Polling error: {e}")
-                time.sleep(2)
+                time.sleep(poll_interval)
         
         return {'success': False, 'error_msg': "Timeout waiting for i2i result"}
 
 
+@register_provider('minimax')
+@instrumented('minimax')
 class MiniMaxHandler:
     @staticmethod
     def _get_headers(config):
@@ -1023,7 +1206,7 @@ class MiniMaxHandler:
         
         try:
             url = f"{base_url.rstrip('/')}/v1/image_generation"
-            resp = requests.post(url, json=payload, headers=MiniMaxHandler._get_headers(config), timeout=120)
+            resp = http.post(url, json=payload, headers=MiniMaxHandler._get_headers(config), timeout=120)
             
             if resp.status_code == 200:
                 data = resp.json()
@@ -1065,7 +1248,7 @@ class MiniMaxHandler:
         
         try:
             url = f"{base_url.rstrip('/')}/v1/video_generation"
-            resp = requests.post(url, json=payload, headers=MiniMaxHandler._get_headers(config), timeout=60)
+            resp = http.post(url, json=payload, headers=MiniMaxHandler._get_headers(config), timeout=60)
             
             if resp.status_code == 200:
                 data = resp.json()
@@ -1094,7 +1277,7 @@ class MiniMaxHandler:
         
         try:
             logger.info(f"[MiniMax] Retrieving file_id: {file_id}")
-            resp = requests.get(url, headers=headers, params=params, timeout=30)
+            resp = http.get(url, headers=headers, params=params, timeout=30)
             if resp.status_code == 200:
                 data = resp.json()
                 if data.get('base_resp', {}).get('status_code') == 0:
@@ -1112,6 +1295,7 @@ class MiniMaxHandler:
         base_url = config.get('base_url', 'https://api.minimaxi.com')
         url = f"{base_url.rstrip('/')}/v1/query/video_generation?task_id={task_id}"
         headers = MiniMaxHandler._get_headers(config)
+        poll_interval = float(config.get('poll_interval', 10))
         
         logger.info(f"Step 1: 开始轮询视频任务 [ID: {task_id}], 最大等待: {max_wait}秒")
         start_time = time.time()
@@ -1119,7 +1303,7 @@ class MiniMaxHandler:
         while time.time() - start_time < max_wait:
             elapsed_time = int(time.time() - start_time)
             try:
-                resp = requests.get(url, headers=headers, timeout=30)
+                resp = http.get(url, headers=headers, timeout=30)
                 if resp.status_code == 200:
                     data = resp.json()
                     base_resp = data.get('base_resp', {})
@@ -1141,7 +1325,7 @@ class MiniMaxHandler:
                             else:
                                 return {'success': False, 'error_msg': "Success status but no video URL or File ID found"}
                         
-                        elif status == 'Failed':
+                        elif status in ('Fail', 'Failed'):
                             return {'success': False, 'error_msg': data.get('error_message')}
                     else:
                         logger.warning(f"API 返回非0状态码: {base_resp.get('status_msg')}")
@@ -1149,7 +1333,7 @@ class MiniMaxHandler:
                     logger.warning(f"HTTP 请求失败, 状态码: {resp.status_code}")
             except Exception as e:
                 logger.error(f"轮询请求发生异常: {str(e)}")
-            time.sleep(10)
+            time.sleep(poll_interval)
 
         logger.error(f"❌ 任务 [{task_id}] 等待超时")
         return {'success': False, 'error_msg': 'Timeout'}
@@ -1158,13 +1342,15 @@ class MiniMaxHandler:
     def fuse_image(prompt, media_manager, config, base_image_path, ref_image_path_list, entity_id=None):
         return {'success': False, 'error_msg': "海螺AI目前无提供融合图模型"}
 
+@register_provider('zai')
+@instrumented('zai')
 class ZhipuHandler:
     @staticmethod
     def generate_text(messages, config):
         try:
             api_key = config.get('api_key')
             model = config.get('model_name') or 'glm-4.6'
-            client = ZhipuAiClient(api_key=api_key)
+            client = _zhipu_client(api_key)
             
             response = client.chat.completions.create(model=model, messages=messages)
             if response.choices:
@@ -1173,12 +1359,20 @@ class ZhipuHandler:
         except Exception as e:
             return {'success': False, 'error_msg': str(e)}
 
+    @staticmethod
+    def generate_text_stream(messages, config):
+        client = _zhipu_client(config.get('api_key'))
+        model = config.get('model_name') or 'glm-4.6'
+        for chunk in client.chat.completions.create(model=model, messages=messages, stream=True):
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
     @staticmethod
     def generate_image(prompt, media_manager, config, entity_id=None):
         try:
             api_key = config.get('api_key')
             model = config.get('model_name') or 'cogview-3'
-            client = ZhipuAiClient(api_key=api_key)
+            client = _zhipu_client(api_key)
             
             response = client.images.generations(
                 model=model, prompt=prompt,
@@ -1203,7 +1397,7 @@ class ZhipuHandler:
             if not start_img_b64: return {'success': False, 'error_msg': "Zhipu requires start image"}
             
             model = config.get('model_name') or 'cogvideox-2'
-            client = ZhipuAiClient(api_key=api_key)
+            client = _zhipu_client(api_key)
             
             response = client.videos.generations(
                 model=model, image_url=[start_img_b64, end_img_b64] if end_img_b64 else [start_img_b64],
@@ -1236,26 +1430,132 @@ class ZhipuHandler:
 # ============================================================
 
 def get_handler(provider_type):
-    if provider_type == 'aliyun': return AliyunHandler
-    if provider_type == 'siliconflow' or provider_type == 'runninghub': return OpenAICompatibleHandler
-    if provider_type == 'comfyui': return ComfyUIHandler
-    if provider_type == 'vidu': return ViduHandler
-    if provider_type == 'jimeng': return JimengHandler
-    if provider_type == 'zai': return ZhipuHandler
-    if provider_type == 'minimax': return MiniMaxHandler
-    return MockHandler
+    """按 provider type 查注册表，未登记的 type (含空值) 回退到 MockHandler"""
+    handler = PROVIDERS.get(provider_type)
+    if handler is None and PROVIDER_PLUGINS and not _plugins_loaded:
+        _load_plugins()
+        handler = PROVIDERS.get(provider_type)
+    return handler or MockHandler
 
 # ============================================================
 #  Business Logic (Prompt Engineering & Coordination)
 # ============================================================
 
-def run_text_generation(messages, config):
+# 并行 provider 调用的默认共享截止时间 (秒)
+PARALLEL_CALL_DEADLINE = float(os.getenv('PARALLEL_CALL_DEADLINE', 180))
+
+def run_parallel(calls: Dict[str, Callable[[], Dict[str, Any]]], deadline: Optional[float] = PARALLEL_CALL_DEADLINE, max_workers: Optional[int] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    结构化并发：并行执行多个互不依赖的 provider 调用，全部结束 (或到达共享截止时间) 后才返回。
+
+    Args:
+        calls: { 名称: 无参函数 }，函数返回 handler 风格的结果字典 ({'success': ..., ...})。
+        deadline: 所有调用共享的截止时间 (秒)，None 表示不限时。
+        max_workers: 最大并发数，默认全部同时发起。
+
+    Returns:
+        { 名称: 结果字典 }。部分失败不会影响其他调用：
+            - 抛出异常的调用记为 {'success': False, 'error_msg': 异常信息}
+            - 截止时仍未完成的调用记为 {'success': False, 'error_msg': ..., 'timeout': True}，
+              尚未开始的会被取消，已在执行的在后台自然结束，结果被丢弃
+        是否整体失败由调用方根据各项结果决定。
+    """
+    if not calls: return {}
+    results = {}
+    executor = ThreadPoolExecutor(max_workers=min(max_workers or len(calls), len(calls)))
+    try:
+        futures = {executor.submit(tracing.propagate(func)): name for name, func in calls.items()}
+        done, pending = wait(futures, timeout=deadline)
+        for future in done:
+            name = futures[future]
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                logger.error(f"[Parallel] {name} failed: {e}")
+                results[name] = {'success': False, 'error_msg': str(e)}
+        for future in pending:
+            name = futures[future]
+            future.cancel()
+            logger.warning(f"[Parallel] {name} exceeded deadline ({deadline}s)")
+            results[name] = {'success': False, 'error_msg': f"Deadline exceeded ({deadline}s)", 'timeout': True}
+    finally:
+        executor.shutdown(wait=False)
+    return results
+
+def _text_cache_key(messages, config):
+    # 按 provider + 模型 + 消息列表寻址 (不含 api_key)
+    return make_key('text', config.get('type'), config.get('base_url'), config.get('model_name'), messages)
+
+@metrics.timed(metrics.GENERATION_SECONDS, kind='text')
+@tracing.traced('generation.text')
+def run_text_generation(messages, config, cache=None, force_refresh=False):
+    """
+    文本生成入口
+    :param cache: 接口名 (如 'scene_prompt')，在 LLM_CACHE_ENDPOINTS 中的接口才启用响应缓存
+    :param force_refresh: 跳过缓存读取强制重新生成，结果仍会写入缓存
+    """
     logger.info(f"[Main] Run Text Gen. Provider: {config.get('type')}")
     handler = get_handler(config.get('type'))
-    return handler.generate_text(messages, config)
+    if not cache or cache not in TEXT_CACHE_ENDPOINTS:
+        return handler.generate_text(messages, config)
+
+    cache_key = _text_cache_key(messages, config)
+    cached = None if force_refresh else text_cache.get(cache_key)
+    if cached:
+        text_cache.record(cache, True, cached)
+        logger.info(f"[Main] Text Gen cache hit ({cache})")
+        return {'success': True, 'content': cached['value'], 'cached': True}
+
+    started = time.time()
+    result = handler.generate_text(messages, config)
+    if result.get('success'):
+        text_cache.set(cache_key, result['content'], latency_ms=(time.time() - started) * 1000, tokens=result.get('tokens'))
+    text_cache.record(cache, False)
+    return result
+
+@metrics.timed(metrics.GENERATION_SECONDS, kind='text_stream')
+@tracing.traced('generation.text_stream')
+def run_text_generation_stream(messages, config, on_delta=None, cache=None, force_refresh=False):
+    """
+    流式文本生成：每收到一段增量文本就回调 on_delta(delta)，返回值与 run_text_generation 相同。
+    中途出错时返回 {'success': False, 'error_msg', 'content': 已收到的部分}，调用方可保留部分结果。
+    不支持流式的 provider 自动退化为一次性生成 (整段回调一次)。
+    """
+    handler = get_handler(config.get('type'))
+    use_cache = bool(cache) and cache in TEXT_CACHE_ENDPOINTS
+    if not hasattr(handler, 'generate_text_stream'):
+        result = run_text_generation(messages, config, cache=cache, force_refresh=force_refresh)
+        if result.get('success') and on_delta: on_delta(result['content'])
+        return result
+
+    logger.info(f"[Main] Run Text Stream. Provider: {config.get('type')}")
+    cache_key = _text_cache_key(messages, config) if use_cache else None
+    cached = text_cache.get(cache_key) if use_cache and not force_refresh else None
+    if cached:
+        text_cache.record(cache, True, cached)
+        if on_delta: on_delta(cached['value'])
+        return {'success': True, 'content': cached['value'], 'cached': True}
+
+    started = time.time()
+    parts = []
+    try:
+        for delta in handler.generate_text_stream(messages, config):
+            parts.append(delta)
+            if on_delta: on_delta(delta)
+    except Exception as e:
+        logger.error(f"[Main] Text Stream interrupted after {sum(len(p) for p in parts)} chars: {e}")
+        return {'success': False, 'error_msg': str(e), 'content': ''.join(parts)}
 
+    content = ''.join(parts)
+    if use_cache:
+        text_cache.set(cache_key, content, latency_ms=(time.time() - started) * 1000)
+        text_cache.record(cache, False)
+    return {'success': True, 'content': content}
 
-def run_image_generation(visual_desc, style_desc, consistency_text, frame_type, config, media_manager, start_prompt_ref=None, prev_shot_context="", entity_id=None):
+
+@metrics.timed(metrics.GENERATION_SECONDS, kind='image')
+@tracing.traced('generation.image')
+def run_image_generation(visual_desc, style_desc, consistency_text, frame_type, config, media_manager, start_prompt_ref=None, prev_shot_context="", entity_id=None, use_prompt_cache=True, project_id=None):
     """
     图片生成流程：包含 Prompt 优化逻辑 (Prompt Chaining)
 
@@ -1280,6 +1580,9 @@ def run_image_generation(visual_desc, style_desc, consistency_text, frame_type,
         start_prompt_ref (Optional[str]): **仅当 frame_type='end' 时需要。**
                                           这是由 LLM 为起始帧生成的**优化后**提示词，用于确保结束帧在风格和运镜上100%匹配。
         prev_shot_context (str): 前一个镜头的简短上下文描述，用于辅助 LLM 在生成起始帧时保持叙事连贯性。
+        use_prompt_cache (bool): 是否复用缓存的优化结果 (相同系统提示词/用户提示词/文本模型)。
+                                 为 False 时强制重新优化，结果仍会写入缓存。
+        project_id (Optional[str]): 用于按项目统计缓存节省的耗时与 token。
 
     Returns:
         Tuple[Dict[str, Any], str]: 包含两部分的元组：
@@ -1321,22 +1624,35 @@ def run_image_generation(visual_desc, style_desc, consistency_text, frame_type,
     # 2. 尝试使用文本模型优化 Prompt
     handler = get_handler('aliyun')
     if hasattr(handler, 'generate_text'):
-        try:
-            text_config = config.copy()
-            if config.get('type') == 'aliyun': text_config['model_name'] = 'qwen-plus'
-            elif config.get('type') in ['siliconflow', 'runninghub']: text_config['model_name'] = 'Qwen/Qwen2.5-7B-Instruct'
-            elif config.get('type') == 'zai': text_config['model_name'] = 'glm-4.6'
-            
-            logger.info("[Prompt Eng] Starting optimization...")
-            res = handler.generate_text([{'role': 'system', 'content': sys_prompt + " 使用中文回答"}, {'role': 'user', 'content': user_prompt}], text_config)
+        with metrics.timer(metrics.GENERATION_STAGE_SECONDS, stage='prompt_engineering'), tracing.span('prompt_engineering'):
+            try:
+                text_config = config.copy()
+                if config.get('type') == 'aliyun': text_config['model_name'] = 'qwen-plus'
+                elif config.get('type') in ['siliconflow', 'runninghub']: text_config['model_name'] = 'Qwen/Qwen2.5-7B-Instruct'
+                elif config.get('type') == 'zai': text_config['model_name'] = 'glm-4.6'
             
-            if res['success']:
-                optimized_prompt = res['content']
-                logger.info(f"[Prompt Eng] Optimized: {optimized_prompt[:50]}...")
-            else:
-                logger.warning(f"[Prompt Eng] Failed: {res.get('error_msg')}")
-        except Exception as e:
-            logger.error(f"[Prompt Eng] Error: {e}")
+                messages = [{'role': 'system', 'content': sys_prompt + " 使用中文回答"}, {'role': 'user', 'content': user_prompt}]
+                cache_key = make_key('prompt_eng', 'aliyun', text_config.get('model_name'), messages)
+                cached = prompt_cache.get(cache_key) if use_prompt_cache else None
+
+                if cached:
+                    optimized_prompt = cached['value']
+                    prompt_cache.record(project_id, True, cached)
+                    logger.info(f"[Prompt Eng] Cache hit, skipped LLM call (saved ~{cached['latency_ms']}ms)")
+                else:
+                    logger.info("[Prompt Eng] Starting optimization...")
+                    started = time.time()
+                    res = handler.generate_text(messages, text_config)
+                
+                    if res['success']:
+                        optimized_prompt = res['content']
+                        prompt_cache.set(cache_key, optimized_prompt, latency_ms=(time.time() - started) * 1000, tokens=res.get('tokens'))
+                        prompt_cache.record(project_id, False)
+                        logger.info(f"[Prompt Eng] Optimized: {optimized_prompt[:50]}...")
+                    else:
+                        logger.warning(f"[Prompt Eng] Failed: {res.get('error_msg')}")
+            except Exception as e:
+                logger.error(f"[Prompt Eng] Error: {e}")
 
     # Call actual image generation with version control
     img_handler = get_handler(config.get('type'))
@@ -1344,6 +1660,8 @@ def run_image_generation(visual_desc, style_desc, consistency_text, frame_type,
     
     return result, optimized_prompt
 
+@metrics.timed(metrics.GENERATION_SECONDS, kind='video')
+@tracing.traced('generation.video')
 def run_video_generation(prompt, start_img_path, end_img_path, config, media_manager, entity_id=None):
     """
     视频生成逻辑入口 (Video Generation Entry Point)
@@ -1379,6 +1697,8 @@ def run_video_generation(prompt, start_img_path, end_img_path, config, media_man
     handler = get_handler(config.get('type'))
     return handler.generate_video(prompt, media_manager, config, start_img=start_img_path, end_img=end_img_path, entity_id=entity_id)
 
+@metrics.timed(metrics.GENERATION_SECONDS, kind='simple_image')
+@tracing.traced('generation.simple_image')
 def run_simple_image_generation(prompt, config, media_manager, entity_id=None):
     """
     不带提示词工程的简单图片生成方法
@@ -1388,11 +1708,15 @@ def run_simple_image_generation(prompt, config, media_manager, entity_id=None):
     handler = get_handler(config.get('type', 'mock'))
     return handler.generate_image(prompt, media_manager, config, entity_id)
 
+@metrics.timed(metrics.GENERATION_SECONDS, kind='voice')
+@tracing.traced('generation.voice')
 def run_voice_generation(text, config, media_manager, entity_id=None):
     logger.info(f"[Main] Run Voice Gen. Provider: {config.get('type')}, EntityID: {entity_id}")
     handler = get_handler(config.get('type'))
     return handler.generate_voice(text, media_manager, config, entity_id)
 
+@metrics.timed(metrics.GENERATION_SECONDS, kind='fusion')
+@tracing.traced('generation.fusion')
 def run_fusion_generation(base_image_path, fusion_prompt, config, media_manager, element_image_paths, entity_id=None):
     """
     融图/图生图逻辑入口 (Image Fusion / Image-to-Image Generation)
@@ -1431,6 +1755,8 @@ def run_fusion_generation(base_image_path, fusion_prompt, config, media_manager,
     handler = get_handler(config.get('type', 'mock'))
     return handler.fuse_image(fusion_prompt, media_manager, config, base_image_path, ref_image_path_list=element_image_paths, entity_id=entity_id)
 
+@metrics.timed(metrics.GENERATION_SECONDS, kind='visual_analysis')
+@tracing.traced('generation.visual_analysis')
 def run_visual_analysis(base_image_path, prompt, config, media_manager):
     """
     视觉理解/图片分析逻辑入口 (Visual Analysis Entry Point)
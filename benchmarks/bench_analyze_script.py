@@ -0,0 +1,71 @@
+"""
+长剧本分镜拆解耗时对比 (Mock provider + 注入延迟)
+
+单次调用: 整部剧本一次性发给模型
+分块并行: 按场景边界分块，ANALYZE_CHUNK_CONCURRENCY 路并行，再合并重编号
+
+Mock 延迟模型: 每次调用固定 BASE_LATENCY 秒 + 每输出一个分镜 PER_SHOT_LATENCY 秒 (模拟逐 token 生成)
+
+用法 (在项目根目录执行):
+    python benchmarks/bench_analyze_script.py [scenes]
+"""
+import os
+import re
+import sys
+import json
+import time
+import logging
+
+sys.path.insert(0, os.path.abspath("."))
+
+import main
+import ai_service
+from script_chunker import chunk_script
+
+BASE_LATENCY = 0.3
+PER_SHOT_LATENCY = 0.01
+SHOTS_PER_SCENE = 3
+
+
+def build_script(scenes):
+    parts = []
+    for i in range(1, scenes + 1):
+        parts.append(f"第{i}场 日 内 旧城区咖啡馆\n")
+        parts.append("林夏推门而入，雨水顺着伞尖滴落。她环顾四周，目光停在角落里的陈默身上。" * 4 + "\n")
+        parts.append(f"林夏：你终于肯见我了。（第{i}场台词）\n\n")
+    return "".join(parts)
+
+
+def mock_generate_text(messages, config):
+    """按提示词里出现的场景数生成分镜，并按输出量注入延迟"""
+    content = messages[-1]['content']
+    scenes = re.findall(r"第(\d+)场", content)
+    shots = [{"scene": s, "shot_number": str(k + 1), "visual_description": f"场{s} 镜{k + 1}", "duration": 3}
+             for s in dict.fromkeys(scenes) for k in range(SHOTS_PER_SCENE)]
+    time.sleep(BASE_LATENCY + PER_SHOT_LATENCY * len(shots))
+    return {'success': True, 'content': json.dumps(shots, ensure_ascii=False)}
+
+
+def run(label, client, script):
+    start = time.perf_counter()
+    res = client.post('/api/generate/analyze_script', json={'content': script, 'provider_id': None, 'force_refresh': True}).get_json()
+    elapsed = time.perf_counter() - start
+    shots = res.get('shots', [])
+    scenes = len({s['scene'] for s in shots})
+    print(f"{label:<24} {elapsed:6.2f}s  shots {len(shots)}  scenes {scenes}  chunks {res.get('chunks', 1)}")
+    return elapsed
+
+
+if __name__ == '__main__':
+    scenes = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    logging.disable(logging.INFO)
+    ai_service.MockHandler.generate_text = staticmethod(mock_generate_text)
+    client = main.app.test_client()
+    script = build_script(scenes)
+    print(f"script: {scenes} scenes, {len(script)} chars, concurrency {main.ANALYZE_CHUNK_CONCURRENCY}")
+
+    chunked = run("chunked + parallel", client, script)
+
+    main.chunk_script = lambda text: chunk_script(text, max_chars=10 ** 9)
+    single = run("single call", client, script)
+    print(f"speedup: {single / chunked:.1f}x")
@@ -0,0 +1,54 @@
+"""
+后台任务单次调度开销对比 (Mock provider)
+
+旧路径: app.test_request_context(json=...) → 调用路由函数 → Response.get_json()
+新路径: service_runner 直接调用 GenerationService
+
+用法 (在项目根目录执行):
+    python benchmarks/bench_async_bridge.py [iterations]
+"""
+import os
+import sys
+import time
+import logging
+
+sys.path.insert(0, os.path.abspath("."))
+
+import main
+from async_bridge import service_runner
+
+
+def legacy_context_runner(app, target_route_func, request_data, save_callback=None):
+    """重构前 async_bridge.context_runner 的实现，仅用于对比"""
+    with app.test_request_context(json=request_data):
+        raw_response = target_route_func()
+        response_obj = raw_response[0] if isinstance(raw_response, tuple) else raw_response
+        result = response_obj.get_json()
+        if result and result.get('success'):
+            if save_callback: save_callback(result)
+        else:
+            raise Exception(result)
+
+
+def bench(label, fn, iterations):
+    for _ in range(min(50, iterations)): fn()  # 预热
+    start = time.perf_counter()
+    for _ in range(iterations): fn()
+    elapsed = time.perf_counter() - start
+    per_job = elapsed / iterations * 1e6
+    print(f"{label:<28} {iterations} jobs  total {elapsed:.3f}s  per job {per_job:.1f}µs")
+    return per_job
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    # 屏蔽逐条日志，只测调度本身
+    logging.disable(logging.INFO)
+
+    # provider_id 为空时 get_provider_config 返回 mock 配置，MockHandler.generate_text 不做任何 IO
+    data = {'scene_description': '雨夜的旧街道', 'provider_id': None}
+    sink = lambda res: res['prompt']
+
+    old = bench("context_runner (legacy)", lambda: legacy_context_runner(main.app, main.generate_scene_prompt, data, sink), iterations)
+    new = bench("service_runner", lambda: service_runner(main.gen_service.generate_scene_prompt, data, sink), iterations)
+    print(f"overhead saved per job: {old - new:.1f}µs ({(1 - new / old) * 100:.0f}%)")
@@ -0,0 +1,277 @@
+"""
+端到端压测 (本地桩服务，不产生真实调用费用)
+
+启动 benchmarks/stub_provider.py 模拟厂商接口，按场景驱动 Flask 应用 (test_client，经过路由 / 任务队列 / 落盘全流程)：
+    crud      建项目 + 批量建分镜 + 读分镜 + 改项目
+    analyze   剧本分镜拆解 (文本 provider)
+    images    批量场景图 (异步任务队列，--provider 指定图片 provider)
+    videos    批量融图视频 (异步任务队列，首尾帧 base64 上传)
+    export    剪映草稿导出 + 打包 (-n 个融图分镜)
+
+每个场景在独立子进程 + 独立临时工作目录中运行，峰值 RSS 互不影响。
+输出：每个场景的 成功/失败数、耗时、吞吐 (ops/s)、p50 / p95 延迟、峰值 RSS
+
+用法 (在项目根目录执行):
+    python benchmarks/bench_e2e.py [--scenarios crud,analyze,images,videos,export] [--provider vidu]
+                                   [-n 20] [--concurrency 4] [--latency 0.02] [--job-seconds 1]
+                                   [--rate-limit 0] [--error-rate 0] [--fail-rate 0]
+provider 可选: siliconflow / vidu / jimeng / minimax / aliyun (文本固定走 siliconflow 协议，aliyun 时走 DashScope)
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stub_provider import make_server, make_png, make_mp4
+
+SCENARIOS = ['crud', 'analyze', 'images', 'videos', 'export']
+
+
+def percentile(values, q):
+    if not values: return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def build_script(scenes):
+    return "".join(f"第{i}场 日 内 旧城区咖啡馆\n林夏推门而入，雨水顺着伞尖滴落。\n林夏：你终于肯见我了。\n\n" for i in range(1, scenes + 1))
+
+
+# ============================================================
+#  Worker (子进程)：在临时目录中 import main 并执行一个场景
+# ============================================================
+
+class Worker:
+    def __init__(self, args):
+        import main
+        self.main = main
+        self.args = args
+        self.stub = args.stub
+        text_type = 'aliyun' if args.provider == 'aliyun' else 'siliconflow'
+        main.db.save_settings({'providers': [
+            self._provider('stub-text', text_type),
+            self._provider('stub-media', args.provider),
+        ]})
+
+    def _provider(self, pid, ptype):
+        config = {'id': pid, 'name': pid, 'type': ptype, 'api_key': 'stub|stub', 'poll_interval': self.args.poll_interval, 'enabled': True}
+        if ptype == 'siliconflow': config['base_url'] = f"{self.stub}/v1"
+        elif ptype in ('vidu', 'minimax'): config['base_url'] = self.stub
+        return config
+
+    def client(self):
+        return self.main.app.test_client()
+
+    def new_project(self, shots=0):
+        client = self.client()
+        project = client.post('/api/projects', json={'film_name': 'bench', 'visual_color_system': '冷色调'}).get_json()
+        if shots:
+            items = [{'scene': '1', 'shot_number': str(i + 1), 'visual_description': f'镜头 {i + 1}'} for i in range(shots)]
+            client.post(f"/api/projects/{project['id']}/shots/batch", json={'shots': items})
+        return project['id']
+
+    def run_sync(self, op, n):
+        """并发执行 n 次同步操作，op() 返回是否成功"""
+        # 必须在 main (eventlet.monkey_patch) 之后导入，否则线程池内部的全局锁是未打补丁的真实锁
+        from concurrent.futures import ThreadPoolExecutor
+        samples = []
+        def timed(_):
+            started = time.perf_counter()
+            try:
+                ok = op()
+            except Exception as e:
+                print(f"op failed: {e}", file=sys.stderr)
+                ok = False
+            samples.append((ok, time.perf_counter() - started))
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as pool:
+            list(pool.map(timed, range(n)))
+        return samples
+
+    def run_queued(self, submits):
+        """逐个提交异步任务，轮询任务队列直到全部结束；延迟 = 完成时刻 - 提交时刻"""
+        queue = self.main.queue
+        submitted = {}
+        for submit in submits:
+            before = set(queue.tasks)
+            started = time.perf_counter()
+            submit()
+            for tid in set(queue.tasks) - before:
+                submitted[tid] = started
+        finished = {}
+        while len(finished) < len(submitted):
+            for tid in submitted:
+                if tid not in finished and queue.tasks[tid]['status'] in ('success', 'failed'):
+                    finished[tid] = time.perf_counter()
+            time.sleep(0.01)
+        return [(queue.tasks[tid]['status'] == 'success', finished[tid] - submitted[tid]) for tid in submitted]
+
+    # --- 场景 ---
+    def scenario_crud(self):
+        def op():
+            client = self.client()
+            pid = self.new_project(shots=20)
+            ok = len(client.get(f"/api/projects/{pid}/shots").get_json()) == 20
+            return ok and client.put(f"/api/projects/{pid}", json={'description': 'bench'}).status_code == 200
+        return self.run_sync(op, self.args.n)
+
+    def scenario_analyze(self):
+        pid = self.new_project()
+        script = build_script(self.args.scenes)
+        def op():
+            res = self.client().post('/api/generate/analyze_script', json={
+                'content': script, 'project_id': pid, 'provider_id': 'stub-text', 'force_refresh': True})
+            return res.status_code == 200 and bool(res.get_json().get('shots'))
+        return self.run_sync(op, self.args.n)
+
+    def scenario_images(self):
+        pid = self.new_project(shots=self.args.n)
+        shots = self.main.db.get_shots(pid)
+        client = self.client()
+        return self.run_queued([
+            (lambda s=s: client.post('/api/async/generate/scene_image', json={
+                'project_id': pid, 'scene_id': s['id'], 'scene_prompt': s['visual_description'], 'provider_id': 'stub-media'}))
+            for s in shots])
+
+    def _fusion_project(self, with_video=False):
+        """n 个融图分镜，首尾帧为桩 PNG (with_video 时同时带桩 MP4)"""
+        db, media = self.main.db, self.main.media_mgr
+        pid = self.new_project()
+        png = make_png(self.args.image_bytes)
+        for i in range(self.args.n):
+            fusion = db.create_fusion(pid, {'shot_number': str(i + 1), 'scene': '1', 'visual_description': f'融图 {i + 1}'})
+            update = {'result_image': media.save_binary(png, 'image', fusion['id'], '.png'),
+                      'end_frame_image': media.save_binary(png, 'image', fusion['id'], '.png'),
+                      'fusion_prompt': '镜头缓慢推进，雨丝飘落'}
+            if with_video:
+                update['video_url'] = media.save_binary(make_mp4(self.args.video_bytes), 'video', fusion['id'], '.mp4')
+            db.update_fusion(pid, fusion['id'], update)
+        return pid
+
+    def scenario_videos(self):
+        pid = self._fusion_project()
+        client = self.client()
+        return self.run_queued([
+            (lambda f=f: client.post('/api/async/generate/fusion_video', json={
+                'project_id': pid, 'fusion_id': f['id'], 'provider_id': 'stub-media'}))
+            for f in self.main.db.get_fusions(pid)])
+
+    def scenario_export(self):
+        pid = self._fusion_project(with_video=True)
+        client = self.client()
+        def op():
+            client.post(f"/api/projects/{pid}/export/jianying")
+            while True:
+                state = client.get(f"/api/projects/{pid}/export/jianying").get_json()
+                if state['status'] in ('success', 'failed', 'none'): return state['status'] == 'success'
+                time.sleep(0.02)
+        # 每次导出前删掉压缩包，避免命中 "项目未变化直接返回"
+        samples = []
+        for _ in range(self.args.repeat):
+            for path in (self.main._export_zip_path(pid), self.main._export_zip_path(pid) + '.json'):
+                if os.path.exists(path): os.remove(path)
+            started = time.perf_counter()
+            samples.append((op(), time.perf_counter() - started))
+        return samples
+
+    def run(self, scenario):
+        started = time.perf_counter()
+        samples = getattr(self, f"scenario_{scenario}")()
+        wall = time.perf_counter() - started
+        latencies = [lat for ok, lat in samples]
+        return {
+            'scenario': scenario,
+            'ops': len(samples),
+            'ok': sum(1 for ok, _ in samples if ok),
+            'wall_s': round(wall, 3),
+            'throughput': round(len(samples) / wall, 2) if wall else 0,
+            'p50_ms': round(percentile(latencies, 0.5) * 1000, 1),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 1),
+            # Linux 下 ru_maxrss 单位为 KB
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        }
+
+
+# ============================================================
+#  Driver (父进程)：启动桩服务，逐个场景起子进程并汇总
+# ============================================================
+
+def run_scenario(scenario, args, stub_url):
+    workdir = tempfile.mkdtemp(prefix=f"bench_{scenario}_")
+    env = dict(os.environ,
+               PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])),
+               DASHSCOPE_HTTP_BASE_URL=f"{stub_url}/api/v1",
+               JIMENG_ENDPOINT=stub_url,
+               TASK_QUEUE_WORKERS=str(args.concurrency))
+    cmd = [sys.executable, os.path.abspath(__file__), '--worker', scenario, '--stub', stub_url,
+           '-n', str(args.n), '--concurrency', str(args.concurrency), '--provider', args.provider,
+           '--scenes', str(args.scenes), '--repeat', str(args.repeat), '--poll-interval', str(args.poll_interval),
+           '--image-bytes', str(args.image_bytes), '--video-bytes', str(args.video_bytes)]
+    try:
+        proc = subprocess.run(cmd, cwd=workdir, env=env, capture_output=True, text=True)
+        for line in reversed(proc.stdout.splitlines()):
+            if line.startswith('RESULT '): return json.loads(line[7:])
+        print(f"[{scenario}] worker failed (exit {proc.returncode}):\n{proc.stderr[-2000:]}", file=sys.stderr)
+        return None
+    finally:
+        if not args.keep: shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main_driver(args):
+    server = make_server(args.stub_port, seed=args.seed, latency=args.latency, jitter=args.jitter, rate_limit=args.rate_limit,
+                         error_rate=args.error_rate, fail_rate=args.fail_rate, job_seconds=args.job_seconds,
+                         text_seconds=args.text_seconds, image_bytes=args.image_bytes, video_bytes=args.video_bytes)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    stub_url = f"http://127.0.0.1:{server.server_address[1]}"
+    print(f"stub {stub_url}  provider {args.provider}  n {args.n}  concurrency {args.concurrency}  "
+          f"latency {args.latency}s  job {args.job_seconds}s  429 {args.rate_limit:.0%}  500 {args.error_rate:.0%}  fail {args.fail_rate:.0%}")
+    print(f"{'scenario':<10} {'ok/ops':>9} {'wall s':>8} {'ops/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'peak RSS MB':>12}")
+    for scenario in args.scenarios.split(','):
+        res = run_scenario(scenario.strip(), args, stub_url)
+        if not res: continue
+        print(f"{res['scenario']:<10} {res['ok']:>4}/{res['ops']:<4} {res['wall_s']:>8.2f} {res['throughput']:>8.2f} "
+              f"{res['p50_ms']:>9.1f} {res['p95_ms']:>9.1f} {res['peak_rss_mb']:>12.1f}")
+    print(f"stub calls: {json.dumps(server.state.stats, ensure_ascii=False)}")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="End-to-end benchmark against the local provider stub")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--provider', default='vidu', choices=['siliconflow', 'vidu', 'jimeng', 'minimax', 'aliyun'])
+    parser.add_argument('-n', type=int, default=20, help="每个场景的操作数 (export 场景为分镜数)")
+    parser.add_argument('--concurrency', type=int, default=4, help="同步场景的并发数 / 任务队列 worker 数")
+    parser.add_argument('--scenes', type=int, default=12, help="analyze 场景的剧本场景数")
+    parser.add_argument('--repeat', type=int, default=3, help="export 场景的导出次数")
+    parser.add_argument('--poll-interval', type=float, default=0.2, help="provider 轮询间隔 (秒)")
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--job-seconds', type=float, default=1.0)
+    parser.add_argument('--text-seconds', type=float, default=0.3)
+    parser.add_argument('--rate-limit', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--fail-rate', type=float, default=0.0)
+    parser.add_argument('--image-bytes', type=int, default=256 * 1024)
+    parser.add_argument('--video-bytes', type=int, default=2 * 1024 * 1024)
+    parser.add_argument('--stub-port', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--keep', action='store_true', help="保留各场景的临时工作目录")
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--stub', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        logging.disable(logging.WARNING)
+        result = Worker(args).run(args.worker)
+        print("RESULT " + json.dumps(result), flush=True)
+        os._exit(0)  # 跳过 eventlet / 线程池的退出清理
+    main_driver(args)
@@ -0,0 +1,97 @@
+"""
+冷启动 import 耗时 (python -X importtime)
+
+对每个入口在全新子进程 + 临时工作目录中执行 `import <模块>`，重复多次取中位数：
+    main    gunicorn 的 main:app
+    gui     桌面版入口 (未安装 pywebview 时跳过)
+另外测量在 main 之后再导入 provider SDK (dashscope / zai) 的增量耗时，
+即 SDK 改为首次使用时才加载后，启动阶段省下的时间
+
+用法 (在项目根目录执行):
+    python benchmarks/bench_import_time.py [--repeat 5] [--top 10]
+"""
+import os
+import re
+import sys
+import argparse
+import tempfile
+import subprocess
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SDK_MODULES = ['dashscope', 'zai']
+SDK_IMPORT = 'import dashscope; from dashscope import ImageSynthesis, VideoSynthesis, MultiModalConversation, Generation; ' \
+             'from dashscope.audio.tts import SpeechSynthesizer; import zai'
+LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|( *)(\S+)")
+
+
+def importtime(code):
+    """返回 [(depth, name, self_us, cumulative_us), ...]，导入失败时返回 None"""
+    with tempfile.TemporaryDirectory() as cwd:
+        env = dict(os.environ, PYTHONPATH=ROOT)
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=cwd, env=env,
+                              capture_output=True, text=True)
+    if proc.returncode != 0:
+        return None
+    rows = []
+    for line in proc.stderr.splitlines():
+        m = LINE.match(line)
+        if m: rows.append((len(m.group(3)) // 2, m.group(4), int(m.group(1)), int(m.group(2))))
+    return rows
+
+
+def top_level(rows):
+    return [(name, cumulative) for depth, name, _, cumulative in rows if depth == 0]
+
+
+def children(rows, module):
+    """module 直接导入的包及其累计耗时 (importtime 先输出子模块，再输出父模块)"""
+    end = next(i for i, (depth, name, _, _) in enumerate(rows) if depth == 0 and name == module)
+    start = max((i for i in range(end) if rows[i][0] == 0), default=-1) + 1
+    return [(name, cumulative) for depth, name, _, cumulative in rows[start:end] if depth == 1]
+
+
+def measure(module, repeat):
+    runs = [importtime(f"import {module}") for _ in range(repeat)]
+    if any(r is None for r in runs): return None
+    totals = [dict(top_level(r))[module] for r in runs]
+    loaded = {name.split('.')[0] for _, name, _, _ in runs[0]}
+    return statistics.median(totals), runs[0], loaded
+
+
+def measure_sdk(repeat):
+    """main 之后再导入 SDK 的增量耗时 (与 main 共享的依赖不重复计算)"""
+    totals = []
+    for _ in range(repeat):
+        rows = importtime(f"import main; {SDK_IMPORT}")
+        if rows is None: return None
+        after_main = False
+        total = 0
+        for name, cumulative in top_level(rows):
+            if after_main: total += cumulative
+            if name == 'main': after_main = True
+        totals.append(total)
+    return statistics.median(totals)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10, help="列出最耗时的前 N 个顶层包")
+    args = parser.parse_args()
+
+    for module in ('main', 'gui'):
+        result = measure(module, args.repeat)
+        if result is None:
+            print(f"{module:<6} import failed (missing dependency?), skipped\n")
+            continue
+        total, rows, loaded = result
+        sdks = [m for m in SDK_MODULES if m in loaded]
+        print(f"{module:<6} cold import {total / 1000:.0f}ms (median of {args.repeat})  provider SDKs loaded: {', '.join(sdks) or 'none'}")
+        for name, cumulative in sorted(children(rows, module), key=lambda r: -r[1])[:args.top]:
+            print(f"    {name:<32} {cumulative / 1000:8.1f}ms")
+        print()
+
+    sdk = measure_sdk(args.repeat)
+    if sdk is not None:
+        print(f"provider SDKs (dashscope + zai) on top of main: {sdk / 1000:.0f}ms")
@@ -0,0 +1,70 @@
+"""
+指标埋点开销估算
+
+文件读写的耗时抖动远大于埋点本身，直接对比开/关指标的总耗时测不出差别，因此分开测：
+    1. 单次埋点的额外开销：timed 包装的空函数 对比 原始空函数
+    2. 一次典型操作 (100 个分镜的项目上 get_shots + update_shot + Mock 文本生成) 触发的埋点次数与耗时
+    开销占比 = 埋点次数 × 单次开销 / 操作耗时
+
+用法 (在项目根目录执行):
+    python benchmarks/bench_metrics.py [iterations]
+"""
+import os
+import sys
+import time
+import atexit
+import shutil
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def observation_count(metrics_module):
+    total = 0
+    for metric in list(metrics_module._registry):
+        for child in list(metric._children.values()):
+            total += child.count if hasattr(child, 'count') else child.value
+    return total
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    workdir = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, workdir, True)
+    os.chdir(workdir)
+
+    import metrics
+    from data_manager import DataManager
+    import ai_service
+
+    # 1. 单次埋点开销
+    histogram = metrics.Histogram('bench_noop_seconds', 'noop')
+    noop = lambda: None
+    wrapped = metrics.timed(histogram)(noop)
+    n = 200000
+    per_observation = min((timeit.timeit(wrapped, number=n) - timeit.timeit(noop, number=n)) / n for _ in range(5))
+
+    # 2. 典型操作
+    db = DataManager()
+    project = db.create_project({'film_name': 'bench'})
+    pid = project['id'] if isinstance(project, dict) else project.id
+    db.create_shots(pid, [{'scene': str(i // 10 + 1), 'shot_number': str(i + 1), 'visual_description': '雨夜旧街道 ' * 20} for i in range(100)])
+    shot_id = db.get_shots(pid)[0]['id']
+    messages = [{'role': 'user', 'content': 'x'}]
+
+    def op():
+        db.get_shots(pid)
+        db.update_shot(pid, shot_id, {'dialogue': 'x'})
+        ai_service.run_text_generation(messages, {'type': 'mock'})
+
+    for _ in range(min(50, iterations)): op()  # 预热
+    before = observation_count(metrics)
+    start = time.perf_counter()
+    for _ in range(iterations): op()
+    per_op = (time.perf_counter() - start) / iterations
+    observations = (observation_count(metrics) - before) / iterations
+
+    print(f"per observation   {per_observation * 1e9:.0f}ns")
+    print(f"per op            {per_op * 1e6:.1f}µs, {observations:.1f} observations")
+    print(f"overhead          {observations * per_observation * 1e6:.2f}µs ({observations * per_observation / per_op * 100:.2f}%)")
@@ -0,0 +1,427 @@
+"""
+本地 provider 桩服务 (压测 / 联调用，不产生任何真实调用费用)
+
+模拟以下协议的 提交 → 轮询状态流转 → 结果下载：
+    OpenAI 兼容 (SiliconFlow / RunningHub)  POST /v1/chat/completions (含 SSE 流式)、/v1/images/generations
+    Vidu                                    POST /ent/v2/start-end2video、/ent/v2/reference2image，GET /ent/v2/tasks/<id>/creations
+    即梦 (火山引擎)                          POST /?Action=CVSync2AsyncSubmitTask | CVSync2AsyncGetResult
+    MiniMax                                 POST /v1/image_generation、/v1/video_generation，GET /v1/query/video_generation、/v1/files/retrieve
+    DashScope (阿里云)                       /api/v1/services/aigc/...、GET /api/v1/tasks/<id>
+生成的图片/视频由 GET /files/<name> 提供 (合法 PNG / 可被 mediainfo 解析的 MP4，大小可配置)
+
+故障注入 (每个请求独立抽样，/files 与 /_stub 除外)：
+    --latency / --jitter   每个请求的固定延迟 ± 抖动 (秒)
+    --rate-limit           返回 429 的概率
+    --error-rate           返回 500 的概率
+    --fail-rate            异步任务最终失败的概率
+    --job-seconds          异步任务从提交到完成的耗时 (同步生成接口按此耗时阻塞)
+    --text-seconds         文本生成耗时
+运行时可通过 POST /_stub/config 修改上述参数，GET /_stub/stats 查看各接口调用计数
+
+用法:
+    python benchmarks/stub_provider.py --port 8765 --latency 0.05 --job-seconds 1 --rate-limit 0.05
+
+各 provider 的配置 (base_url 指向桩服务):
+    siliconflow / vidu / minimax   base_url = http://127.0.0.1:8765
+    siliconflow                    base_url = http://127.0.0.1:8765/v1
+    jimeng                         环境变量 JIMENG_ENDPOINT=http://127.0.0.1:8765
+    aliyun                         环境变量 DASHSCOPE_HTTP_BASE_URL=http://127.0.0.1:8765/api/v1
+"""
+import re
+import sys
+import json
+import time
+import uuid
+import zlib
+import random
+import struct
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+DEFAULT_CONFIG = {
+    'latency': 0.02,
+    'jitter': 0.0,
+    'rate_limit': 0.0,
+    'error_rate': 0.0,
+    'fail_rate': 0.0,
+    'job_seconds': 1.0,
+    'text_seconds': 0.3,
+    'image_bytes': 256 * 1024,
+    'video_bytes': 2 * 1024 * 1024,
+    'shots_per_scene': 3,
+}
+
+
+def make_png(size):
+    """64x64 纯色 PNG，用 tEXt 块填充到约 size 字节"""
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+    raw = b''.join(b'\x00' + b'\x2c\x3e\x50' * 64 for _ in range(64))
+    body = chunk(b'IHDR', struct.pack('>IIBBBBB', 64, 64, 8, 2, 0, 0, 0)) + chunk(b'IDAT', zlib.compress(raw))
+    padding = max(0, size - len(body) - 8 - 12 - 12 - 8)
+    if padding: body += chunk(b'tEXt', b'stub\x00' + b'x' * padding)
+    return b'\x89PNG\r\n\x1a\n' + body + chunk(b'IEND', b'')
+
+
+def _box(kind, payload=b''):
+    return struct.pack('>I', 8 + len(payload)) + kind + payload
+
+
+def _full_box(kind, payload=b'', flags=0):
+    return _box(kind, struct.pack('>I', flags) + payload)
+
+
+def make_mp4(size, seconds=5, width=1280, height=720, fps=25):
+    """
+    结构合法的 MP4 (ftyp + moov 单条 AVC 视频轨 + mdat 填充到约 size 字节)
+    mediainfo / 剪映草稿导出能识别出时长和分辨率，但帧数据为空，不可播放
+    """
+    timescale, frames = fps * 512, seconds * fps
+    matrix = struct.pack('>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+    ftyp = _box(b'ftyp', b'isom' + struct.pack('>I', 512) + b'isomiso2avc1mp41')
+    mvhd = _full_box(b'mvhd', struct.pack('>IIII', 0, 0, 1000, seconds * 1000) + struct.pack('>IH', 0x10000, 0x100)
+                     + b'\0' * 10 + matrix + b'\0' * 24 + struct.pack('>I', 2))
+    tkhd = _full_box(b'tkhd', struct.pack('>IIIII', 0, 0, 1, 0, seconds * 1000) + b'\0' * 16 + matrix
+                     + struct.pack('>II', width << 16, height << 16), flags=3)
+    mdhd = _full_box(b'mdhd', struct.pack('>IIIIHH', 0, 0, timescale, frames * 512, 0x55c4, 0))
+    hdlr = _full_box(b'hdlr', struct.pack('>I', 0) + b'vide' + b'\0' * 12 + b'VideoHandler\0')
+    sps, pps = bytes.fromhex('6764001facd9405005bb011000000300100000030320f18319a0'), bytes.fromhex('68ebe3cb22c0')
+    avcc = _box(b'avcC', bytes([1, 0x64, 0, 0x1f, 0xff, 0xe1]) + struct.pack('>H', len(sps)) + sps
+                + bytes([1]) + struct.pack('>H', len(pps)) + pps)
+    avc1 = _box(b'avc1', b'\0' * 6 + struct.pack('>H', 1) + b'\0' * 16 + struct.pack('>HHIIIH', width, height, 0x480000, 0x480000, 0, 1)
+                + b'\0' * 32 + struct.pack('>Hh', 0x18, -1) + avcc)
+    sample = max(1, (size - 2048) // frames)
+
+    def moov(mdat_offset):
+        stbl = _box(b'stbl', _full_box(b'stsd', struct.pack('>I', 1) + avc1)
+                    + _full_box(b'stts', struct.pack('>III', 1, frames, 512))
+                    + _full_box(b'stsc', struct.pack('>IIII', 1, 1, frames, 1))
+                    + _full_box(b'stsz', struct.pack('>II', sample, frames))
+                    + _full_box(b'stco', struct.pack('>II', 1, mdat_offset)))
+        dinf = _box(b'dinf', _full_box(b'dref', struct.pack('>I', 1) + _full_box(b'url ', flags=1)))
+        minf = _box(b'minf', _full_box(b'vmhd', b'\0' * 8, flags=1) + dinf + stbl)
+        return _box(b'moov', mvhd + _box(b'trak', tkhd + _box(b'mdia', mdhd + hdlr + minf)))
+
+    header = ftyp + moov(0)
+    header = ftyp + moov(len(header) + 8)
+    return header + _box(b'mdat', b'\0' * (sample * frames))
+
+
+class StubState:
+    def __init__(self, config, seed=None):
+        self.config = dict(config)
+        self.tasks = {}
+        self.stats = {}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self._files = {}
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] = self.stats.get(key, 0) + 1
+
+    def chance(self, p):
+        with self.lock:
+            return p > 0 and self.random.random() < p
+
+    def new_task(self, kind, **extra):
+        task_id = uuid.uuid4().hex
+        with self.lock:
+            self.tasks[task_id] = {'kind': kind, 'created': time.time(), 'fail': p_hit(self.random, self.config['fail_rate']), **extra}
+        return task_id
+
+    def task_phase(self, task_id):
+        """queued / running / done / failed / None (不存在)"""
+        task = self.tasks.get(task_id)
+        if not task: return None, None
+        elapsed = time.time() - task['created']
+        job = self.config['job_seconds']
+        if elapsed < job * 0.3: return 'queued', task
+        if elapsed < job: return 'running', task
+        return ('failed' if task['fail'] else 'done'), task
+
+    def file_bytes(self, ext):
+        size = self.config['video_bytes'] if ext == 'mp4' else self.config['image_bytes']
+        key = (ext, size)
+        if key not in self._files:
+            self._files[key] = make_mp4(size) if ext == 'mp4' else make_png(size)
+        return self._files[key]
+
+
+def p_hit(rng, p):
+    return p > 0 and rng.random() < p
+
+
+def stub_text(messages, shots_per_scene):
+    """按提示词内容返回看起来合理的文本：分镜拆解返回 JSON 数组，角色列表返回 JSON 对象，其余返回一段提示词"""
+    text = '\n'.join(m['content'] if isinstance(m.get('content'), str) else json.dumps(m.get('content'), ensure_ascii=False) for m in messages)
+    if '"characters"' in text:
+        return json.dumps({'characters': [{'name': '林夏', 'description': '短发，灰色风衣'}, {'name': '陈默', 'description': '戴眼镜，白衬衫'}]}, ensure_ascii=False)
+    if '分镜' in text and 'JSON' in text.upper():
+        scenes = list(dict.fromkeys(re.findall(r"第\s*(\d+)\s*场", messages[-1].get('content', '') if isinstance(messages[-1].get('content'), str) else ''))) or ['1']
+        shots = [{'scene': s, 'shot_number': str(k + 1), 'visual_description': f'第{s}场 镜{k + 1} 林夏推门而入', 'duration': 3,
+                  'shot_type': '中景', 'characters': ['林夏'], 'dialogue': ''} for s in scenes for k in range(shots_per_scene)]
+        return json.dumps(shots, ensure_ascii=False)
+    return '电影感，雨夜旧街道，霓虹灯反射在积水中，中景，35mm，低机位，冷暖对比，胶片颗粒质感'
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state = None  # StubState
+
+    def log_message(self, fmt, *args):
+        pass
+
+    # --- 基础工具 ---
+    @property
+    def base_url(self):
+        return f"http://{self.headers.get('Host') or '%s:%s' % self.server.server_address}"
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        try:
+            return json.loads(raw or b'{}')
+        except ValueError:
+            return {}
+
+    def _send(self, status, payload=None, raw=None, content_type='application/json', headers=None):
+        data = raw if raw is not None else json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in (headers or {}).items(): self.send_header(k, v)
+        self.end_headers()
+        if self.command != 'HEAD': self.wfile.write(data)
+
+    def _sse(self, events):
+        """events: 已格式化的 SSE 事件字符串迭代器 (chunked 传输)"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for event in events:
+            data = event.encode('utf-8')
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _file_url(self, task_id, ext):
+        return f"{self.base_url}/files/{task_id}.{ext}"
+
+    def _inject(self, route):
+        """延迟 + 429 / 500 注入，返回 True 表示已经响应了错误"""
+        cfg = self.state.config
+        delay = cfg['latency'] + (self.state.random.uniform(-cfg['jitter'], cfg['jitter']) if cfg['jitter'] else 0)
+        if delay > 0: time.sleep(delay)
+        self.state.count(route)
+        if self.state.chance(cfg['rate_limit']):
+            self.state.count('injected_429')
+            self._send(429, {'error': {'message': 'Too Many Requests (stub)'}, 'base_resp': {'status_code': 1002, 'status_msg': 'rate limit'}},
+                       headers={'Retry-After': '1'})
+            return True
+        if self.state.chance(cfg['error_rate']):
+            self.state.count('injected_500')
+            self._send(500, {'error': {'message': 'Internal Server Error (stub)'}, 'base_resp': {'status_code': 1000, 'status_msg': 'stub error'}})
+            return True
+        return False
+
+    # --- 分发 ---
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_HEAD(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def _dispatch(self, method):
+        url = urlparse(self.path)
+        path, query = url.path, parse_qs(url.query)
+        try:
+            if path.startswith('/files/'):
+                return self._send(200, raw=self.state.file_bytes(path.rsplit('.', 1)[-1]),
+                                  content_type='video/mp4' if path.endswith('.mp4') else 'image/png')
+            if path == '/_stub/stats':
+                return self._send(200, {'stats': self.state.stats, 'tasks': len(self.state.tasks), 'config': self.state.config})
+            if path == '/_stub/config' and method == 'POST':
+                self.state.config.update({k: v for k, v in self._body().items() if k in DEFAULT_CONFIG})
+                return self._send(200, self.state.config)
+
+            for pattern, route_method, handler in ROUTES:
+                match = re.fullmatch(pattern, path)
+                if match and route_method == method:
+                    body = self._body() if method == 'POST' else {}
+                    if self._inject(handler.__name__): return
+                    return handler(self, body, query, *match.groups())
+            self.state.count('not_found')
+            sys.stderr.write(f"[stub] unhandled {method} {self.path}\n")
+            self._send(404, {'error': {'message': f'No stub for {method} {path}'}})
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    # --- OpenAI 兼容 ---
+    def openai_chat(self, body, query):
+        time.sleep(self.state.config['text_seconds'])
+        content = stub_text(body.get('messages', []), self.state.config['shots_per_scene'])
+        usage = {'prompt_tokens': 100, 'completion_tokens': len(content), 'total_tokens': 100 + len(content)}
+        if not body.get('stream'):
+            return self._send(200, {'id': uuid.uuid4().hex, 'object': 'chat.completion', 'model': body.get('model'),
+                                    'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+                                    'usage': usage})
+        def events():
+            for i in range(0, len(content), 24):
+                chunk = {'choices': [{'index': 0, 'delta': {'content': content[i:i + 24]}}]}
+                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+            yield "data: [DONE]\n\n"
+        self._sse(events())
+
+    def openai_images(self, body, query):
+        time.sleep(self.state.config['job_seconds'])
+        self._send(200, {'created': int(time.time()), 'data': [{'url': self._file_url(uuid.uuid4().hex, 'png')}]})
+
+    # --- Vidu ---
+    def vidu_submit(self, body, query, kind):
+        task_id = self.state.new_task('video' if kind == 'start-end2video' else 'image')
+        self._send(201, {'task_id': task_id, 'state': 'created', 'model': body.get('model')})
+
+    def vidu_creations(self, body, query, task_id):
+        phase, task = self.state.task_phase(task_id)
+        if phase is None: return self._send(404, {'message': 'task not found'})
+        state = {'queued': 'queueing', 'running': 'processing', 'done': 'success', 'failed': 'failed'}[phase]
+        payload = {'id': task_id, 'state': state, 'err_code': 'AuditSubmitIllegal' if phase == 'failed' else '', 'creations': []}
+        if phase == 'done':
+            payload['creations'] = [{'id': task_id, 'url': self._file_url(task_id, 'mp4' if task['kind'] == 'video' else 'png')}]
+        self._send(200, payload)
+
+    # --- 即梦 (火山引擎 CVSync2Async) ---
+    def jimeng(self, body, query):
+        action = (query.get('Action') or [''])[0]
+        if action == 'CVSync2AsyncSubmitTask':
+            req_key = body.get('req_key', '')
+            task_id = self.state.new_task('video' if 'i2v' in req_key else 'image', req_key=req_key)
+            return self._send(200, {'code': 10000, 'message': 'Success', 'data': {'task_id': task_id}})
+        if action == 'CVSync2AsyncGetResult':
+            phase, task = self.state.task_phase(body.get('task_id'))
+            if phase is None: return self._send(200, {'code': 10000, 'message': 'Success', 'data': {'status': 'not_found'}})
+            if phase == 'failed': return self._send(200, {'code': 50413, 'message': 'Post Text Risk Not Pass', 'data': None})
+            data = {'status': {'queued': 'in_queue', 'running': 'generating', 'done': 'done'}[phase]}
+            if phase == 'done':
+                if task['kind'] == 'video': data['video_url'] = self._file_url(body['task_id'], 'mp4')
+                else: data['image_urls'] = [self._file_url(body['task_id'], 'png')]
+            return self._send(200, {'code': 10000, 'message': 'Success', 'data': data})
+        self._send(400, {'code': 50400, 'message': f'Unknown Action {action}'})
+
+    # --- MiniMax ---
+    def minimax_image(self, body, query):
+        time.sleep(self.state.config['job_seconds'])
+        self._send(200, {'id': uuid.uuid4().hex, 'data': {'image_urls': [self._file_url(uuid.uuid4().hex, 'png')]},
+                         'base_resp': {'status_code': 0, 'status_msg': 'success'}})
+
+    def minimax_video(self, body, query):
+        task_id = self.state.new_task('video')
+        self._send(200, {'task_id': task_id, 'base_resp': {'status_code': 0, 'status_msg': 'success'}})
+
+    def minimax_query(self, body, query):
+        task_id = (query.get('task_id') or [''])[0]
+        phase, task = self.state.task_phase(task_id)
+        if phase is None: return self._send(200, {'base_resp': {'status_code': 2013, 'status_msg': 'task not found'}})
+        status = {'queued': 'Queueing', 'running': 'Processing', 'done': 'Success', 'failed': 'Fail'}[phase]
+        payload = {'task_id': task_id, 'status': status, 'base_resp': {'status_code': 0, 'status_msg': 'success'}}
+        if phase == 'done': payload['file_id'] = task_id
+        if phase == 'failed': payload['error_message'] = 'stub task failed'
+        self._send(200, payload)
+
+    def minimax_retrieve(self, body, query):
+        file_id = (query.get('file_id') or [''])[0]
+        self._send(200, {'file': {'file_id': file_id, 'download_url': self._file_url(file_id, 'mp4')},
+                         'base_resp': {'status_code': 0, 'status_msg': 'success'}})
+
+    # --- DashScope ---
+    def dashscope_text(self, body, query):
+        time.sleep(self.state.config['text_seconds'])
+        content = stub_text((body.get('input') or {}).get('messages', []), self.state.config['shots_per_scene'])
+        usage = {'input_tokens': 100, 'output_tokens': len(content), 'total_tokens': 100 + len(content)}
+        def result(text):
+            return {'request_id': uuid.uuid4().hex, 'usage': usage,
+                    'output': {'choices': [{'finish_reason': 'null', 'message': {'role': 'assistant', 'content': text}}]}}
+        if self.headers.get('X-DashScope-SSE', '').lower() != 'enable' and 'text/event-stream' not in self.headers.get('Accept', ''):
+            return self._send(200, result(content))
+        def events():
+            for n, i in enumerate(range(0, len(content), 24)):
+                yield f"id:{n + 1}\nevent:result\n:HTTP_STATUS/200\ndata:{json.dumps(result(content[i:i + 24]), ensure_ascii=False)}\n\n"
+        self._sse(events())
+
+    def dashscope_multimodal(self, body, query):
+        messages = (body.get('input') or {}).get('messages', [])
+        has_image = any(isinstance(m.get('content'), list) and any('image' in c for c in m['content']) for m in messages)
+        if has_image:
+            time.sleep(self.state.config['text_seconds'])
+            content = [{'text': '整体为冷色调电影质感，低饱和，侧逆光，浅景深。'}]
+        else:
+            time.sleep(self.state.config['job_seconds'])
+            content = [{'image': self._file_url(uuid.uuid4().hex, 'png')}]
+        self._send(200, {'request_id': uuid.uuid4().hex, 'usage': {'image_count': 1},
+                         'output': {'choices': [{'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': content}}]}})
+
+    def dashscope_async(self, body, query, group, function):
+        task_id = self.state.new_task('video' if 'video' in group else 'image')
+        self._send(200, {'request_id': uuid.uuid4().hex, 'output': {'task_id': task_id, 'task_status': 'PENDING'}})
+
+    def dashscope_task(self, body, query, task_id):
+        phase, task = self.state.task_phase(task_id)
+        if phase is None: return self._send(404, {'code': 'NotFound', 'message': 'task not found', 'request_id': uuid.uuid4().hex})
+        output = {'task_id': task_id, 'task_status': {'queued': 'PENDING', 'running': 'RUNNING', 'done': 'SUCCEEDED', 'failed': 'FAILED'}[phase]}
+        if phase == 'failed':
+            output.update({'code': 'DataInspectionFailed', 'message': 'stub task failed'})
+        if phase == 'done':
+            if task['kind'] == 'video': output['video_url'] = self._file_url(task_id, 'mp4')
+            else: output['results'] = [{'url': self._file_url(task_id, 'png')}]
+        self._send(200, {'request_id': uuid.uuid4().hex, 'output': output, 'usage': {}})
+
+
+ROUTES = [
+    (r'/v1/chat/completions', 'POST', StubHandler.openai_chat),
+    (r'/v1/images/generations', 'POST', StubHandler.openai_images),
+    (r'/ent/v2/(start-end2video|reference2image)', 'POST', StubHandler.vidu_submit),
+    (r'/ent/v2/tasks/([^/]+)/creations', 'GET', StubHandler.vidu_creations),
+    (r'/', 'POST', StubHandler.jimeng),
+    (r'/v1/image_generation', 'POST', StubHandler.minimax_image),
+    (r'/v1/video_generation', 'POST', StubHandler.minimax_video),
+    (r'/v1/query/video_generation', 'GET', StubHandler.minimax_query),
+    (r'/v1/files/retrieve', 'GET', StubHandler.minimax_retrieve),
+    (r'/api/v1/services/aigc/text-generation/generation', 'POST', StubHandler.dashscope_text),
+    (r'/api/v1/services/aigc/multimodal-generation/generation', 'POST', StubHandler.dashscope_multimodal),
+    (r'/api/v1/services/aigc/([\w-]+)/([\w-]+)', 'POST', StubHandler.dashscope_async),
+    (r'/api/v1/tasks/([^/]+)', 'GET', StubHandler.dashscope_task),
+]
+
+
+def make_server(port=0, host='127.0.0.1', seed=None, **config):
+    """创建 (未启动的) 桩服务，port=0 时自动分配端口"""
+    state = StubState({**DEFAULT_CONFIG, **{k: v for k, v in config.items() if v is not None}}, seed=seed)
+    handler = type('BoundStubHandler', (StubHandler,), {'state': state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.state = state
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local provider stub server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--seed', type=int)
+    for key, value in DEFAULT_CONFIG.items():
+        parser.add_argument(f"--{key.replace('_', '-')}", type=type(value), default=value)
+    args = vars(parser.parse_args())
+    host, port, seed = args.pop('host'), args.pop('port'), args.pop('seed')
+    server = make_server(port, host, seed, **args)
+    print(f"stub provider listening on http://{host}:{server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
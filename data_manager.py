@@ -1,17 +1,167 @@
 import os
 import json
+import time
 import uuid
 import shutil
+import threading
+import unicodedata
+from types import MappingProxyType
 from dataclasses import dataclass, field, asdict
 from datetime import datetime
 from typing import List, Optional, Dict, Any
 from pathlib import Path
+from functools import wraps
+
+import metrics
+import tracing
 
 # --- 配置常量 ---
 DATA_DIR = "data/projects"
 SETTINGS_FILE = "data/settings.json"
 SERIES_FILE = "data/series.json"
 
+def synchronized(method):
+    """读改写 json 的方法加锁，防止并发任务互相覆盖"""
+    lock_wait = metrics.DATA_MANAGER_LOCK_WAIT_SECONDS.labels(method=method.__name__)
+    span_name = f"data.{method.__name__}"
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        started = time.perf_counter()
+        with self._write_lock:
+            waited = time.perf_counter() - started
+            lock_wait.observe(waited)
+            with tracing.span(span_name, lock_wait_ms=round(waited * 1000, 2)):
+                return method(self, *args, **kwargs)
+    return wrapper
+
+def normalize_name(name):
+    """
+    角色名归一化：全角/半角统一，去空白与间隔号，忽略大小写 (例如 "林 夏（少年）" 与 "林夏(少年)" 视为同一角色)
+    括号里的说明保留在键中："林夏（少年）" 与 "林夏（成年）" 是不同角色
+    """
+    if not name: return ""
+    text = unicodedata.normalize('NFKC', str(name))
+    return "".join(c for c in text if not c.isspace() and c not in '·•・.').casefold()
+
+class CharacterNameIndex:
+    """
+    角色名索引：归一化名称/别名 → 角色，每个请求构建一次，O(1) 查找
+    未知名字通过 add_pending 登记为待创建角色 (预分配 id)，最后用 create_characters 一次写入
+    """
+    def __init__(self, characters):
+        self._by_name = {}
+        self.pending = []
+        for char in characters:
+            self._register(char)
+
+    def _register(self, char):
+        names = [char.get('name')] + list(char.get('aliases') or [])
+        for n in names:
+            key = normalize_name(n)
+            if key: self._by_name.setdefault(key, char)
+
+    def resolve(self, name):
+        return self._by_name.get(normalize_name(name))
+
+    def resolve_or_add(self, name, description=""):
+        found = self.resolve(name)
+        if found: return found
+        new_char = {'id': str(uuid.uuid4()), 'name': str(name).strip(), 'description': description}
+        self.pending.append(new_char)
+        self._register(new_char)
+        return new_char
+
+def _freeze(value):
+    """递归转为只读结构 (dict → MappingProxyType, list → tuple)，可放心地在请求之间共享"""
+    if isinstance(value, dict): return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)): return tuple(_freeze(v) for v in value)
+    return value
+
+def _thaw(value):
+    """_freeze 的逆操作，得到调用方可以随意修改的 dict / list"""
+    if isinstance(value, MappingProxyType): return {k: _thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple): return [_thaw(v) for v in value]
+    return value
+
+MOCK_PROVIDER = _freeze({'type': 'mock'})
+
+class SettingsStore:
+    """
+    settings.json 的内存缓存 + 预建的 provider 索引 (按 id / 按 type / 按能力的路由顺序)
+    - 每次访问只 stat 一次文件，mtime/大小/inode 变化时 (其他 gunicorn worker 保存、手工编辑) 才重新解析并重建索引
+    - replace() 在本进程保存后直接换上新数据，不必等下一次 stat
+    - 对外的配置都是只读快照，需要改动时先 dict(config) 复制
+    """
+    def __init__(self, path=SETTINGS_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._build({'providers': []})
+
+    def _file_stamp(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _build(self, data):
+        frozen = _freeze(data if isinstance(data, dict) else {})
+        providers = frozen.get('providers', ())
+        by_id, by_type = {}, {}
+        for p in providers:
+            by_id.setdefault(p.get('id'), p)
+            if p.get('enabled', True) is not False:
+                by_type.setdefault(p.get('type'), []).append(p)
+        by_capability = {}
+        for capability, pids in frozen.get('routing', {}).items():
+            chain = []
+            for pid in dict.fromkeys(pids):
+                p = by_id.get(pid)
+                if p is not None and p.get('enabled', True) is not False: chain.append(p)
+            by_capability[capability] = tuple(chain)
+        # 整体替换一个元组，读方无需加锁
+        self._snapshot = (frozen, by_id, {k: tuple(v) for k, v in by_type.items()}, by_capability)
+
+    def _current(self):
+        stamp = self._file_stamp()
+        if stamp != self._stamp:
+            with self._lock:
+                if stamp != self._stamp:
+                    if stamp is None:
+                        self._build({'providers': []})
+                        self._stamp = None
+                    else:
+                        try:
+                            with open(self.path, 'r', encoding='utf-8') as f: data = json.load(f)
+                        except (OSError, ValueError):
+                            # 可能读到另一进程写了一半的文件：沿用旧数据，下次访问再试
+                            return self._snapshot
+                        self._build(data)
+                        self._stamp = stamp
+        return self._snapshot
+
+    def replace(self, data):
+        """本进程刚写完 settings.json 后调用"""
+        with self._lock:
+            self._build(data)
+            self._stamp = self._file_stamp()
+
+    @property
+    def data(self):
+        return self._current()[0]
+
+    def provider(self, provider_id):
+        return self._current()[1].get(provider_id)
+
+    def providers_by_type(self, provider_type):
+        """已启用的某类 provider，按设置中的顺序"""
+        return self._current()[2].get(provider_type, ())
+
+    def routing(self, capability):
+        """某能力的备选 provider 配置 (已剔除重复、已删除和已停用的)"""
+        return self._current()[3].get(capability, ())
+
 # --- 数据模型 (Data Models) ---
 @dataclass
 class Series:
@@ -98,6 +248,7 @@ class FusionTask:
     end_frame_image: str = ""
     end_frame_prompt: str = ""
     shot_id: str = ""
+    base_scene_image: str = ""   # 底图同步自的分镜场景图 (流水线据此判断底图是否需要跟随场景图更新)
     video_url: str = ""
     scene_description: str = ""  # 场景说明
     visual_description: str = "" # 画面描述
@@ -112,9 +263,13 @@ class FusionTask:
     def to_dict(self): return asdict(self)
 
 
+@metrics.instrument(metrics.DATA_MANAGER_SECONDS, include=('_read_json', '_write_json'))
 class DataManager:
     def __init__(self):
+        # 后台任务会并发地读改写同一个 json 文件，写操作统一串行化
+        self._write_lock = threading.RLock()
         self._ensure_root_dirs()
+        self.settings = SettingsStore()
 
     # --- 基础工具 ---
     def _ensure_root_dirs(self):
@@ -135,8 +290,15 @@ class DataManager:
             if isinstance(obj, datetime): return obj.isoformat()
             raise TypeError(f"Type {type(obj)} not serializable")
         
-        with open(filepath, 'w', encoding='utf-8') as f: 
-            json.dump(data, f, default=json_serial, indent=4, ensure_ascii=False)
+        # 先写临时文件再原子替换：其他 worker / 媒体 GC 不会读到写了一半的文档
+        tmp_path = f"{filepath}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, default=json_serial, indent=4, ensure_ascii=False)
+            os.replace(tmp_path, filepath)
+        except BaseException:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+            raise
 
     def _get_project_path(self, pid):
         return os.path.join(DATA_DIR, pid)
@@ -151,6 +313,7 @@ class DataManager:
         series_list = self.get_all_series()
         return next((s for s in series_list if s['id'] == series_id), None)
 
+    @synchronized
     def create_series(self, data):
         series_list = self._read_json(SERIES_FILE, default=[])
         data['id'] = str(uuid.uuid4())
@@ -159,6 +322,7 @@ class DataManager:
         self._write_json(SERIES_FILE, series_list)
         return new_series.to_dict()
 
+    @synchronized
     def update_series(self, series_id, data):
         series_list = self._read_json(SERIES_FILE, default=[])
         for i, s in enumerate(series_list):
@@ -169,6 +333,7 @@ class DataManager:
                 return merged
         return None
 
+    @synchronized
     def delete_series(self, series_id):
         series_list = self._read_json(SERIES_FILE, default=[])
         new_list = [s for s in series_list if s['id'] != series_id]
@@ -177,16 +342,36 @@ class DataManager:
 
     # --- Settings (设置) CRUD ---
     def get_settings(self):
-        return self._read_json(SETTINGS_FILE, default={'providers': []})
+        """完整设置的可修改副本 (读改写后交给 save_settings)；只读场景用 self.settings / get_provider_config"""
+        return _thaw(self.settings.data)
 
+    @synchronized
     def save_settings(self, settings_data):
         self._write_json(SETTINGS_FILE, settings_data)
-
-    def get_provider_config(self, provider_id):
-        settings = self.get_settings()
-        for p in settings.get('providers', []):
-            if p.get('id') == provider_id: return p
-        return {'type': 'mock'}
+        self.settings.replace(settings_data)
+
+    def get_provider_config(self, provider_id, model_name=None):
+        """
+        provider 配置的只读快照，未找到时返回 mock 配置
+        model_name 非空时返回覆盖了模型名的新快照，不影响缓存中的共享配置
+        """
+        config = self.settings.provider(provider_id) or MOCK_PROVIDER
+        if model_name: config = MappingProxyType(dict(config, model_name=model_name))
+        return config
+
+    def find_provider(self, provider_type):
+        """第一个已启用的指定类型 provider，没有时返回 None"""
+        return next(iter(self.settings.providers_by_type(provider_type)), None)
+
+    def get_provider_chain(self, capability, provider_id, model_name=None):
+        """
+        某一能力的有序 provider 配置列表：请求指定的 provider 在前，
+        其后是 settings['routing'][capability] 中配置的备选 provider (跳过重复与已删除的)
+        model_name 只作用于请求指定的 provider (模型名与 provider 绑定)
+        """
+        chain = [self.get_provider_config(provider_id, model_name)]
+        chain.extend(p for p in self.settings.routing(capability) if p.get('id') != provider_id)
+        return chain
 
     # --- Project (项目/分集) CRUD ---
     def get_all_projects(self):
@@ -210,6 +395,7 @@ class DataManager:
         path = os.path.join(self._get_project_path(project_id), 'info.json')
         return self._read_json(path)
 
+    @synchronized
     def create_project(self, data):
         project = MovieProject.from_dict(data)
         proj_dir = self._get_project_path(project.id)
@@ -223,6 +409,7 @@ class DataManager:
         
         return project.to_dict()
 
+    @synchronized
     def update_project(self, project_id, data):
         path = os.path.join(self._get_project_path(project_id), 'info.json')
         current = self._read_json(path)
@@ -238,10 +425,29 @@ class DataManager:
             return True
         return False
 
+    def iter_documents(self):
+        """
+        逐个返回所有项目 json 文档 (及剧集列表) 解析后的内容，供媒体 GC 提取引用；
+        列出后被删除的文件跳过，其余读取/解析失败直接抛出 (GC 据此放弃本轮，不能当作没有引用)
+        """
+        paths = [SERIES_FILE]
+        if os.path.exists(DATA_DIR):
+            for pid in os.listdir(DATA_DIR):
+                proj_dir = self._get_project_path(pid)
+                if os.path.isdir(proj_dir):
+                    paths.extend(os.path.join(proj_dir, f) for f in os.listdir(proj_dir) if f.endswith('.json'))
+        for path in paths:
+            try:
+                with open(path, 'r', encoding='utf-8') as f: document = json.load(f)
+            except FileNotFoundError:
+                continue
+            yield document
+
     # --- Script (剧本) CRUD ---
     def get_script(self, project_id):
         return self._read_json(os.path.join(self._get_project_path(project_id), 'script.json'), default=[])
 
+    @synchronized
     def save_script(self, project_id, script_data):
         self._write_json(os.path.join(self._get_project_path(project_id), 'script.json'), script_data)
 
@@ -262,6 +468,7 @@ class DataManager:
         except:
             return None
 
+    @synchronized
     def create_shot(self, project_id, data):
         shots = self.get_shots(project_id)
         new_shot = StoryboardShot.from_dict({**data, 'movie_id': project_id})
@@ -275,6 +482,56 @@ class DataManager:
         self._write_json(os.path.join(self._get_project_path(project_id), 'shot.json'), shots)
         return new_shot.to_dict()
 
+    @synchronized
+    def create_shots(self, project_id, items, insert_index=None):
+        """
+        批量创建分镜，只读写一次 shot.json
+        插入位置语义与逐条调用 create_shot 相同：按顺序处理，条目自带的 insert_index 优先；
+        传了整体 insert_index 时，其余条目从该位置开始连续插入
+        """
+        path = os.path.join(self._get_project_path(project_id), 'shot.json')
+        shots = self._read_json(path, default=[])
+        created = []
+        next_index = insert_index if isinstance(insert_index, int) else None
+        for data in items:
+            new_shot = StoryboardShot.from_dict({**data, 'movie_id': project_id}).to_dict()
+            index = data.get('insert_index')
+            if not isinstance(index, int):
+                index = next_index
+            if index is not None and 0 <= index <= len(shots):
+                shots.insert(index, new_shot)
+                if next_index is not None: next_index = index + 1
+            else:
+                shots.append(new_shot)
+            created.append(new_shot)
+        self._write_json(path, shots)
+        return created
+
+    @synchronized
+    def update_shots(self, project_id, updates):
+        """
+        批量更新分镜，只读写一次 shot.json
+        :param updates: [{'id': shot_id, ...字段}]
+        :return: (更新后的分镜列表, 未找到的 id 列表)
+        """
+        path = os.path.join(self._get_project_path(project_id), 'shot.json')
+        shots = self._read_json(path, default=[])
+        positions = {s['id']: i for i, s in enumerate(shots)}
+        now = datetime.now().isoformat()
+        updated, not_found = [], []
+        for data in updates:
+            shot_id = data.get('id')
+            i = positions.get(shot_id)
+            if i is None:
+                not_found.append(shot_id)
+                continue
+            shots[i] = StoryboardShot.from_dict({**shots[i], **data, 'id': shot_id, 'updated_time': now}).to_dict()
+            updated.append(shots[i])
+        if updated:
+            self._write_json(path, shots)
+        return updated, not_found
+
+    @synchronized
     def update_shot(self, project_id, shot_id, data):
         path = os.path.join(self._get_project_path(project_id), 'shot.json')
         shots = self._read_json(path, default=[])
@@ -291,6 +548,7 @@ class DataManager:
             self._write_json(path, shots)
         return updated_shot
 
+    @synchronized
     def delete_shot(self, project_id, shot_id):
         path = os.path.join(self._get_project_path(project_id), 'shot.json')
         shots = self._read_json(path, default=[])
@@ -298,12 +556,14 @@ class DataManager:
         self._write_json(path, new_shots)
         return True
 
+    @synchronized
     def batch_delete_shots(self, project_id, shot_ids):
         path = os.path.join(self._get_project_path(project_id), 'shot.json')
         shots = self._read_json(path, default=[])
         new_shots = [s for s in shots if s['id'] not in shot_ids]
         self._write_json(path, new_shots)
 
+    @synchronized
     def reorder_shots(self, project_id, ordered_ids):
         path = os.path.join(self._get_project_path(project_id), 'shot.json')
         shots = self._read_json(path, default=[])
@@ -318,6 +578,7 @@ class DataManager:
     def get_characters(self, project_id):
         return self._read_json(os.path.join(self._get_project_path(project_id), 'characters.json'), default=[])
 
+    @synchronized
     def create_character(self, project_id, data):
         path = os.path.join(self._get_project_path(project_id), 'characters.json')
         characters = self._read_json(path, default=[])
@@ -332,6 +593,25 @@ class DataManager:
         self._write_json(path, characters)
         return new_char
 
+    @synchronized
+    def create_characters(self, project_id, items):
+        """批量创建角色，只读写一次 characters.json；items 可自带 id (例如 CharacterNameIndex 预分配的)"""
+        if not items: return []
+        path = os.path.join(self._get_project_path(project_id), 'characters.json')
+        characters = self._read_json(path, default=[])
+        now = datetime.now().isoformat()
+        created = [{
+            'id': data.get('id') or str(uuid.uuid4()),
+            'name': data.get('name'),
+            'description': data.get('description'),
+            'image_url': data.get('image_url', ''),
+            'created_time': now
+        } for data in items]
+        characters.extend(created)
+        self._write_json(path, characters)
+        return created
+
+    @synchronized
     def update_character(self, project_id, character_id, data):
         path = os.path.join(self._get_project_path(project_id), 'characters.json')
         characters = self._read_json(path, default=[])
@@ -345,6 +625,7 @@ class DataManager:
             self._write_json(path, characters)
         return updated_char
 
+    @synchronized
     def delete_character(self, project_id, character_id):
         path = os.path.join(self._get_project_path(project_id), 'characters.json')
         characters = self._read_json(path, default=[])
@@ -355,6 +636,7 @@ class DataManager:
     def get_fusions(self, project_id):
         return self._read_json(os.path.join(self._get_project_path(project_id), 'fusions.json'), default=[])
 
+    @synchronized
     def create_fusion(self, project_id, data):
         path = os.path.join(self._get_project_path(project_id), 'fusions.json')
         fusions = self._read_json(path, default=[])
@@ -374,6 +656,7 @@ class DataManager:
         self._write_json(path, fusions)
         return new_fusion.to_dict()
 
+    @synchronized
     def update_fusion(self, project_id, fusion_id, data):
         path = os.path.join(self._get_project_path(project_id), 'fusions.json')
         fusions = self._read_json(path, default=[])
@@ -394,9 +677,21 @@ class DataManager:
         fusions = self.get_fusions(project_id)
         return next((f for f in fusions if f['id'] == fusion_id), None)
 
+    @synchronized
     def delete_fusion(self, project_id, fusion_id):
         path = os.path.join(self._get_project_path(project_id), 'fusions.json')
         fusions = self._read_json(path, default=[])
         new_fusions = [f for f in fusions if f['id'] != fusion_id]
         self._write_json(path, new_fusions)
-        return True
\ No newline at end of file
+        return True
+    # --- Pipeline (生产流水线) 状态 ---
+    def get_pipeline_state(self, project_id):
+        """各阶段上次成功执行时的输入指纹 { node_key: fingerprint }"""
+        return self._read_json(os.path.join(self._get_project_path(project_id), 'pipeline.json'), default={})
+
+    @synchronized
+    def set_stage_fingerprint(self, project_id, node_key, fingerprint):
+        path = os.path.join(self._get_project_path(project_id), 'pipeline.json')
+        state = self._read_json(path, default={})
+        state[node_key] = fingerprint
+        self._write_json(path, state)
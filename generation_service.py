@@ -0,0 +1,319 @@
+# generation_service.py
+import logging
+
+import ai_service
+from provider_router import router
+
+logger = logging.getLogger("GenerationService")
+
+
+def build_comprehensive_character_prompt(character_desc, color_system, emotional_keywords, basic_info):
+    """
+    [UPDATED] 基于 PDF Phase 1: Character Foundation 逻辑
+    重点：视频一致性 (Video Consistency)，简单轮廓，无琐碎细节
+    """
+    prompt = f"""
+    [Cinematographer AI Character Reference]
+    主体：{character_desc}
+
+    【CRITICAL: Design for Video Consistency / 视频生成一致性设计】
+    1. **简化设计 (SIMPLE)**: 保持角色轮廓清晰简洁。
+    2. **拒绝琐碎细节**: 避免任何细小的悬挂元素（如流苏、细链条、飘带、羊皮纸碎片），这些在视频生成中会变成噪点。
+    3. **标志性形状**: 强调可识别的形状（如独特的头盔轮廓、大胆的护甲设计）。
+    4. **电影级写实**: 追求超写实摄影质感 (Hyper-realistic photography)，而非概念艺术。
+
+    请生成一张包含以下内容的角色设计表 (Character Sheet)：
+    1. 左上角：角色正面特写 (Chest up)
+    2. 右上角：角色正面全身
+    3. 左下角：角色侧面全身
+    4. 右下角：角色背面全身
+
+    重要要求：纯白背景，无水印，人物外貌特征在所有视图中保持严格一致。
+    """
+    if color_system: prompt += f"\n色彩体系：{color_system} (保持电影感色调)"
+    if emotional_keywords: prompt += f"\n情感/能量状态：{emotional_keywords}"
+    if basic_info: prompt += f"\n背景设定：{basic_info}"
+    return prompt
+
+
+class GenerationService:
+    """
+    生成业务逻辑 (Service 层)
+    路由和后台队列共用同一套实现：入参为普通 dict，返回 (payload, http_status)，
+    不依赖 Flask 请求上下文，后台任务可以直接调用。
+    """
+    def __init__(self, db, media_manager):
+        self.db = db
+        self.media_mgr = media_manager
+
+    def _route(self, capability, data, call):
+        """按能力取 provider 链 (请求指定的 provider + 备选)，出错/超时自动切换，call(config) 返回结果字典"""
+        configs = self.db.get_provider_chain(capability, data.get('provider_id'), data.get('model_name'))
+        return router.call(capability, configs, call)
+
+    # --- 文本 (提示词) ---
+    def generate_scene_prompt(self, data):
+        project_id = data.get('project_id')
+        project_info = self.db.get_project(project_id) if project_id else {}
+
+        sys = "你是一个专业的电影场景设计师。请根据场景描述生成详细的场景提示词。"
+        user_prompt = f"场景描述：{data.get('scene_description')}\n请生成包含时间、天气、光影、空间、风格的详细提示词。"
+
+        if project_info:
+            user_prompt += f"\n色彩：{project_info.get('visual_color_system','')}\n基调：{project_info.get('script_emotional_keywords','')}"
+
+        result = self._route('text', data, lambda config: ai_service.run_text_generation(
+            [{'role': 'system', 'content': sys}, {'role': 'user', 'content': user_prompt}], config,
+            cache='scene_prompt', force_refresh=data.get('force_refresh')))
+        return ({'success': True, 'prompt': result['content']}, 200) if result.get('success') else ({'success': False}, 500)
+
+    def generate_fusion_prompt(self, data):
+        """
+        [UPDATED] 基于 PDF Phase 3 Logic: Image-to-Video Motion Prompts Prep
+        目标：生成 Explicit Shot Description, 并包含 Environmental Motion (如 fog, wind) 以为视频做准备
+        """
+        project_info = self.db.get_project(data.get('project_id')) if data.get('project_id') else {}
+
+        # === [Phase 3: Motion Prep & Explicit Description] ===
+        sys = """
+        你是一位专家级电影摄影师 (Cinematographer AI)。请生成用于 AI 图像生成的英文提示词。
+
+        【Output Format - Strict】
+        [Subject Description] + [Shot Setup] + [Environment/Lighting] + [Style Keywords]
+
+        【Principles】
+        1. **Shot Description Clarity**: 极其明确地描述谁在画面中、在哪个位置、面朝哪里。不要留给 AI 猜测的空间。
+        2. **Realism**: 追求《你的名字》的动漫二次元感，避免由于描述模糊导致的概念图质感。
+        3. **Motion Prep (重要)**: 既然这是为视频生成的静帧，请在环境描述中包含动态元素 (如 drifting fog, swaying branches, dust particles)，这能让后续的图生视频更生动。
+
+        请直接输出中文提示词，不要包含 Markdown 或其他解释性文字。
+        """
+
+        base_info = f"【元素结合】：{data.get('element_mapping')} 【场景环境】：{data.get('scene_description')} 【镜头动作】：{data.get('shot_description')}"
+        if project_info: user_prompt_base = f"{base_info}\n【整体色彩体系】：{project_info.get('visual_color_system','')}"
+        else: user_prompt_base = base_info
+
+        # 首帧与尾帧 (为视频一致性做准备) 互不依赖，并行生成
+        user_prompt_start = f"{user_prompt_base}\n\n任务：生成该镜头 **开始时刻 (Start Frame)** 的画面提示词。"
+        user_prompt_end = f"{user_prompt_base}\n\n任务：生成该镜头 **结束时刻 (End Frame)** 的画面提示词。如果镜头有推拉摇移，请描述视角的改变；如果角色有动作，请描述动作完成后的状态。"
+
+        def text_call(user_prompt):
+            return lambda: self._route('text', data, lambda config: ai_service.run_text_generation(
+                [{'role': 'system', 'content': sys}, {'role': 'user', 'content': user_prompt}], config,
+                cache='fusion_prompt', force_refresh=data.get('force_refresh')))
+
+        results = ai_service.run_parallel({'start': text_call(user_prompt_start), 'end': text_call(user_prompt_end)})
+        res_start, res_end = results['start'], results['end']
+
+        # 首帧是必需的，尾帧失败时降级为空
+        if res_start.get('success'):
+            return {'success': True, 'prompt': res_start['content'], 'end_frame_prompt': res_end.get('content', '') if res_end.get('success') else ''}, 200
+        return {'success': False, 'error_msg': res_start.get('error_msg')}, 500
+
+    def generate_grid_prompt(self, data):
+        """
+        生成用于 9宫格 角色动作分镜的 Prompt
+        """
+        # 构造 Prompt
+        # 核心是将 scene_description, visual_description, characters 结合
+        # 要求生成一个 3x3 grid 的描述
+
+        scene_desc = data.get('scene_description', '')
+        shot_desc = data.get('shot_description', '')
+        char_names = data.get('character_names', []) # list of names
+
+        sys_prompt = """
+        你是一位资深分镜师。请根据输入生成一段用于 AI 绘画的英文 Prompt。
+
+        【目标】生成一张 **3x3 分镜九宫格 (9-panel storyboard grid)**，展示角色在特定场景中的连续动作或不同景别。
+
+        【格式要求】
+        必须用中文回答.
+        结果: "一种 3×3 的分镜网格布局。【场景与灯光】。【角色】的连续性动作：【动作描述】。呈现【细节】的关键帧画面"
+
+        请确保 Prompt 强调 "9 格画面", "形象连贯的角色", "顺序叙事逻辑".
+        """
+
+        user_prompt = f"""
+        场景：{scene_desc}
+        动作：{shot_desc}
+        角色：{', '.join(char_names)}
+        """
+
+        result = self._route('text', data, lambda config: ai_service.run_text_generation(
+            [{'role': 'system', 'content': sys_prompt}, {'role': 'user', 'content': user_prompt}],
+            config, cache='grid_prompt', force_refresh=data.get('force_refresh')
+        ))
+
+        return ({'success': True, 'prompt': result['content']}, 200) if result.get('success') else ({'success': False}, 500)
+
+    def generate_video_prompt(self, data):
+        scene_desc = data.get('scene_description', '')
+        shot_desc = data.get('shot_description', '')
+
+        # todo 提示词还需要修改适配9宫格
+        sys_prompt = """
+        你是一位专业的视频生成提示词专家。请根据场景和画面描述，生成一段用于 AI 视频生成的中文 Prompt。
+
+        【要求】
+        1. 必须是中文。
+        2. 重点描述 **动态 (Motion)**：包括运镜 (Camera Movement)、角色动作 (Subject Action)、环境动态 (Environmental Motion like wind, rain, light changes)。
+        3. 格式建议: "[Subject & Action]. [Environment & Atmosphere]. [Camera Movement]. [Style]"
+        """
+
+        user_prompt = f"""
+        场景描述：{scene_desc}
+        分镜画面：{shot_desc}
+        """
+
+        result = self._route('text', data, lambda config: ai_service.run_text_generation(
+            [{'role': 'system', 'content': sys_prompt}, {'role': 'user', 'content': user_prompt}],
+            config, cache='video_prompt', force_refresh=data.get('force_refresh')
+        ))
+
+        return ({'success': True, 'prompt': result['content']}, 200) if result.get('success') else ({'success': False}, 500)
+
+    # --- 图片 ---
+    def generate_character_views(self, data):
+        project_id = data.get('project_id')
+        character_id = data.get('character_id')
+
+        project_info = self.db.get_project(project_id) if project_id else {}
+
+        prompt = build_comprehensive_character_prompt(
+            data.get('character_description'),
+            project_info.get('visual_color_system', ''),
+            project_info.get('script_emotional_keywords', ''),
+            project_info.get('basic_info', '')
+        )
+
+        result = self._route('image', data, lambda config: ai_service.run_simple_image_generation(prompt, config, self.media_mgr, entity_id=character_id))
+        return ({'success': True, 'url': result['url']}, 200) if result.get('success') else ({'success': False, 'error': '生成失败'}, 500)
+
+    def generate_scene_image(self, data):
+        scene_id = data.get('scene_id')
+        prompt = f"电影场景设计图，{data.get('scene_prompt')}。高分辨率，电影质感。"
+        result = self._route('image', data, lambda config: ai_service.run_simple_image_generation(prompt, config, self.media_mgr, entity_id=scene_id))
+        return ({'success': True, 'url': result['url']}, 200) if result.get('success') else ({'success': False}, 500)
+
+    def generate_fusion_image(self, data):
+        fusion_id = data.get('fusion_id')
+        project_id = data.get('project_id')
+
+        current_fusion = self.db.get_fusion(project_id, fusion_id)
+        if not current_fusion: return {'success': False, 'error': 'Fusion not found'}, 404
+
+        base_image_url = current_fusion.get('base_image')
+        if not base_image_url: return {'success': False, 'error': 'No base image'}, 400
+
+        base_image_path = self.media_mgr.get_absolute_path(base_image_url)
+
+        element_paths = []
+        for el in current_fusion.get('elements', []):
+            if el.get('image_url'):
+                element_paths.append(self.media_mgr.get_absolute_path(el['image_url']))
+
+        result = self._route('fusion', data, lambda config: ai_service.run_fusion_generation(
+            base_image_path=base_image_path,
+            fusion_prompt=data.get('fusion_prompt'),
+            config=config,
+            media_manager=self.media_mgr,
+            element_image_paths=element_paths,
+            entity_id=fusion_id
+        ))
+
+        return ({'success': True, 'url': result['url']}, 200) if result.get('success') else ({'success': False, 'error': result.get('error_msg')}, 500)
+
+    def generate_grid_image(self, data):
+        """
+        生成 9宫格 图片
+        使用 run_fusion_generation (Image-to-Image) 或 run_simple_image_generation (Text-to-Image)
+        这里假设使用 Image-to-Image，将 Scene Image 作为 Base，或者 Text-to-Image 仅用 Prompt
+        根据用户需求 "将底图和人物列表作为融图的素材"，最好是 Image-to-Image (ControlNet or Ref)
+        但为了简化，我们复用 run_fusion_generation 的逻辑，将 Scene Image 设为 Base Image
+        """
+        shot_id = data.get('shot_id')
+        # 这里的 grid_prompt 应该是上面生成的 "A 3x3 storyboard grid..."
+        prompt = data.get('grid_prompt')
+
+        # 获取底图路径
+        base_image_url = data.get('base_image_url')
+        base_image_path = self.media_mgr.get_absolute_path(base_image_url) if base_image_url else None
+
+        # 获取角色图路径列表
+        # character_images: list of urls
+        element_paths = []
+        for url in data.get('character_images', []):
+            if url:
+                element_paths.append(self.media_mgr.get_absolute_path(url))
+
+        # 调用 AI Service
+        # 如果有 base_image, 倾向于使用 fusion 生成 (img2img / controlnet)
+        # 否则使用 simple generation (txt2img)
+        if base_image_path:
+            result = self._route('fusion', data, lambda config: ai_service.run_fusion_generation(
+                base_image_path=base_image_path,
+                fusion_prompt=prompt,
+                config=config,
+                media_manager=self.media_mgr,
+                element_image_paths=element_paths,
+                entity_id=shot_id
+            ))
+        else:
+            # Fallback to text-to-image if no scene image
+            result = self._route('image', data, lambda config: ai_service.run_simple_image_generation(
+                prompt, config, self.media_mgr, entity_id=shot_id
+            ))
+
+        return ({'success': True, 'url': result['url']}, 200) if result.get('success') else ({'success': False, 'error': result.get('error_msg')}, 500)
+
+    # --- 视频 ---
+    def generate_fusion_video(self, data):
+        """
+        [UPDATED] PDF Phase 3: Motion Generation
+        注意：虽然这里调用的是视频生成模型，但输入的 Prompt (来自 fusion_prompt) 必须包含 PDF 中提到的 Motion Keywords。
+        """
+        fusion_id = data.get('fusion_id')
+        project_id = data.get('project_id')
+
+        current_fusion = self.db.get_fusion(project_id, fusion_id)
+        if not current_fusion: return {'success': False, 'error': 'Not found'}, 404
+
+        s_url = current_fusion.get('result_image')
+        e_url = current_fusion.get('end_frame_image')
+        if not s_url: return {'success': False, 'error': 'No start image'}, 400
+
+        s_path = self.media_mgr.get_absolute_path(s_url)
+        e_path = self.media_mgr.get_absolute_path(e_url) if e_url else None
+
+        # 获取提示词，如果没有则给默认值。
+        # 理想情况下，这里的 fusion_prompt 已经由上面的 generate_fusion_prompt 生成并包含 Motion keywords
+        prompt_text = current_fusion.get('fusion_prompt') or "high quality cinematic video, slow motion"
+
+        result = self._route('video', data, lambda config: ai_service.run_video_generation(
+            prompt_text,
+            s_path, e_path, config,
+            self.media_mgr,
+            entity_id=fusion_id
+        ))
+
+        if result.get('success'):
+            self.db.update_fusion(project_id, fusion_id, {'video_url': result['url']})
+            return {'success': True, 'url': result['url']}, 200
+        return {'success': False}, 500
+
+    def generate_shot_video(self, data):
+        """分镜视频：以九宫格图 (或场景图) 为首帧生成视频"""
+        shot = self.db.get_shot(data.get('project_id'), data.get('shot_id'))
+        if not shot: return {'success': False, 'error': 'Shot not found'}, 404
+
+        s_url = shot.get('grid_image') or shot.get('scene_image')
+        if not s_url: return {'success': False, 'error': 'No reference image'}, 400
+
+        s_path = self.media_mgr.get_absolute_path(s_url)
+        prompt_text = shot.get('video_prompt') or "high quality cinematic video"
+
+        result = self._route('video', data, lambda config: ai_service.run_video_generation(
+            prompt_text, s_path, None, config, self.media_mgr, entity_id=shot['id']
+        ))
+        return ({'success': True, 'url': result['url']}, 200) if result.get('success') else ({'success': False, 'error': result.get('error_msg')}, 500)
@@ -1,8 +1,12 @@
 import os
 import json
+import time
 import shutil
 import uuid
+import hashlib
 import logging
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import unquote, urlparse # 新增：用于处理URL解码
 
 # 配置日志
@@ -17,6 +21,16 @@ try:
 except ImportError:
     logger.warning("pyJianYingDraft library not found. Export features will be disabled.")
 
+# 素材并行拷贝的线程数
+STAGE_WORKERS = int(os.getenv('EXPORT_STAGE_WORKERS', 8))
+
+# 已压缩格式直接存储 (ZIP_STORED)，再 deflate 只会白白消耗 CPU
+STORED_EXTENSIONS = {'.mp4', '.mov', '.m4v', '.webm', '.mp3', '.m4a', '.aac', '.png', '.jpg', '.jpeg', '.webp', '.gif', '.zip'}
+ZIP_CHUNK_SIZE = 1024 * 1024
+
+# 草稿目录中的素材清单 (增量导出用)，不会打进压缩包
+MANIFEST_NAME = "export_manifest.json"
+
 def parse_duration(duration_str):
     """解析时长字符串"""
     if not duration_str: return 3.0
@@ -48,6 +62,10 @@ def resolve_local_path(static_folder, url_path):
     # 3. 去除开头的斜杠，防止 os.path.join 把它当做绝对路径处理
     # Windows下也要去除反斜杠
     path = path.lstrip('/\\')
+
+    # 媒体 URL 形如 /static/videos/xxx.mp4，而 static_folder 本身就是 static 目录
+    if path.startswith('static/') or path.startswith('static\\'):
+        path = path[len('static/'):]
     
     # 4. 拼接绝对路径
     full_path = os.path.join(static_folder, path)
@@ -55,41 +73,280 @@ def resolve_local_path(static_folder, url_path):
     
     return abs_path
 
+def staged_filename(source_full_path, prefix=""):
+    """素材在草稿 media 目录中的文件名"""
+    filename = os.path.basename(source_full_path)
+    clean_filename = "".join([c for c in filename if c.isalnum() or c in '._-'])
+    return f"{prefix}_{clean_filename}" if prefix else clean_filename
+
 def copy_asset(source_full_path, dest_folder, prefix=""):
     """
-    复制资源文件
+    暂存资源文件到草稿目录
+    同一文件系统下优先使用硬链接 (零拷贝)，跨设备或不支持时回退为复制
     """
     if not source_full_path:
         return None
-        
-    # --- 调试打印 ---
-    # 如果控制台打印了 "❌ 未找到文件"，说明路径拼错了
+
     if not os.path.exists(source_full_path):
-        print(f"❌ [文件缺失] 试图寻找: {source_full_path}") 
+        logger.warning(f"[文件缺失] 试图寻找: {source_full_path}")
         return None
-    
+
     if not os.path.exists(dest_folder):
         os.makedirs(dest_folder, exist_ok=True)
-        
-    filename = os.path.basename(source_full_path)
-    clean_filename = "".join([c for c in filename if c.isalnum() or c in '._-'])
-    
-    if prefix:
-        new_filename = f"{prefix}_{clean_filename}"
-    else:
-        new_filename = clean_filename
-        
+
+    new_filename = staged_filename(source_full_path, prefix)
     dest_path = os.path.join(dest_folder, new_filename)
-    
+
     try:
-        shutil.copy2(source_full_path, dest_path)
-        print(f"✅ [复制成功] {new_filename}") # 打印成功信息
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+        try:
+            os.link(source_full_path, dest_path)
+        except OSError:
+            # EXDEV (跨设备) / 文件系统不支持硬链接
+            shutil.copy2(source_full_path, dest_path)
+        logger.debug(f"[暂存成功] {new_filename}")
         return dest_path
     except Exception as e:
-        print(f"❌ [复制出错] {e}")
+        logger.error(f"[暂存出错] {source_full_path}: {e}")
         return None
 
-def export_draft(project_info, tasks, static_folder, export_dir): 
+def stage_assets(jobs, dest_folder, on_staged=None):
+    """
+    并行暂存素材
+    :param jobs: [(source_full_path, prefix), ...]
+    :param on_staged: 每个素材完成后回调 on_staged(source_full_path)
+    :return: 与 jobs 一一对应的暂存路径列表 (失败为 None)
+    """
+    if not jobs: return []
+    results = [None] * len(jobs)
+    with ThreadPoolExecutor(max_workers=min(STAGE_WORKERS, len(jobs))) as pool:
+        futures = {pool.submit(copy_asset, source, dest_folder, prefix): i for i, (source, prefix) in enumerate(jobs)}
+        for future in as_completed(futures):
+            i = futures[future]
+            results[i] = future.result()
+            if on_staged: on_staged(jobs[i][0])
+    return results
+
+def _source_signature(source_full_path):
+    st = os.stat(source_full_path)
+    return {"source": os.path.abspath(source_full_path), "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+def load_manifest(draft_path):
+    try:
+        with open(os.path.join(draft_path, MANIFEST_NAME), 'r', encoding='utf-8') as f:
+            return json.load(f).get('assets', {})
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def save_manifest(draft_path, assets):
+    path = os.path.join(draft_path, MANIFEST_NAME)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({"version": 1, "assets": assets}, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+def sync_assets(jobs, draft_path, dest_folder, progress_callback=None):
+    """
+    增量暂存素材
+    对照上次导出的清单 (源路径 + 大小 + mtime → 暂存文件名)：
+    - 未变化的素材直接复用
+    - 只是序号变了 (插入/删除分镜) 的素材在 media 目录内重新链接，不再复制
+    - 新增/修改的素材并行暂存
+    - 不再被引用的旧素材删除
+    :param progress_callback: progress_callback(stage, done, total)，按字节统计暂存进度
+    :return: 与 jobs 一一对应的暂存路径列表 (失败为 None)
+    """
+    os.makedirs(dest_folder, exist_ok=True)
+    old_assets = load_manifest(draft_path)
+
+    # 按源签名反查已有的暂存文件
+    reusable = {}
+    for name, sig in old_assets.items():
+        if os.path.exists(os.path.join(dest_folder, name)):
+            reusable.setdefault((sig.get('source'), sig.get('size'), sig.get('mtime_ns')), name)
+
+    results = [None] * len(jobs)
+    new_assets = {}
+    relinks = []
+    to_copy = []
+    reused = 0
+    for i, (source, prefix) in enumerate(jobs):
+        name = staged_filename(source, prefix)
+        dest_path = os.path.join(dest_folder, name)
+        try:
+            sig = _source_signature(source)
+        except OSError:
+            logger.warning(f"[文件缺失] 试图寻找: {source}")
+            continue
+        key = (sig['source'], sig['size'], sig['mtime_ns'])
+
+        if old_assets.get(name) == sig and os.path.exists(dest_path):
+            results[i] = dest_path
+            reused += 1
+        elif key in reusable:
+            relinks.append((i, os.path.join(dest_folder, reusable[key]), dest_path))
+        else:
+            to_copy.append(i)
+        new_assets[name] = sig
+
+    # 先链接到临时名再统一替换，避免覆盖还没被复用的旧文件
+    pending = []
+    for i, old_path, dest_path in relinks:
+        tmp_path = dest_path + ".relink"
+        try:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+            try:
+                os.link(old_path, tmp_path)
+            except OSError:
+                shutil.copy2(old_path, tmp_path)
+            pending.append((i, tmp_path, dest_path))
+        except Exception as e:
+            logger.warning(f"[复用失败] {old_path}: {e}")
+            to_copy.append(i)
+    for i, tmp_path, dest_path in pending:
+        os.replace(tmp_path, dest_path)
+        results[i] = dest_path
+
+    copy_jobs = [jobs[i] for i in to_copy]
+    total_bytes = sum(os.path.getsize(source) for source, _ in copy_jobs)
+    done_bytes = 0
+    def on_staged(source):
+        nonlocal done_bytes
+        done_bytes += os.path.getsize(source)
+        if progress_callback: progress_callback('staging', done_bytes, total_bytes)
+
+    if progress_callback: progress_callback('staging', 0, total_bytes)
+    copied = stage_assets(copy_jobs, dest_folder, on_staged=on_staged)
+    for i, path in zip(to_copy, copied):
+        results[i] = path
+        if not path:
+            new_assets.pop(staged_filename(*jobs[i]), None)
+
+    # 清理孤儿素材
+    removed = 0
+    for name in os.listdir(dest_folder):
+        if name not in new_assets:
+            try:
+                os.remove(os.path.join(dest_folder, name))
+                removed += 1
+            except OSError as e:
+                logger.warning(f"[清理失败] {name}: {e}")
+
+    save_manifest(draft_path, new_assets)
+    logger.info(f"素材同步完成: 复用 {reused}，重链接 {len(pending)}，暂存 {len(to_copy)}，清理 {removed}")
+    return results
+
+def open_draft(export_dir, draft_dir, width=1920, height=1080):
+    """
+    打开草稿进行重写
+    已导出过的草稿只重写 draft_content.json，保留 media 目录与清单；
+    否则走 create_draft 新建 (它会整目录删除重建)
+    """
+    draft_path = os.path.join(export_dir, draft_dir)
+    if os.path.exists(os.path.join(draft_path, "draft_meta_info.json")):
+        script = draft.ScriptFile(width, height)
+        script.save_path = os.path.join(draft_path, "draft_content.json")
+        return script
+    return draft.DraftFolder(export_dir).create_draft(draft_dir, width, height, allow_replace=True)
+
+def write_draft_zip(export_dir, draft_dir, zip_path, progress_callback=None, archive_name=None):
+    """
+    将草稿打包写入 zip_path (先写临时文件再原子替换)，压缩包缓存在磁盘上，项目未变化时直接复用
+    已压缩的媒体文件使用 STORED 模式，json 等文本使用 DEFLATED
+    :param archive_name: 压缩包内的草稿文件夹名 (剪映中显示的草稿名)，默认同 draft_dir
+    :param progress_callback: progress_callback('zipping', done, total)，按字节统计
+    """
+    draft_root = os.path.join(export_dir, draft_dir)
+    entries = []
+    for root, dirs, files in os.walk(draft_root):
+        dirs.sort()
+        for name in sorted(files):
+            if name == MANIFEST_NAME: continue
+            full_path = os.path.join(root, name)
+            entries.append((full_path, os.path.getsize(full_path)))
+    total_bytes = sum(size for _, size in entries)
+    done_bytes = 0
+    tmp_path = zip_path + ".tmp"
+    with zipfile.ZipFile(tmp_path, 'w') as zf:
+        for full_path, size in entries:
+            arcname = '/'.join([archive_name or draft_dir, os.path.relpath(full_path, draft_root).replace(os.sep, '/')])
+            zinfo = zipfile.ZipInfo.from_file(full_path, arcname)
+            ext = os.path.splitext(full_path)[1].lower()
+            zinfo.compress_type = zipfile.ZIP_STORED if ext in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+
+            with open(full_path, 'rb') as src, zf.open(zinfo, 'w', force_zip64=size > zipfile.ZIP64_LIMIT) as dst:
+                for chunk in iter(lambda: src.read(ZIP_CHUNK_SIZE), b''):
+                    dst.write(chunk)
+                    done_bytes += len(chunk)
+                    if progress_callback: progress_callback('zipping', done_bytes, total_bytes)
+                    # eventlet 环境下让出 hub，避免大文件打包期间阻塞其他请求
+                    time.sleep(0)
+    os.replace(tmp_path, zip_path)
+    return zip_path
+
+def export_fingerprint(project_info, tasks, static_folder):
+    """
+    项目导出指纹：项目信息 + 融图数据 + 引用素材的大小/mtime
+    指纹不变说明上次的压缩包仍然可用
+    """
+    media = []
+    for item in tasks:
+        path = resolve_local_path(static_folder, item.get('video_url')) if item.get('video_url') else None
+        try:
+            st = os.stat(path) if path else None
+            media.append([path, st.st_size, st.st_mtime_ns] if st else None)
+        except OSError:
+            media.append(None)
+    raw = json.dumps([project_info, tasks, media], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+def load_archive_meta(zip_path):
+    """读取压缩包旁的元信息 ({fingerprint, created_at, size})，压缩包不存在时返回 None"""
+    if not os.path.exists(zip_path): return None
+    try:
+        with open(zip_path + ".json", 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def export_archive(project_info, tasks, static_folder, export_dir, zip_path, progress_callback=None, probe_many=None):
+    """
+    生成草稿压缩包 (供后台任务调用)
+    项目未变化时直接复用上次的压缩包
+    :param progress_callback: progress_callback(percent, stage=..., done=..., total=...)
+    """
+    def report(percent, stage, done=0, total=0):
+        if progress_callback: progress_callback(percent, stage=stage, done=done, total=total)
+
+    fp = export_fingerprint(project_info, tasks, static_folder)
+    meta = load_archive_meta(zip_path)
+    if meta and meta.get('fingerprint') == fp:
+        logger.info(f"项目未变化，复用压缩包: {zip_path}")
+        return {"success": True, "reused": True, "zip_path": zip_path, **meta}
+
+    # 各阶段在总进度中的占比: 暂存 0-60，生成草稿 60-65，打包 65-99
+    def on_progress(stage, done, total):
+        ratio = done / total if total else 1.0
+        if stage == 'staging':
+            report(60 * ratio, stage, done, total)
+        elif stage == 'zipping':
+            report(65 + 34 * ratio, stage, done, total)
+
+    report(0, 'staging')
+    result = export_draft(project_info, tasks, static_folder, export_dir, progress_callback=on_progress, probe_many=probe_many)
+    if not result['success']: return result
+
+    report(65, 'zipping')
+    write_draft_zip(export_dir, result['draft_dir'], zip_path, progress_callback=on_progress, archive_name=result['draft_name'])
+
+    meta = {"fingerprint": fp, "created_at": time.strftime('%Y-%m-%d %H:%M:%S'),
+            "size": os.path.getsize(zip_path), "zip_name": result['zip_name']}
+    with open(zip_path + ".json", 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    return {"success": True, "reused": False, "zip_path": zip_path, **meta}
+
+def export_draft(project_info, tasks, static_folder, export_dir, progress_callback=None, probe_many=None): 
     # 注意：这里第二个参数名我改成了 tasks，代表传入的是 fusion 列表
     """
     生成剪映草稿工程 (适配 Fusion 数据源)
@@ -100,15 +357,16 @@ def export_draft(project_info, tasks, static_folder, export_dir):
     film_name = project_info.get('film_name', 'Untitled_Project')
     film_name = "".join([c for c in film_name if c.isalnum() or c in ' _-']).strip()
     if not film_name: film_name = "Project_Export"
+    # 草稿目录按项目 id 区分 (同名项目不会互相覆盖)，压缩包内仍以片名作为草稿文件夹名
+    draft_dir = "".join(c for c in str(project_info.get('id') or '') if c.isalnum() or c in '_-') or film_name
     
     if not os.path.exists(export_dir):
         os.makedirs(export_dir, exist_ok=True)
 
     try:
         # 1. 准备目录
-        draft_folder = draft.DraftFolder(export_dir)
-        script = draft_folder.create_draft(film_name, 1920, 1080, allow_replace=True)
-        draft_sys_path = os.path.join(export_dir, film_name)
+        script = open_draft(export_dir, draft_dir)
+        draft_sys_path = os.path.join(export_dir, draft_dir)
         assets_target_dir = os.path.join(draft_sys_path, "media")
         os.makedirs(assets_target_dir, exist_ok=True)
         
@@ -116,47 +374,53 @@ def export_draft(project_info, tasks, static_folder, export_dir):
         script.add_track(draft.TrackType.video).add_track(draft.TrackType.audio).add_track(draft.TrackType.text)
         
         current_time = 0.0
-        
-        print(f"========== 开始导出 (Fusion 模式) ==========")
-        print(f"数据源数量: {len(tasks)}")
 
+        logger.info(f"开始导出 (Fusion 模式)，数据源数量: {len(tasks)}")
+
+        # 批量探测视频真实时长 (带缓存，并行)
+        media_info = probe_many([item.get('video_url') for item in tasks]) if probe_many else {}
+
+        # 3. 先计算每一项的时间轴与素材来源，再并行暂存素材
+        timeline = []
+        stage_jobs = []
         for idx, item in enumerate(tasks):
             # item 现在是一个 fusion 对象
-            
-            # === 调试打印 ===
             scene = item.get('scene', '?')
             shot_no = item.get('shot_number', '?')
-            print(f"--- 处理第 {idx+1} 项: 场{scene}-镜{shot_no} ---")
-            
-            # === 字段适配 (关键修改) ===
+
+            # === 字段适配 ===
             # Fusion 对象通常包含：
             # - video_url: 生成的视频
             # - result_image: 融图生成的最终图片
             # - base_image: 底图 (备选)
             raw_url = item.get('video_url') or ''
-            
-            # 打印一下找到的路径，方便你调试
-            print(f"   关键字段 video_url: {item.get('video_url')}")
-            print(f"   关键字段 result_image: {item.get('result_image')}")
-            print(f"   👉 最终决定使用: {raw_url}")
-
-            # 时长 (Fusion 如果没有 duration 字段，默认 3s)
-            duration_sec = parse_duration(item.get('duration', '3s'))
+
+            # 时长优先使用探测到的真实时长，探测不到 (图片/文件缺失) 再用 duration 字段，默认 3s
+            probed = media_info.get(raw_url) or {}
+            duration_sec = probed.get('duration') or parse_duration(item.get('duration', '3s'))
             start_time_str = f"{current_time:.3f}s"
             duration_str = f"{duration_sec:.3f}s"
-            target_trange = trange(start_time_str, duration_str)
             file_prefix = f"{idx+1:03d}_sc{scene}_sh{shot_no}" # 文件名前缀带上场号镜号方便识别
 
-            # === 视频/图片处理逻辑 (使用 resolve_local_path) ===
-            media_source_path = resolve_local_path(static_folder, raw_url)
-            
+            media_source_path = resolve_local_path(static_folder, raw_url) if raw_url else None
+            stage_index = None
             if media_source_path and os.path.exists(media_source_path):
-                copied_path = copy_asset(media_source_path, assets_target_dir, prefix=file_prefix)
-                if copied_path:
-                    segment = draft.VideoSegment(copied_path, target_trange)
-                    script.add_segment(segment)
+                stage_index = len(stage_jobs)
+                stage_jobs.append((media_source_path, file_prefix))
             else:
-                print(f"   ⚠️ 跳过: 文件不存在或路径为空 -> {media_source_path}")
+                logger.warning(f"跳过 场{scene}-镜{shot_no}: 文件不存在或路径为空 -> {media_source_path}")
+
+            timeline.append((item, trange(start_time_str, duration_str), stage_index))
+            current_time += duration_sec
+
+        staged_paths = sync_assets(stage_jobs, draft_sys_path, assets_target_dir, progress_callback=progress_callback)
+
+        # 4. 按顺序组装轨道
+        for item, target_trange, stage_index in timeline:
+            copied_path = staged_paths[stage_index] if stage_index is not None else None
+            if copied_path:
+                segment = draft.VideoSegment(copied_path, target_trange)
+                script.add_segment(segment)
 
             # === 文本 (Fusion 可能没有 dialogue，看你需求) ===
             # 如果想显示 Prompt 作为字幕，可以用 item.get('fusion_prompt')
@@ -166,17 +430,15 @@ def export_draft(project_info, tasks, static_folder, export_dir):
                 text_seg.style = draft.TextStyle(color=(1.0, 1.0, 1.0)) 
                 script.add_segment(text_seg)
 
-            current_time += duration_sec
-            
         script.save()
-        
-        zip_output_name = os.path.join(export_dir, f"{film_name}_archive")
-        shutil.make_archive(zip_output_name, 'zip', export_dir, film_name)
-        
+
+        # 压缩包由调用方 (export_archive -> write_draft_zip) 生成
         return {
             "success": True, 
-            "message": "打包成功", 
-            "zip_path": zip_output_name + ".zip",
+            "message": "导出成功", 
+            "draft_name": film_name,
+            "draft_dir": draft_dir,
+            "zip_name": f"{film_name}_archive.zip",
             "folder_path": draft_sys_path
         }
 
@@ -0,0 +1,83 @@
+# json_stream.py
+import json
+import logging
+
+logger = logging.getLogger("JSONStream")
+
+
+class JSONArrayStreamParser:
+    """
+    增量解析 LLM 流式输出中的 JSON 数组
+    每当数组中的一个对象完整闭合就立即解析并返回，不必等待整个响应结束；
+    数组前的 ```json 等杂质会被跳过，单个对象格式错误只丢弃该对象，
+    响应被截断时已完成的对象依然保留。
+
+    用法：
+        parser = JSONArrayStreamParser()
+        for delta in stream:
+            for obj in parser.feed(delta): ...
+    """
+    def __init__(self):
+        self.items = []          # 已解析出的全部对象
+        self.errors = 0          # 解析失败被丢弃的对象数
+        self.closed = False      # 是否读到了数组结尾 ']'
+        self._started = False
+        self._depth = 0          # 相对数组的嵌套层级 (数组内为 1)
+        self._in_string = False
+        self._escape = False
+        self._buf = []
+
+    def feed(self, text):
+        """输入一段文本，返回本次新完成的对象列表"""
+        completed = []
+        for ch in text:
+            if self.closed:
+                break
+            if not self._started:
+                if ch == '[':
+                    self._started = True
+                    self._depth = 1
+                continue
+
+            if self._depth > 1:
+                self._buf.append(ch)
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                continue
+
+            if ch == '"':
+                self._in_string = True
+            elif ch in '{[':
+                if self._depth == 1:
+                    self._buf = [ch]
+                self._depth += 1
+            elif ch in '}]':
+                self._depth -= 1
+                if self._depth == 1:
+                    obj = self._parse(''.join(self._buf))
+                    self._buf = []
+                    if obj is not None:
+                        self.items.append(obj)
+                        completed.append(obj)
+                elif self._depth == 0:
+                    self.closed = True
+        return completed
+
+    def _parse(self, raw):
+        try:
+            return json.loads(raw)
+        except ValueError as e:
+            self.errors += 1
+            logger.warning(f"Skip malformed array item: {e}")
+            return None
+
+    @property
+    def truncated(self):
+        """数组未正常闭合 (响应被截断或输出不完整)"""
+        return self._started and not self.closed
@@ -0,0 +1,230 @@
+# llm_cache.py
+import os
+import json
+import time
+import atexit
+import sqlite3
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger("LLMCache")
+
+PROMPT_CACHE_FILE = "data/prompt_cache.sqlite3"
+PROMPT_CACHE_TTL = int(os.getenv('PROMPT_CACHE_TTL', 7 * 24 * 3600))
+
+TEXT_CACHE_FILE = "data/llm_cache.sqlite3"
+TEXT_CACHE_TTL = int(os.getenv('LLM_CACHE_TTL', 7 * 24 * 3600))
+TEXT_CACHE_MAX_BYTES = int(os.getenv('LLM_CACHE_MAX_BYTES', 20 * 1024 * 1024))
+# 启用响应缓存的接口 (逗号分隔)，未列出的接口即使传了 cache 参数也不走缓存
+TEXT_CACHE_ENDPOINTS = set(filter(None, os.getenv(
+    'LLM_CACHE_ENDPOINTS',
+    'scene_prompt,grid_prompt,video_prompt,fusion_prompt,analyze_script,character_list,script_continuation'
+).split(',')))
+
+
+def make_key(*parts):
+    """对请求内容做稳定哈希作为缓存键"""
+    raw = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class LLMCache:
+    """
+    LLM 结果的持久化缓存 (SQLite，WAL 模式，多个 gunicorn worker 共享同一个库)
+    - entries: 每个键一行 {value, created_at, used_at, latency_ms, tokens, size}，超过 TTL 视为失效
+      读写都只涉及单行，查询耗时与缓存总大小无关
+    - max_bytes: 缓存内容总大小上限，总大小在 meta 表中随写入增量维护，超出时按 used_at 淘汰最久未使用的条目
+    - stats: 按统计维度 (项目 / 接口) 记录命中次数、节省的耗时与 token
+      命中/未命中计数与命中条目的 used_at 先记在内存里，每 STATS_FLUSH_SECONDS 秒 (或查看统计时) 合并写入一次
+    首次打开时导入旧版 JSON 缓存文件 (同名 .json)
+    """
+    STATS_FLUSH_SECONDS = 10
+
+    def __init__(self, cache_file, ttl=PROMPT_CACHE_TTL, max_bytes=None):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.RLock()
+        self._conn = None
+        self._pid = None
+        self._pending_stats = {}
+        self._pending_used = {}
+        self._last_flush = time.time()
+        atexit.register(self.flush)
+
+    def _db(self):
+        """连接在首次使用时创建 (fork 出来的 worker 各自重新连接)"""
+        if self._conn is None or self._pid != os.getpid():
+            directory = os.path.dirname(self.cache_file)
+            if directory: os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.cache_file, timeout=10, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, used_at REAL NOT NULL,
+                    latency_ms INTEGER NOT NULL DEFAULT 0, tokens INTEGER NOT NULL DEFAULT 0, size INTEGER NOT NULL);
+                CREATE INDEX IF NOT EXISTS entries_used_at ON entries (used_at);
+                CREATE INDEX IF NOT EXISTS entries_created_at ON entries (created_at);
+                CREATE TABLE IF NOT EXISTS stats (
+                    bucket TEXT PRIMARY KEY, hits INTEGER NOT NULL DEFAULT 0, misses INTEGER NOT NULL DEFAULT 0,
+                    saved_ms INTEGER NOT NULL DEFAULT 0, saved_tokens INTEGER NOT NULL DEFAULT 0);
+                CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+            """)
+            if self._pid is not None:
+                # fork 出来的子进程：父进程未落库的统计由父进程自己写，这里丢弃副本避免重复计数
+                self._pending_stats, self._pending_used = {}, {}
+            self._conn, self._pid = conn, os.getpid()
+            self._import_legacy()
+        return self._conn
+
+    def _import_legacy(self):
+        """导入旧版整文件 JSON 缓存 (只做一次，导入后改名为 .json.imported)"""
+        legacy = os.path.splitext(self.cache_file)[0] + '.json'
+        if not os.path.exists(legacy): return
+        try:
+            with open(legacy, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            with self._transaction() as conn:
+                for key, e in (data.get('entries') or {}).items():
+                    value = json.dumps(e['value'], ensure_ascii=False)
+                    conn.execute("INSERT OR IGNORE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                 (key, value, e['created_at'], e.get('used_at', e['created_at']),
+                                  int(e.get('latency_ms', 0)), int(e.get('tokens') or 0), len(value.encode('utf-8'))))
+                for bucket, st in (data.get('stats') or {}).items():
+                    self._merge_stats(conn, bucket, st)
+                conn.execute("INSERT OR REPLACE INTO meta VALUES ('total_bytes', (SELECT COALESCE(SUM(size), 0) FROM entries))")
+            os.replace(legacy, legacy + '.imported')
+            logger.info(f"Imported legacy LLM cache {legacy}")
+        except Exception as e:
+            logger.warning(f"Legacy LLM cache import failed: {e}")
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._db()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    @staticmethod
+    def _merge_stats(conn, bucket, st):
+        conn.execute("""
+            INSERT INTO stats VALUES (?, ?, ?, ?, ?) ON CONFLICT(bucket) DO UPDATE SET
+                hits = hits + excluded.hits, misses = misses + excluded.misses,
+                saved_ms = saved_ms + excluded.saved_ms, saved_tokens = saved_tokens + excluded.saved_tokens
+        """, (bucket, st.get('hits', 0), st.get('misses', 0), int(st.get('saved_ms', 0)), int(st.get('saved_tokens', 0))))
+
+    def get(self, key):
+        """返回未过期的缓存条目，没有则返回 None"""
+        if not key: return None
+        with self._lock:
+            row = self._db().execute(
+                "SELECT value, created_at, used_at, latency_ms, tokens FROM entries WHERE key = ?", (key,)).fetchone()
+            if not row or time.time() - row[1] > self.ttl:
+                return None
+            now = time.time()
+            # used_at 只记在内存，随统计一起定期落库
+            self._pending_used[key] = now
+            return {'value': json.loads(row[0]), 'created_at': row[1], 'used_at': now,
+                    'latency_ms': row[3], 'tokens': row[4]}
+
+    def set(self, key, value, latency_ms=0, tokens=0):
+        now = time.time()
+        value = json.dumps(value, ensure_ascii=False)
+        size = len(value.encode('utf-8'))
+        with self._lock, self._transaction() as conn:
+            # 顺带清理过期条目；总大小随每次增删增量维护
+            expired = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries WHERE created_at < ?", (now - self.ttl,)).fetchone()[0]
+            conn.execute("DELETE FROM entries WHERE created_at < ?", (now - self.ttl,))
+            old = conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (key, value, now, now, int(latency_ms), int(tokens or 0), size))
+            total = self._add_total(conn, size - (old[0] if old else 0) - expired)
+            if self.max_bytes and total > self.max_bytes:
+                self._evict(conn, total)
+            self._pending_used.pop(key, None)
+
+    @staticmethod
+    def _add_total(conn, delta):
+        row = conn.execute("SELECT value FROM meta WHERE name = 'total_bytes'").fetchone()
+        if row is None:
+            # 库是旧版本建的或首次使用：全量统计一次
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        else:
+            total = max(0, row[0] + delta)
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('total_bytes', ?)", (total,))
+        return total
+
+    def _evict(self, conn, total):
+        """按最近使用时间淘汰，直到总大小不超过 max_bytes (至少保留刚写入的一条)"""
+        while total > self.max_bytes:
+            victims = conn.execute("SELECT key, size FROM entries ORDER BY used_at LIMIT 64").fetchall()
+            if len(victims) <= 1: break
+            freed = []
+            for key, size in victims[:-1]:
+                if total <= self.max_bytes: break
+                freed.append((key,))
+                total -= size
+            conn.executemany("DELETE FROM entries WHERE key = ?", freed)
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('total_bytes', ?)", (total,))
+
+    def record(self, bucket, hit, entry=None):
+        """记录一次查询结果 (bucket 为项目 ID 或接口名)，命中时累计节省的耗时与 token；先记在内存，定期落库"""
+        if not bucket: return
+        with self._lock:
+            stats = self._pending_stats.setdefault(bucket, {'hits': 0, 'misses': 0, 'saved_ms': 0, 'saved_tokens': 0})
+            if hit:
+                stats['hits'] += 1
+                stats['saved_ms'] += (entry or {}).get('latency_ms', 0)
+                stats['saved_tokens'] += (entry or {}).get('tokens', 0)
+            else:
+                stats['misses'] += 1
+            if time.time() - self._last_flush >= self.STATS_FLUSH_SECONDS:
+                self.flush()
+
+    def flush(self):
+        """把内存中的统计增量与 used_at 合并写入库"""
+        with self._lock:
+            self._last_flush = time.time()
+            if not self._pending_stats and not self._pending_used: return
+            pending_stats, pending_used = self._pending_stats, self._pending_used
+            self._pending_stats, self._pending_used = {}, {}
+            try:
+                with self._transaction() as conn:
+                    for bucket, st in pending_stats.items():
+                        self._merge_stats(conn, bucket, st)
+                    conn.executemany("UPDATE entries SET used_at = MAX(used_at, ?) WHERE key = ?",
+                                     [(t, k) for k, t in pending_used.items()])
+            except sqlite3.Error as e:
+                logger.warning(f"LLM cache stats flush failed: {e}")
+
+    def get_stats(self, bucket):
+        self.flush()
+        with self._lock:
+            row = self._db().execute("SELECT hits, misses, saved_ms, saved_tokens FROM stats WHERE bucket = ?", (bucket,)).fetchone()
+        stats = dict(zip(('hits', 'misses', 'saved_ms', 'saved_tokens'), row or (0, 0, 0, 0)))
+        total = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / total, 4) if total else 0.0
+        return stats
+
+    def get_all_stats(self):
+        """所有统计维度的汇总 + 缓存条目数"""
+        self.flush()
+        with self._lock:
+            conn = self._db()
+            buckets = [r[0] for r in conn.execute("SELECT bucket FROM stats")]
+            entry_count = conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        return {"entries": entry_count, "buckets": {b: self.get_stats(b) for b in buckets}}
+
+
+# Prompt 优化 (run_image_generation) 结果缓存，按项目统计
+prompt_cache = LLMCache(PROMPT_CACHE_FILE)
+
+# 通用文本生成 (run_text_generation) 响应缓存，按接口统计
+text_cache = LLMCache(TEXT_CACHE_FILE, ttl=TEXT_CACHE_TTL, max_bytes=TEXT_CACHE_MAX_BYTES)
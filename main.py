@@ -37,6 +37,8 @@ import time
 import re
 import uuid
 import json
+import mimetypes
+from urllib.parse import quote
 from typing import List, Optional, Dict, Any
 
 import logging
@@ -55,11 +57,20 @@ else:
     import eventlet
     eventlet.monkey_patch()
 
-from flask import Flask, request, jsonify, send_file, after_this_request
+from functools import wraps
+from flask import Flask, Request, request, jsonify, send_file, send_from_directory, after_this_request, g, Response, abort
+from werkzeug.security import safe_join
 
 import ai_service 
-from data_manager import DataManager
-from media_manager import MediaManager
+from json_stream import JSONArrayStreamParser
+from script_chunker import chunk_script, merge_shots
+from data_manager import DataManager, CharacterNameIndex
+from media_manager import MediaManager, UPLOAD_LIMITS, UPLOAD_FORM_OVERHEAD
+from media_gc import MediaGarbageCollector
+from generation_service import GenerationService
+from provider_router import router as provider_router
+import metrics
+import tracing
 
 from flask_socketio import SocketIO
 from task_queue import queue, init_socketio
@@ -75,8 +86,10 @@ def setup_logging():
     if not os.path.exists(log_dir):
         os.makedirs(log_dir)
 
+    # 后台任务中的日志带上 trace/span id，可与 /api/tasks/<id>/trace 对照
+    tracing.install_log_context()
     formatter = logging.Formatter(
-        '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+        '%(asctime)s - %(name)s - %(levelname)s - %(trace_ctx)s%(message)s'
     )
 
     file_handler = RotatingFileHandler(
@@ -109,8 +122,17 @@ setup_logging()
 
 # --- 配置 ---
 STATIC_FOLDER = os.path.join(BASE_DIR, 'static')
-app = Flask(__name__, static_url_path='/static', static_folder=STATIC_FOLDER)
+# /static 由下面的 serve_static 处理 (缓存头 / 交给前端服务器发送)，不用 Flask 内置的静态路由
+class MediaUploadRequest(Request):
+    """上传的文件在解析请求时直接流式写入 static/.uploads (边写边算摘要)，不在内存或系统临时目录中缓冲"""
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return media_mgr.open_upload_stream()
+
+app = Flask(__name__, static_folder=None)
+app.request_class = MediaUploadRequest
 app.config['SECRET_KEY'] = 'secret!'
+# 全局请求体上限；各上传接口再用 upload_limit 按媒体类型收紧
+app.config['MAX_CONTENT_LENGTH'] = max(UPLOAD_LIMITS.values()) + UPLOAD_FORM_OVERHEAD
 socket_mode = 'threading' if IS_FROZEN else 'eventlet'
 socketio = SocketIO(
     app, 
@@ -124,17 +146,68 @@ init_socketio(socketio)
 # 初始化管理器
 db = DataManager() 
 media_mgr = MediaManager(STATIC_FOLDER)
+media_gc = MediaGarbageCollector(db, media_mgr)
+media_gc.start()
+metrics.start_multiprocess()
+gen_service = GenerationService(db, media_mgr)
+
+def route_call(capability, data, call):
+    """按能力取 provider 链 (请求指定的 provider + settings 中配置的备选)，出错/超时自动切换"""
+    configs = db.get_provider_chain(capability, data.get('provider_id'), data.get('model_name'))
+    return provider_router.call(capability, configs, call)
+
+def route_stream(data, msgs, on_delta, **kwargs):
+    """
+    流式文本生成走 provider 链：只有在推送第一段增量之前出错才切换到备选 provider，
+    已经推送过内容再切换会把两个 provider 的输出拼在一起，此时按原样返回部分结果。
+    不对冲、不加单次超时 (超时后旧的流仍会继续推送)，由流式请求自身的读超时兜底
+    """
+    emitted = []
+    def forward(delta):
+        emitted.append(len(delta))
+        on_delta(delta)
+    def call(config):
+        result = ai_service.run_text_generation_stream(msgs, config, on_delta=forward, **kwargs)
+        if emitted and not result.get('success'): result['committed'] = True
+        return result
+    configs = db.get_provider_chain('text', data.get('provider_id'), data.get('model_name'))
+    return provider_router.call('text', configs, call, hedge=False, timeout=0)
+
+def upload_limit(media_type):
+    """上传接口装饰器：按媒体类型限制请求体大小，Content-Length 超出时不读请求体直接返回 413"""
+    limit = UPLOAD_LIMITS[media_type] + UPLOAD_FORM_OVERHEAD
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            request.max_content_length = limit
+            return func(*args, **kwargs)
+        return wrapper
+    return decorator
 
 # --- 路由 ---
+@app.errorhandler(413)
+def request_too_large(e):
+    limit = request.max_content_length or 0
+    return jsonify({'success': False, 'error': f"File too large (limit {limit // (1024 * 1024)}MB)"}), 413
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
 @app.after_request
 def log_http_request(response):
+    # 流式响应只统计到响应头发出为止
+    elapsed = time.perf_counter() - g.get('request_started', time.perf_counter())
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.HTTP_REQUEST_SECONDS.observe(elapsed, method=request.method, endpoint=endpoint)
+    metrics.HTTP_REQUESTS.inc(method=request.method, endpoint=endpoint, status=response.status_code)
     if request.path.startswith('/static') or request.path.startswith('/favicon'):
         return response
     ip = request.remote_addr
     method = request.method
     path = request.path
     status = response.status_code
-    app_logger.info(f"[HTTP] {ip} - {method} {path} - {status}")
+    app_logger.info(f"[HTTP] {ip} - {method} {path} - {status} - {elapsed * 1000:.1f}ms")
     return response
 
 @socketio.on('connect')
@@ -142,6 +215,54 @@ def handle_connect():
     print('Client connected')
     socketio.emit('task_update', queue.get_list())
     
+# === 静态媒体 (Static Media) ===
+# 版本化文件 ({entity}_v{N}.ext 及其缩略图) 写入后不再变化，浏览器缓存一年且不再协商；
+# 其余文件 (导出包、临时文件) 每次用 ETag / Last-Modified 协商 (304)。Range 请求 (视频拖动) 只返回所需片段
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+def offload_response(path):
+    """
+    经前端服务器代理时 (请求头 X-Sendfile-Type，Rack::Sendfile 约定) 只返回 X-Accel-Redirect / X-Sendfile 头，
+    由 nginx 等直接发送文件 (自带 Range / 条件请求 / sendfile)；未声明或路径无法映射时返回 None
+    X-Accel-Mapping: /app/static/=/_media/  (本地路径前缀=内部 location，逗号分隔多条)
+    """
+    kind = request.headers.get('X-Sendfile-Type')
+    if kind == 'X-Sendfile':
+        header, value = 'X-Sendfile', path
+    elif kind == 'X-Accel-Redirect':
+        value = None
+        for rule in request.headers.get('X-Accel-Mapping', '').split(','):
+            prefix, _, location = rule.strip().partition('=')
+            if prefix and location and path.startswith(prefix):
+                value = quote(location + path[len(prefix):])
+                break
+        if value is None: return None
+        header = 'X-Accel-Redirect'
+    else:
+        return None
+    response = Response(mimetype=mimetypes.guess_type(path)[0] or 'application/octet-stream')
+    response.headers[header] = value
+    return response
+
+@app.route('/static/<path:filename>')
+def serve_static(filename):
+    path = safe_join(STATIC_FOLDER, filename)
+    if path is None or not os.path.isfile(path): abort(404)
+
+    immutable = media_mgr.is_immutable(filename)
+    response = offload_response(path)
+    if response is None:
+        response = send_from_directory(STATIC_FOLDER, filename, conditional=True, etag=True,
+                                       max_age=IMMUTABLE_MAX_AGE if immutable else None)
+        response.accept_ranges = 'bytes'
+    if immutable:
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
 @app.route('/')
 def index(): return send_file('series.html')
 
@@ -225,6 +346,32 @@ def delete_provider(pid):
     db.save_settings(settings)
     return jsonify({"success": True})
 
+@app.route('/api/settings/routing', methods=['GET'])
+def get_routing():
+    """各能力的备选 provider 顺序 {capability: [provider_id, ...]}"""
+    return jsonify(db.get_settings().get('routing', {}))
+
+@app.route('/api/settings/routing', methods=['PUT'])
+def save_routing():
+    from provider_router import CAPABILITIES
+    req = request.json or {}
+    settings = db.get_settings()
+    known = {p['id'] for p in settings.get('providers', [])}
+    routing = {cap: [pid for pid in req.get(cap, []) if pid in known] for cap in CAPABILITIES if req.get(cap)}
+    settings['routing'] = routing
+    db.save_settings(settings)
+    return jsonify({"success": True, "routing": routing})
+
+@app.route('/api/providers/stats', methods=['GET'])
+def get_provider_stats():
+    """当前进程内各 provider 的滚动延迟 / 错误率 / 熔断状态"""
+    return jsonify(provider_router.get_stats())
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus 文本格式指标 (合并所有 gunicorn worker，见 metrics.py)"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 # === Project API ===
 @app.route('/api/projects', methods=['GET'])
 def get_projects():
@@ -296,10 +443,33 @@ def save_script(project_id):
     db.save_script(project_id, request.json)
     return jsonify({"success": True})
 
+def with_video_meta(items):
+    """为带 video_url 的分镜/融图附加视频元数据 (时长/分辨率/帧率/编码)，整集并行探测并缓存"""
+    meta = media_mgr.probe_many([item.get('video_url') for item in items])
+    for item in items:
+        if item.get('video_url'):
+            item['video_meta'] = meta.get(item['video_url'])
+    return items
+
+# 分镜/融图/角色中引用图片的字段 (列表字段与融图元素中的图片也包括在内)
+THUMB_FIELDS = ('scene_image', 'start_frame', 'end_frame', 'grid_image', 'base_image', 'result_image', 'end_frame_image', 'image_url')
+
+def with_thumbnails(items):
+    """附加 thumbs: {原图 url: {thumb, preview}}，缺失的派生图在后台补生成，前端拿不到时回退到原图"""
+    def image_urls(item):
+        urls = [item.get(f) for f in THUMB_FIELDS] + list(item.get('images') or [])
+        urls += [el.get('image_url') for el in item.get('elements') or [] if isinstance(el, dict)]
+        return [u for u in urls if isinstance(u, str) and u]
+
+    derived = media_mgr.derivatives_many([u for item in items for u in image_urls(item)])
+    for item in items:
+        item['thumbs'] = {u: derived[u] for u in image_urls(item) if u in derived}
+    return items
+
 # === Shot API ===
 @app.route('/api/projects/<project_id>/shots', methods=['GET'])
 def get_shots(project_id): 
-    return jsonify(db.get_shots(project_id))
+    return jsonify(with_thumbnails(with_video_meta(db.get_shots(project_id))))
 
 @app.route('/api/projects/<project_id>/shots', methods=['POST'])
 def create_shot(project_id):
@@ -317,6 +487,19 @@ def delete_shot(project_id, shot_id):
     db.delete_shot(project_id, shot_id)
     return jsonify({"message": "Deleted"})
 
+@app.route('/api/projects/<project_id>/shots/batch', methods=['POST'])
+def batch_create_shots(project_id):
+    """批量创建分镜: { shots: [...], insert_index? }"""
+    data = request.json or {}
+    created = db.create_shots(project_id, data.get('shots', []), insert_index=data.get('insert_index'))
+    return jsonify(created), 201
+
+@app.route('/api/projects/<project_id>/shots/batch', methods=['PATCH'])
+def batch_update_shots(project_id):
+    """批量更新分镜: { updates: [{ id, ...字段 }] }"""
+    updated, not_found = db.update_shots(project_id, (request.json or {}).get('updates', []))
+    return jsonify({"updated": updated, "not_found": not_found})
+
 @app.route('/api/projects/<project_id>/shots/batch_delete', methods=['POST'])
 def batch_delete_shots(project_id):
     ids = request.json.get('ids', [])
@@ -334,21 +517,22 @@ def reorder_shots(project_id):
 @app.route('/api/generate/script_continuation', methods=['POST'])
 def generate_script_continuation():
     data = request.json
-    config = db.get_provider_config(data.get('provider_id'))
-    if data.get('model_name'): config['model_name'] = data.get('model_name')
     
     sys = "你是一个专业的中文电影编剧助手。请根据前文续写一段剧本。要求：全中文，画面感强。"
     msgs = [{'role': 'system', 'content': sys}, {'role': 'user', 'content': f"前文：\n{data.get('context_text','')}\n\n请续写："}]
     
-    result = ai_service.run_text_generation(msgs, config)
+    stream_id = data.get('stream_id')
+    if stream_id:
+        # 边生成边推送，前端可实时显示续写内容
+        on_delta = lambda delta: socketio.emit('script_continuation_delta', {'stream_id': stream_id, 'delta': delta}, namespace='/')
+        result = route_stream(data, msgs, on_delta, cache='script_continuation', force_refresh=data.get('force_refresh'))
+    else:
+        result = route_call('text', data, lambda config: ai_service.run_text_generation(msgs, config, cache='script_continuation', force_refresh=data.get('force_refresh')))
     return jsonify(result) if result.get('success') else (jsonify(result), 500)
 
 @app.route('/api/generate/analyze_series', methods=['POST'])
 def analyze_series():
     data = request.json
-    config = db.get_provider_config(data.get('provider_id'))
-    if data.get('model_name'): config['model_name'] = data.get('model_name')
-    
     content = data.get('content', '')
     if not content:
         return jsonify({"error": "Content is empty"}), 400
@@ -361,7 +545,7 @@ def analyze_series():
     user_prompt = f"剧本/小说内容如下：\n\n{content}"
     msgs = [{'role': 'system', 'content': sys_prompt}, {'role': 'user', 'content': user_prompt}]
     
-    result = ai_service.run_text_generation(msgs, config)
+    result = route_call('text', data, lambda config: ai_service.run_text_generation(msgs, config))
     
     if result.get('success'):
         try:
@@ -378,6 +562,9 @@ def analyze_series():
     return jsonify(result), 500
 
 
+# 长剧本分块分析的并发数
+ANALYZE_CHUNK_CONCURRENCY = int(os.getenv('ANALYZE_CHUNK_CONCURRENCY', 4))
+
 @app.route('/api/generate/analyze_script', methods=['POST'])
 def analyze_script():
     """
@@ -385,8 +572,6 @@ def analyze_script():
     目标：生成具有叙事纪律、无废镜头、节奏多变的分镜列表
     """
     data = request.json
-    config = db.get_provider_config(data.get('provider_id'))
-    if data.get('model_name'): config['model_name'] = data.get('model_name')
     
     project_id = data.get('project_id')
     project_info = db.get_project(project_id) if project_id else {}
@@ -415,61 +600,108 @@ def analyze_script():
     3. 不要包含 Markdown 标记。
     **JSON对象结构**：scene (场号), shot_number (镜号), visual_description (视觉画面描述), scene_description (场景环境), characters (列表), dialogue, audio_description, shot_size (景别: 远景/全景/中景/特写/特写细节), camera_movement (运镜: 推/拉/摇/移/跟随/手持/静止), duration (秒)
     """
-    user_prompt = f"""
-        剧本内容：{data.get('content', '')}
+    def build_messages(content, chunk_note=""):
+        # 各分块共享同一份项目上下文 (人物、基础信息、情感、色彩)
+        user_prompt = f"""
+        剧本内容：{content}{chunk_note}
         人物信息：{characters_info}
         项目基础信息：{project_info.get('basic_info', '')}
         情感关键词：{project_info.get('script_emotional_keywords', '')}
         色彩体系：{project_info.get('visual_color_system', '')}
     """
+        return [{'role': 'system', 'content': sys}, {'role': 'user', 'content': user_prompt}]
+
+    # 名称索引每个请求只建一次；新角色先在内存中分配 id，返回前一次性写入
+    name_index = CharacterNameIndex(character_list)
+
+    def map_character_names(names):
+        if isinstance(names, str): names = [names]
+        if not isinstance(names, list): return []
+        mapped_objs = []
+        for name in names:
+            if not name or not str(name).strip(): continue
+            mapped_objs.append(name_index.resolve_or_add(name, 'AI 剧本分析自动识别的新角色'))
+        return mapped_objs
+
+    def map_shot(shot):
+        if 'characters' in shot:
+            shot['characters'] = map_character_names(shot['characters'])
+
+    def save_new_characters():
+        if project_id and name_index.pending:
+            db.create_characters(project_id, name_index.pending)
+            name_index.pending = []
+
+    stream_id = data.get('stream_id')
+    chunks = chunk_script(data.get('content', ''))
+
+    if len(chunks) > 1:
+        # 长剧本：按场景边界分块并行分析，再按块顺序合并、重新编号
+        finished = []
+        def analyze_chunk(chunk):
+            def run():
+                note = f"\n（这是完整剧本的第 {chunk['index'] + 1}/{len(chunks)} 部分，只拆解本部分内容）"
+                res = route_call('text', data, lambda config: ai_service.run_text_generation(
+                    build_messages(chunk['text'], note), config, cache='analyze_script', force_refresh=data.get('force_refresh')))
+                chunk_parser = JSONArrayStreamParser()
+                chunk_parser.feed(res.get('content') or '')
+                finished.append(chunk['index'])
+                if stream_id:
+                    socketio.emit('analyze_script_progress', {'stream_id': stream_id, 'chunks_done': len(finished), 'chunks_total': len(chunks)}, namespace='/')
+                return {'success': res.get('success') and not chunk_parser.truncated and not chunk_parser.errors,
+                        'shots': [shot for shot in chunk_parser.items if isinstance(shot, dict)],
+                        'error_msg': res.get('error_msg')}
+            return run
+
+        # 分块数可能远多于并发数，不设整体截止时间，由各 provider 自身的请求超时兜底
+        results = ai_service.run_parallel({c['index']: analyze_chunk(c) for c in chunks}, deadline=None, max_workers=ANALYZE_CHUNK_CONCURRENCY)
+        shots_data = merge_shots([results[c['index']].get('shots', []) for c in chunks])
+        for index, shot in enumerate(shots_data):
+            map_shot(shot)
+            if stream_id:
+                socketio.emit('analyze_script_shot', {'stream_id': stream_id, 'index': index, 'shot': shot}, namespace='/')
+        failed = [c['index'] + 1 for c in chunks if not results[c['index']].get('success')]
+        save_new_characters()
+        if shots_data:
+            if failed: app_logger.warning(f"analyze_script chunks failed or partial: {failed}")
+            return jsonify({'shots': shots_data, 'partial': bool(failed), 'chunks': len(chunks)})
+        result = results[chunks[0]['index']]
+        return jsonify({'success': False, 'error': result.get('error_msg') or 'Invalid JSON from AI'}), 500
+
+    # 增量解析 JSON 数组：每个分镜对象一闭合就处理，传了 stream_id 时立即通过 Socket.IO 推送给前端
+    msgs = build_messages(data.get('content', ''))
+    parser = JSONArrayStreamParser()
+
+    def on_delta(delta):
+        for shot in parser.feed(delta):
+            if not isinstance(shot, dict): continue
+            map_shot(shot)
+            if stream_id:
+                socketio.emit('analyze_script_shot', {'stream_id': stream_id, 'index': len(parser.items) - 1, 'shot': shot}, namespace='/')
+
+    if stream_id:
+        result = route_stream(data, msgs, on_delta, cache='analyze_script', force_refresh=data.get('force_refresh'))
+    else:
+        result = route_call('text', data, lambda config: ai_service.run_text_generation(msgs, config, cache='analyze_script', force_refresh=data.get('force_refresh')))
+        on_delta(result.get('content') or '')
+
+    save_new_characters()
+    shots_data = [shot for shot in parser.items if isinstance(shot, dict)]
+    if shots_data:
+        # 响应被截断或个别对象格式错误时，已完成的分镜依然返回
+        partial = not result.get('success') or parser.truncated or parser.errors > 0
+        if partial:
+            app_logger.warning(f"analyze_script partial result: {len(shots_data)} shots, truncated={parser.truncated}, errors={parser.errors}")
+        return jsonify({'shots': shots_data, 'partial': partial})
 
-    msgs = [{'role': 'system', 'content': sys}, {'role': 'user', 'content': user_prompt}]
-    result = ai_service.run_text_generation(msgs, config)
-    
     if result.get('success'):
-        try:
-            cleaned = re.sub(r'^```json\s*|\s*```$', '', result['content'].strip(), flags=re.MULTILINE | re.DOTALL)
-            shots_data = json.loads(cleaned)
-            
-            current_char_list = db.get_characters(project_id) if project_id else []
-
-            def map_character_names(names, char_data_list, pid):
-                mapped_objs = []
-                if isinstance(names, str): names = [names]
-                if not isinstance(names, list): return []
-                for name in names:
-                    if not name: continue
-                    clean_name = str(name).strip()
-                    if not clean_name: continue
-                    found = next((c for c in char_data_list if c.get('name', '').strip() == clean_name), None)
-                    if found:
-                        mapped_objs.append(found)
-                    else:
-                        new_char_data = {'name': clean_name, 'description': 'AI 剧本分析自动识别的新角色'}
-                        saved_char = db.create_character(pid, new_char_data)
-                        char_data_list.append(saved_char)
-                        mapped_objs.append(saved_char)
-                return mapped_objs
-
-            for shot in shots_data:
-                if 'characters' in shot:
-                    shot['characters'] = map_character_names(shot['characters'], current_char_list, project_id)
-
-            return jsonify({'shots': shots_data})
-        except Exception as e:
-            print(f"JSON Parse Error: {e}")
-            import traceback
-            traceback.print_exc()
-            return jsonify({'error': 'Invalid JSON from AI', 'details': str(e)}), 500
-            
+        app_logger.warning("analyze_script: no shot objects in response")
+        return jsonify({'error': 'Invalid JSON from AI', 'details': result.get('content', '')[:200]}), 500
     return jsonify(result), 500
 
 @app.route('/api/generate/image', methods=['POST'])
 def generate_image():
     data = request.json
-    config = db.get_provider_config(data.get('provider_id'))
-    if data.get('model_name'): config['model_name'] = data.get('model_name')
-    
     shot_id = data.get('shot_id')
     pid = data.get('project_id')
     
@@ -480,10 +712,18 @@ def generate_image():
     prev_context = prev_shot['end_frame_prompt'] if prev_shot else ''
     start_prompt_ref = current_shot.get('start_frame_prompt')
     
-    result, used_prompt = ai_service.run_image_generation(
-        data.get('visual_description'), data.get('style_description'), data.get('consistency_text'),
-        data.get('frame_type'), config, media_mgr, start_prompt_ref, prev_context, entity_id=shot_id
-    )
+    # 切换 provider 时优化后的提示词直接命中缓存，不会重复调用 LLM
+    used = {}
+    def generate(config):
+        res, used['prompt'] = ai_service.run_image_generation(
+            data.get('visual_description'), data.get('style_description'), data.get('consistency_text'),
+            data.get('frame_type'), config, media_mgr, start_prompt_ref, prev_context, entity_id=shot_id,
+            use_prompt_cache=not data.get('refresh_prompt') or 'prompt' in used, project_id=pid
+        )
+        return res
+
+    result = route_call('image', data, generate)
+    used_prompt = used.get('prompt')
 
     if result.get('success'):
         update_data = {'start_frame_prompt': used_prompt} if data.get('frame_type') == 'start' else {'end_frame_prompt': used_prompt}
@@ -491,27 +731,90 @@ def generate_image():
         return jsonify(result)
     return jsonify(result), 500
 
+@app.route('/api/llm_cache/stats', methods=['GET'])
+def get_llm_cache_stats():
+    """文本生成响应缓存的命中率 (按接口)"""
+    from llm_cache import text_cache
+    return jsonify(text_cache.get_all_stats())
+
+@app.route('/api/projects/<project_id>/prompt_cache/stats', methods=['GET'])
+def get_prompt_cache_stats(project_id):
+    """提示词优化缓存的命中率及节省的耗时/token"""
+    from llm_cache import prompt_cache
+    return jsonify(prompt_cache.get_stats(project_id))
+
+
+# 每个项目同一时间只允许一个导出任务 (共用草稿目录)
+export_tasks = {}
+
+def _export_zip_path(project_id):
+    return os.path.join(STATIC_FOLDER, "exports", f"{project_id}_archive.zip")
+
+def _export_state(project_id):
+    """当前导出任务 + 已生成压缩包的状态"""
+    from jianying_exporter import load_archive_meta, export_fingerprint
+    task = queue.get(export_tasks.get(project_id))
+    running = bool(task) and task['status'] in ('pending', 'processing')
+    failed = bool(task) and task['status'] == 'failed'
+    meta = load_archive_meta(_export_zip_path(project_id))
+    fresh = False
+    if meta and not running:
+        fp = export_fingerprint(db.get_project(project_id), db.get_fusions(project_id), STATIC_FOLDER)
+        fresh = meta.get('fingerprint') == fp
+    # 上次导出失败或项目已变化时，旧压缩包不算可下载
+    ready = fresh and not failed
+    return {
+        "task_id": task['id'] if task else None,
+        "status": task['status'] if task else ('success' if ready else 'none'),
+        "progress": task.get('progress', 0) if task else (100 if ready else 0),
+        "stage": task.get('stage') if task else None,
+        "error": task.get('error') if task else None,
+        "ready": ready,
+        "fresh": fresh,
+        "archive": meta,
+        "download_url": f"/api/projects/{project_id}/export/jianying/download" if ready else None
+    }
 
 @app.route('/api/projects/<project_id>/export/jianying', methods=['POST'])
 def export_jianying(project_id):
+    """提交导出任务；项目未变化时直接返回可下载的压缩包"""
     project_info = db.get_project(project_id)
-    from jianying_exporter import export_draft
-    
-    raw_fusions = db.get_fusions(project_id)
+    if not project_info: return jsonify({"error": "Project not found"}), 404
+    from jianying_exporter import export_archive
+
+    state = _export_state(project_id)
+    if state['status'] in ('pending', 'processing') or state['ready']:
+        return jsonify({"success": True, **state})
+
     export_dir = os.path.join(STATIC_FOLDER, "exports")
-    result = export_draft(project_info, raw_fusions, STATIC_FOLDER, export_dir)
-    
-    if result['success']:
-        zip_path = result['zip_path']
-        filename = os.path.basename(zip_path)
-        return send_file(zip_path, as_attachment=True, download_name=filename, mimetype='application/zip')
-    else:
-        return jsonify(result), 500
+    zip_path = _export_zip_path(project_id)
+
+    def job():
+        result = export_archive(db.get_project(project_id), db.get_fusions(project_id), STATIC_FOLDER,
+                                export_dir, zip_path, progress_callback=queue.report_progress,
+                                probe_many=media_mgr.probe_many)
+        if not result['success']:
+            raise Exception(result.get('error') or 'Export failed')
+
+    export_tasks[project_id] = queue.submit(job, desc=f"导出剪映草稿: {project_info.get('film_name', '')}")
+    return jsonify({"success": True, **_export_state(project_id)}), 202
+
+@app.route('/api/projects/<project_id>/export/jianying', methods=['GET'])
+def export_jianying_status(project_id):
+    return jsonify(_export_state(project_id))
+
+@app.route('/api/projects/<project_id>/export/jianying/download', methods=['GET'])
+def download_jianying(project_id):
+    state = _export_state(project_id)
+    if not state['ready']:
+        return jsonify({"error": "Archive not ready"}), 404
+    return send_file(_export_zip_path(project_id), as_attachment=True,
+                     download_name=state['archive'].get('zip_name') or f"{project_id}_archive.zip", mimetype='application/zip')
 
 # === Character API ===
 @app.route('/api/projects/<project_id>/characters', methods=['GET'])
 def get_characters(project_id):
-    return jsonify(db.get_characters(project_id))
+    return jsonify(with_thumbnails(db.get_characters(project_id)))
 
 @app.route('/api/projects/<project_id>/characters', methods=['POST'])
 def create_character(project_id):
@@ -531,65 +834,19 @@ def delete_character(project_id, character_id):
 
 @app.route('/api/generate/character_views', methods=['POST'])
 def generate_character_views():
-    data = request.json
-    config = db.get_provider_config(data.get('provider_id'))
-    if data.get('model_name'): config['model_name'] = data.get('model_name')
-
-    project_id = data.get('project_id')
-    character_id = data.get('character_id')
-    
-    project_info = db.get_project(project_id) if project_id else {}
-    
-    prompt = build_comprehensive_character_prompt(
-        data.get('character_description'), 
-        project_info.get('visual_color_system', ''), 
-        project_info.get('script_emotional_keywords', ''), 
-        project_info.get('basic_info', '')
-    )
-    
-    result = ai_service.run_simple_image_generation(prompt, config, media_mgr, entity_id=character_id)
-    return jsonify({'success': True, 'url': result['url']}) if result.get('success') else (jsonify({'success': False, 'error': '生成失败'}), 500)
-
-def build_comprehensive_character_prompt(character_desc, color_system, emotional_keywords, basic_info):
-    """
-    [UPDATED] 基于 PDF Phase 1: Character Foundation 逻辑
-    重点：视频一致性 (Video Consistency)，简单轮廓，无琐碎细节
-    """
-    prompt = f"""
-    [Cinematographer AI Character Reference]
-    主体：{character_desc}
-    
-    【CRITICAL: Design for Video Consistency / 视频生成一致性设计】
-    1. **简化设计 (SIMPLE)**: 保持角色轮廓清晰简洁。
-    2. **拒绝琐碎细节**: 避免任何细小的悬挂元素（如流苏、细链条、飘带、羊皮纸碎片），这些在视频生成中会变成噪点。
-    3. **标志性形状**: 强调可识别的形状（如独特的头盔轮廓、大胆的护甲设计）。
-    4. **电影级写实**: 追求超写实摄影质感 (Hyper-realistic photography)，而非概念艺术。
-    
-    请生成一张包含以下内容的角色设计表 (Character Sheet)：
-    1. 左上角：角色正面特写 (Chest up)
-    2. 右上角：角色正面全身
-    3. 左下角：角色侧面全身
-    4. 右下角：角色背面全身
-    
-    重要要求：纯白背景，无水印，人物外貌特征在所有视图中保持严格一致。
-    """
-    if color_system: prompt += f"\n色彩体系：{color_system} (保持电影感色调)"
-    if emotional_keywords: prompt += f"\n情感/能量状态：{emotional_keywords}"
-    if basic_info: prompt += f"\n背景设定：{basic_info}"
-    return prompt
+    payload, status = gen_service.generate_character_views(request.json)
+    return jsonify(payload), status
 
 @app.route('/api/generate/character_list', methods=['POST'])
 def generate_character_list():
     data = request.json
-    config = db.get_provider_config(data.get('provider_id'))
-    if data.get('model_name'): config['model_name'] = data.get('model_name')
 
     visual_prompt = data.get('visual_consistency_prompt', '')
     sys = "你是一个专业的电影角色设计师。请根据提供的视觉统一设定，生成主要角色列表，每个角色包含名称和详细描述。"
     msgs = [{'role': 'system', 'content': sys}, 
             {'role': 'user', 'content': f"视觉统一设定：{visual_prompt}\n\n请生成JSON格式的角色列表: {{ \"characters\": [ {{\"name\": \"...\", \"description\": \"...\"}} ] }}"}]
 
-    result = ai_service.run_text_generation(msgs, config)
+    result = route_call('text', data, lambda config: ai_service.run_text_generation(msgs, config, cache='character_list', force_refresh=data.get('force_refresh')))
     if result.get('success'):
         try:
             json_match = re.search(r'\{.*\}', result.get('content', ''), re.DOTALL)
@@ -600,6 +857,7 @@ def generate_character_list():
     return jsonify({'success': False, 'error': '无法解析角色列表'}), 500
 
 @app.route('/api/upload/character_image', methods=['POST'])
+@upload_limit('image')
 def upload_character_image():
     if 'file' not in request.files: return jsonify({'success': False, 'error': 'No file'}), 400
     cid = request.form.get('character_id') or 'char'
@@ -615,6 +873,7 @@ def batch_delete_characters(project_id):
     return jsonify({"success": True})
 
 @app.route('/api/upload/scene_image', methods=['POST'])
+@upload_limit('image')
 def upload_scene_image():
     if 'file' not in request.files: return jsonify({'success': False, 'error': 'No file'}), 400
     sid = request.form.get('scene_id') or 'scene'
@@ -623,6 +882,7 @@ def upload_scene_image():
     return jsonify({'success': True, 'url': url})
 
 @app.route('/api/upload/grid_image', methods=['POST'])
+@upload_limit('image')
 def upload_grid_image():
     if 'file' not in request.files: return jsonify({'success': False, 'error': 'No file'}), 400
     sid = request.form.get('shot_id') or 'scene'
@@ -632,36 +892,18 @@ def upload_grid_image():
 
 @app.route('/api/generate/scene_prompt', methods=['POST'])
 def generate_scene_prompt():
-    data = request.json
-    config = db.get_provider_config(data.get('provider_id'))
-    if data.get('model_name'): config['model_name'] = data.get('model_name')
-    
-    project_id = data.get('project_id')
-    project_info = db.get_project(project_id) if project_id else {}
-    
-    sys = "你是一个专业的电影场景设计师。请根据场景描述生成详细的场景提示词。"
-    user_prompt = f"场景描述：{data.get('scene_description')}\n请生成包含时间、天气、光影、空间、风格的详细提示词。"
-    
-    if project_info:
-        user_prompt += f"\n色彩：{project_info.get('visual_color_system','')}\n基调：{project_info.get('script_emotional_keywords','')}"
-
-    result = ai_service.run_text_generation([{'role': 'system', 'content': sys}, {'role': 'user', 'content': user_prompt}], config)
-    return jsonify({'success': True, 'prompt': result['content']}) if result.get('success') else (jsonify({'success': False}), 500)
+    payload, status = gen_service.generate_scene_prompt(request.json)
+    return jsonify(payload), status
 
 @app.route('/api/generate/scene_image', methods=['POST'])
 def generate_scene_image():
-    data = request.json
-    config = db.get_provider_config(data.get('provider_id'))
-    if data.get('model_name'): config['model_name'] = data.get('model_name')
-    scene_id = data.get('scene_id')
-    prompt = f"电影场景设计图，{data.get('scene_prompt')}。高分辨率，电影质感。"
-    result = ai_service.run_simple_image_generation(prompt, config, media_mgr, entity_id=scene_id)
-    return jsonify({'success': True, 'url': result['url']}) if result.get('success') else (jsonify({'success': False}), 500)
+    payload, status = gen_service.generate_scene_image(request.json)
+    return jsonify(payload), status
 
 # === Fusion API ===
 @app.route('/api/projects/<project_id>/fusions', methods=['GET'])
 def get_fusions(project_id):
-    return jsonify(db.get_fusions(project_id))
+    return jsonify(with_thumbnails(with_video_meta(db.get_fusions(project_id))))
 
 @app.route('/api/projects/<project_id>/fusions', methods=['POST'])
 def create_fusion(project_id):
@@ -681,13 +923,12 @@ def delete_fusion(project_id, fusion_id):
 @app.route('/api/generate/element_image', methods=['POST'])
 def generate_element_image():
     data = request.json
-    config = db.get_provider_config(data.get('provider_id'))
-    if data.get('model_name'): config['model_name'] = data.get('model_name')
     element_id = data.get('element_id')
-    result = ai_service.run_simple_image_generation(data.get('prompt'), config, media_mgr, entity_id=element_id)
+    result = route_call('image', data, lambda config: ai_service.run_simple_image_generation(data.get('prompt'), config, media_mgr, entity_id=element_id))
     return jsonify({'success': True, 'url': result['url']}) if result.get('success') else (jsonify({'success': False}), 500)
 
 @app.route('/api/upload/element_image', methods=['POST'])
+@upload_limit('image')
 def upload_element_image():
     if 'file' not in request.files: return jsonify({'success': False}), 400
     eid = request.form.get('element_id')
@@ -696,6 +937,7 @@ def upload_element_image():
     return jsonify({'success': True, 'url': url})
 
 @app.route('/api/upload/base_image', methods=['POST'])
+@upload_limit('image')
 def upload_base_image():
     if 'file' not in request.files: return jsonify({'success': False}), 400
     fid = request.form.get('fusion_id')
@@ -705,118 +947,18 @@ def upload_base_image():
 
 @app.route('/api/generate/fusion_image', methods=['POST'])
 def generate_fusion_image():
-    data = request.json
-    fusion_id = data.get('fusion_id')
-    project_id = data.get('project_id')
-    
-    current_fusion = db.get_fusion(project_id, fusion_id)
-    if not current_fusion: return jsonify({'success': False, 'error': 'Fusion not found'}), 404
-    
-    base_image_url = current_fusion.get('base_image')
-    if not base_image_url: return jsonify({'success': False, 'error': 'No base image'}), 400
-    
-    base_image_path = media_mgr.get_absolute_path(base_image_url)
-    
-    element_paths = []
-    for el in current_fusion.get('elements', []):
-        if el.get('image_url'): 
-            element_paths.append(media_mgr.get_absolute_path(el['image_url']))
-        
-    config = db.get_provider_config(data.get('provider_id'))
-    if data.get('model_name'): config['model_name'] = data.get('model_name')
-    
-    result = ai_service.run_fusion_generation(
-        base_image_path=base_image_path,
-        fusion_prompt=data.get('fusion_prompt'),
-        config=config,
-        media_manager=media_mgr,
-        element_image_paths=element_paths,
-        entity_id=fusion_id
-    )
-    
-    return jsonify({'success': True, 'url': result['url']}) if result.get('success') else (jsonify({'success': False, 'error': result.get('error_msg')}), 500)
+    payload, status = gen_service.generate_fusion_image(request.json)
+    return jsonify(payload), status
 
 @app.route('/api/generate/fusion_prompt', methods=['POST'])
 def generate_fusion_prompt():
-    """
-    [UPDATED] 基于 PDF Phase 3 Logic: Image-to-Video Motion Prompts Prep
-    目标：生成 Explicit Shot Description, 并包含 Environmental Motion (如 fog, wind) 以为视频做准备
-    """
-    data = request.json
-    config = db.get_provider_config(data.get('provider_id'))
-    if data.get('model_name'): config['model_name'] = data.get('model_name')
-    
-    project_info = db.get_project(data.get('project_id')) if data.get('project_id') else {}
-    
-    # === [Phase 3: Motion Prep & Explicit Description] ===
-    sys = """
-    你是一位专家级电影摄影师 (Cinematographer AI)。请生成用于 AI 图像生成的英文提示词。
-    
-    【Output Format - Strict】
-    [Subject Description] + [Shot Setup] + [Environment/Lighting] + [Style Keywords]
-    
-    【Principles】
-    1. **Shot Description Clarity**: 极其明确地描述谁在画面中、在哪个位置、面朝哪里。不要留给 AI 猜测的空间。
-    2. **Realism**: 追求《你的名字》的动漫二次元感，避免由于描述模糊导致的概念图质感。
-    3. **Motion Prep (重要)**: 既然这是为视频生成的静帧，请在环境描述中包含动态元素 (如 drifting fog, swaying branches, dust particles)，这能让后续的图生视频更生动。
-    
-    请直接输出中文提示词，不要包含 Markdown 或其他解释性文字。
-    """
-    
-    base_info = f"【元素结合】：{data.get('element_mapping')} 【场景环境】：{data.get('scene_description')} 【镜头动作】：{data.get('shot_description')}"
-    if project_info: user_prompt_base = f"{base_info}\n【整体色彩体系】：{project_info.get('visual_color_system','')}"
-    else: user_prompt_base = base_info
-
-    # 生成首帧
-    user_prompt_start = f"{user_prompt_base}\n\n任务：生成该镜头 **开始时刻 (Start Frame)** 的画面提示词。"
-    res_start = ai_service.run_text_generation([{'role': 'system', 'content': sys}, {'role': 'user', 'content': user_prompt_start}], config)
-    
-    # 生成尾帧 (为视频一致性做准备)
-    user_prompt_end = f"{user_prompt_base}\n\n任务：生成该镜头 **结束时刻 (End Frame)** 的画面提示词。如果镜头有推拉摇移，请描述视角的改变；如果角色有动作，请描述动作完成后的状态。"
-    res_end = ai_service.run_text_generation([{'role': 'system', 'content': sys}, {'role': 'user', 'content': user_prompt_end}], config)
-    
-    if res_start.get('success'):
-        return jsonify({'success': True, 'prompt': res_start['content'], 'end_frame_prompt': res_end.get('content', '')})
-    return jsonify({'success': False}), 500
+    payload, status = gen_service.generate_fusion_prompt(request.json)
+    return jsonify(payload), status
 
 @app.route('/api/generate/fusion_video', methods=['POST'])
 def generate_fusion_video():
-    """
-    [UPDATED] PDF Phase 3: Motion Generation
-    注意：虽然这里调用的是视频生成模型，但输入的 Prompt (来自 fusion_prompt) 必须包含 PDF 中提到的 Motion Keywords。
-    """
-    data = request.json
-    fusion_id = data.get('fusion_id')
-    project_id = data.get('project_id')
-    
-    current_fusion = db.get_fusion(project_id, fusion_id)
-    if not current_fusion: return jsonify({'success': False, 'error': 'Not found'}), 404
-    
-    s_url = current_fusion.get('result_image')
-    e_url = current_fusion.get('end_frame_image')
-    if not s_url: return jsonify({'success': False, 'error': 'No start image'}), 400
-    
-    s_path = media_mgr.get_absolute_path(s_url)
-    e_path = media_mgr.get_absolute_path(e_url) if e_url else None
-    
-    config = db.get_provider_config(data.get('provider_id'))
-    if data.get('model_name'): config['model_name'] = data.get('model_name')
-    
-    # 获取提示词，如果没有则给默认值。
-    # 理想情况下，这里的 fusion_prompt 已经由上面的 generate_fusion_prompt 生成并包含 Motion keywords
-    prompt_text = current_fusion.get('fusion_prompt') or "high quality cinematic video, slow motion"
-    
-    result = ai_service.run_video_generation(
-        prompt_text,
-        s_path, e_path, config, 
-        media_mgr,
-        entity_id=fusion_id
-    )
-    
-    if result.get('success'):
-        db.update_fusion(project_id, fusion_id, {'video_url': result['url']})
-        return jsonify({'success': True, 'url': result['url']})
-    return jsonify({'success': False}), 500
+    payload, status = gen_service.generate_fusion_video(request.json)
+    return jsonify(payload), status
 
 @app.route('/api/projects/<project_id>/history', methods=['GET'])
 def get_project_history(project_id):
@@ -841,10 +983,59 @@ def get_project_history(project_id):
                     entity_map[el['id']] = {'name': f"元素: {el.get('name')} ({name})", 'type': 'element'}
 
     history_list = media_mgr.scan_project_files(entity_map)
-    print(history_list)
-    return jsonify(history_list)
+
+    def with_derivatives(items):
+        # 图片条目附加 thumb / preview (只处理本次返回的条目，旧文件按需补生成)
+        derived = media_mgr.derivatives_many([item['url'] for item in items if item['media_type'] == 'image'])
+        for item in items:
+            item.update(derived.get(item['url']) or {})
+        return items
+
+    # 分页 (?page=1&page_size=50)；不带 page 参数时保持原有的完整列表返回
+    page = request.args.get('page', type=int)
+    if not page:
+        return jsonify(with_derivatives(history_list))
+    page_size = max(1, min(request.args.get('page_size', 50, type=int), 500))
+    start = (max(page, 1) - 1) * page_size
+    return jsonify({
+        'items': with_derivatives(history_list[start:start + page_size]),
+        'total': len(history_list),
+        'page': max(page, 1),
+        'page_size': page_size
+    })
+
+# === Media Storage API ===
+@app.route('/api/media/stats', methods=['GET'])
+def get_media_stats():
+    """内容寻址存储占用：版本化文件总大小 / 实际占用 / 去重节省的空间"""
+    return jsonify(media_mgr.storage_stats())
+
+@app.route('/api/media/dedupe', methods=['POST'])
+def dedupe_media():
+    """后台把已有媒体文件纳入内容寻址存储 (重复内容改为硬链接)，结果写入任务信息"""
+    def job():
+        queue.report_progress(99, **media_mgr.dedupe_existing(progress_callback=queue.report_progress))
+    tid = queue.submit(job, desc="媒体去重")
+    return jsonify({"success": True, "task_id": tid}), 202
+
+@app.route('/api/media/gc', methods=['GET'])
+def get_media_gc():
+    """上次孤立媒体回收的报告"""
+    return jsonify(media_gc.last_report())
+
+@app.route('/api/media/gc', methods=['POST'])
+def collect_media_garbage():
+    """后台回收未被任何项目引用的媒体文件；?dry_run=1 只统计不删除"""
+    dry_run = request.args.get('dry_run', '0') in ('1', 'true')
+    def job():
+        report = media_gc.collect(dry_run=dry_run, progress_callback=queue.report_progress)
+        if report is None: raise RuntimeError("另一个进程正在回收，请稍后再试")
+        queue.report_progress(99, **report)
+    tid = queue.submit(job, desc="媒体回收" + (" (预览)" if dry_run else ""))
+    return jsonify({"success": True, "task_id": tid}), 202
 
 @app.route('/api/generate/analyze_image', methods=['POST'])
+@upload_limit('image')
 def analyze_uploaded_image():
     if 'file' not in request.files: return jsonify({'success': False, 'error': 'No file uploaded'}), 400
     file = request.files['file']
@@ -867,13 +1058,7 @@ def analyze_uploaded_image():
     最后，请将上述分析汇总为一段连贯的、高质量的中文Prompt描述。
     """
 
-    config = None
-    settings = db.get_settings()
-    for p in settings.get('providers', []):
-        if p.get('type') == 'aliyun' and p.get('enabled', True):
-            config = p
-            break
-    
+    config = db.find_provider('aliyun')
     if not config: return jsonify({'success': False, 'error': 'No Aliyun provider configuration found.'}), 400
     
     result = ai_service.run_visual_analysis(image_abs_path, VISUAL_STYLE_PROMPT, config, media_mgr)
@@ -888,7 +1073,7 @@ def analyze_uploaded_image():
         return jsonify(result), 500
 
 from task_queue import queue
-from async_bridge import context_runner
+from async_bridge import service_runner
 
 @app.route('/api/async/generate/fusion_image', methods=['POST'])
 def async_fusion_image():
@@ -903,7 +1088,7 @@ def async_fusion_image():
         print(f"💾 [后台] 已更新融图 {fid} 的 {field}")
 
     queue.submit(
-        context_runner, app, generate_fusion_image, data, save_logic,
+        service_runner, gen_service.generate_fusion_image, data, save_logic,
         desc=f"融图生成 ({fid})"
     )
     return jsonify({"success": True, "status": "queued"})
@@ -917,7 +1102,7 @@ def async_scene_image():
     save_logic = lambda res: db.update_shot(pid, sid, {'scene_image': res['url']})
 
     queue.submit(
-        context_runner, app, generate_scene_image, data, save_logic,
+        service_runner, gen_service.generate_scene_image, data, save_logic,
         desc=f"场景图生成 ({sid})"
     )
     return jsonify({"success": True, "status": "queued"})
@@ -931,7 +1116,7 @@ def async_fusion_video():
     save_logic = lambda res: db.update_fusion(pid, fid, {'video_url': res['url']})
 
     queue.submit(
-        context_runner, app, generate_fusion_video, data, save_logic,
+        service_runner, gen_service.generate_fusion_video, data, save_logic,
         desc=f"视频生成 ({fid})"
     )
     return jsonify({"success": True, "status": "queued"})
@@ -948,7 +1133,7 @@ def async_character_views():
             print(f"💾 [后台] 已更新角色 {cid} 的 image_url")
 
     queue.submit(
-        context_runner, app, generate_character_views, data, save_logic,
+        service_runner, gen_service.generate_character_views, data, save_logic,
         desc=f"角色设计图 ({cid})"
     )
     return jsonify({"success": True, "status": "queued"})
@@ -965,7 +1150,7 @@ def async_scene_prompt():
             print(f"📝 [后台] 已更新场景 {sid} 的提示词")
 
     queue.submit(
-        context_runner, app, generate_scene_prompt, data, save_logic,
+        service_runner, gen_service.generate_scene_prompt, data, save_logic,
         desc=f"场景提示词 ({sid})"
     )
     return jsonify({"success": True, "status": "queued"})
@@ -985,7 +1170,7 @@ def async_fusion_prompt():
             print(f"📝 [后台] 已更新融图 {fid} 的提示词")
 
     queue.submit(
-        context_runner, app, generate_fusion_prompt, data, save_logic,
+        service_runner, gen_service.generate_fusion_prompt, data, save_logic,
         desc=f"融图提示词 ({fid})"
     )
     return jsonify({"success": True, "status": "queued"})
@@ -996,45 +1181,8 @@ def async_fusion_prompt():
 
 @app.route('/api/generate/grid_prompt', methods=['POST'])
 def generate_grid_prompt():
-    """
-    生成用于 9宫格 角色动作分镜的 Prompt
-    """
-    data = request.json
-    config = db.get_provider_config(data.get('provider_id'))
-    if data.get('model_name'): config['model_name'] = data.get('model_name')
-    
-    # 构造 Prompt
-    # 核心是将 scene_description, visual_description, characters 结合
-    # 要求生成一个 3x3 grid 的描述
-    
-    scene_desc = data.get('scene_description', '')
-    shot_desc = data.get('shot_description', '')
-    char_names = data.get('character_names', []) # list of names
-    
-    sys_prompt = """
-    你是一位资深分镜师。请根据输入生成一段用于 AI 绘画的英文 Prompt。
-    
-    【目标】生成一张 **3x3 分镜九宫格 (9-panel storyboard grid)**，展示角色在特定场景中的连续动作或不同景别。
-    
-    【格式要求】
-    必须用中文回答. 
-    结果: "一种 3×3 的分镜网格布局。【场景与灯光】。【角色】的连续性动作：【动作描述】。呈现【细节】的关键帧画面"
-    
-    请确保 Prompt 强调 "9 格画面", "形象连贯的角色", "顺序叙事逻辑".
-    """
-    
-    user_prompt = f"""
-    场景：{scene_desc}
-    动作：{shot_desc}
-    角色：{', '.join(char_names)}
-    """
-    
-    result = ai_service.run_text_generation(
-        [{'role': 'system', 'content': sys_prompt}, {'role': 'user', 'content': user_prompt}], 
-        config
-    )
-    
-    return jsonify({'success': True, 'prompt': result['content']}) if result.get('success') else (jsonify({'success': False}), 500)
+    payload, status = gen_service.generate_grid_prompt(request.json)
+    return jsonify(payload), status
 
 @app.route('/api/async/generate/grid_prompt', methods=['POST'])
 def async_grid_prompt():
@@ -1049,7 +1197,7 @@ def async_grid_prompt():
             print(f"📝 [后台] 已更新分镜 {sid} 的九宫格提示词")
 
     queue.submit(
-        context_runner, app, generate_grid_prompt, data, save_logic,
+        service_runner, gen_service.generate_grid_prompt, data, save_logic,
         desc=f"九宫格提示词 ({sid})"
     )
     return jsonify({"success": True, "status": "queued"})
@@ -1062,89 +1210,22 @@ def async_shot_video():
     pid = data.get('project_id')
     sid = data.get('shot_id')
 
-    # 复用 fusion_video 的生成逻辑，但 save_logic 指向 update_shot
+    # 生成逻辑在 service 层，save_logic 指向 update_shot
     def save_logic(result):
         if result.get('url'):
             db.update_shot(pid, sid, {'video_url': result['url']})
             print(f"🎬 [后台] 已更新分镜 {sid} 的视频文件")
 
-    # 构造 generate_fusion_video 所需的数据结构
-    # 因为 generate_fusion_video 内部会通过 db.get_fusion 获取数据，
-    # 这里我们可能需要一个新的逻辑函数或对 existing 逻辑做简单适配。
-    # 为了保持代码简洁，我们直接提交一个特定的执行任务
-    
-    def task_wrapper(params):
-        # 内部构造调用逻辑，适配 shot 对象
-        shot = db.get_shot(pid, sid)
-        if not shot: return {'success': False, 'error': 'Shot not found'}
-        
-        s_url = shot.get('grid_image') or shot.get('scene_image')
-        if not s_url: return {'success': False, 'error': 'No reference image'}
-        
-        s_path = media_mgr.get_absolute_path(s_url)
-        config = db.get_provider_config(params.get('provider_id'))
-        if params.get('model_name'): config['model_name'] = params.get('model_name')
-        
-        prompt_text = shot.get('video_prompt') or "high quality cinematic video"
-        
-        return ai_service.run_video_generation(
-            prompt_text, s_path, None, config, media_mgr, entity_id=sid
-        )
-
     queue.submit(
-        task_wrapper, data, save_logic,
+        service_runner, gen_service.generate_shot_video, data, save_logic,
         desc=f"分镜视频生成 ({sid})"
     )
     return jsonify({"success": True, "status": "queued"})
 
 @app.route('/api/generate/grid_image', methods=['POST'])
 def generate_grid_image():
-    """
-    生成 9宫格 图片
-    使用 run_fusion_generation (Image-to-Image) 或 run_simple_image_generation (Text-to-Image)
-    这里假设使用 Image-to-Image，将 Scene Image 作为 Base，或者 Text-to-Image 仅用 Prompt
-    根据用户需求 "将底图和人物列表作为融图的素材"，最好是 Image-to-Image (ControlNet or Ref)
-    但为了简化，我们复用 run_fusion_generation 的逻辑，将 Scene Image 设为 Base Image
-    """
-    data = request.json
-    config = db.get_provider_config(data.get('provider_id'))
-    if data.get('model_name'): config['model_name'] = data.get('model_name')
-    
-    shot_id = data.get('shot_id')
-    # 这里的 grid_prompt 应该是上面生成的 "A 3x3 storyboard grid..."
-    prompt = data.get('grid_prompt') 
-    
-    # 获取底图路径
-    base_image_url = data.get('base_image_url')
-    base_image_path = media_mgr.get_absolute_path(base_image_url) if base_image_url else None
-    
-    # 获取角色图路径列表
-    # character_images: list of urls
-    element_paths = []
-    for url in data.get('character_images', []):
-        if url:
-            element_paths.append(media_mgr.get_absolute_path(url))
-            
-    # 调用 AI Service
-    # 如果有 base_image, 倾向于使用 fusion 生成 (img2img / controlnet)
-    # 否则使用 simple generation (txt2img)
-    if base_image_path:
-        result = ai_service.run_fusion_generation(
-            base_image_path=base_image_path,
-            fusion_prompt=prompt,
-            config=config,
-            media_manager=media_mgr,
-            element_image_paths=element_paths,
-            entity_id=shot_id
-        )
-    else:
-        # Fallback to text-to-image if no scene image
-        result = ai_service.run_simple_image_generation(
-            prompt, config, media_mgr, entity_id=shot_id
-        )
-        
-    return jsonify({'success': True, 'url': result['url']}) if result.get('success') else (jsonify({'success': False, 'error': result.get('error_msg')}), 500)
-
+    payload, status = gen_service.generate_grid_image(request.json)
+    return jsonify(payload), status
 
 @app.route('/api/async/generate/grid_image', methods=['POST'])
 def async_grid_image():
@@ -1158,41 +1239,15 @@ def async_grid_image():
             print(f"💾 [后台] 已更新分镜 {sid} 的 9宫格图")
 
     queue.submit(
-        context_runner, app, generate_grid_image, data, save_logic,
+        service_runner, gen_service.generate_grid_image, data, save_logic,
         desc=f"九宫格生成 ({sid})"
     )
     return jsonify({"success": True, "status": "queued"})
 
 @app.route('/api/generate/video_prompt', methods=['POST'])
 def generate_video_prompt():
-    data = request.json
-    config = db.get_provider_config(data.get('provider_id'))
-    if data.get('model_name'): config['model_name'] = data.get('model_name')
-    
-    scene_desc = data.get('scene_description', '')
-    shot_desc = data.get('shot_description', '')
-    
-    # todo 提示词还需要修改适配9宫格
-    sys_prompt = """
-    你是一位专业的视频生成提示词专家。请根据场景和画面描述，生成一段用于 AI 视频生成的中文 Prompt。
-    
-    【要求】
-    1. 必须是中文。
-    2. 重点描述 **动态 (Motion)**：包括运镜 (Camera Movement)、角色动作 (Subject Action)、环境动态 (Environmental Motion like wind, rain, light changes)。
-    3. 格式建议: "[Subject & Action]. [Environment & Atmosphere]. [Camera Movement]. [Style]"
-    """
-    
-    user_prompt = f"""
-    场景描述：{scene_desc}
-    分镜画面：{shot_desc}
-    """
-    
-    result = ai_service.run_text_generation(
-        [{'role': 'system', 'content': sys_prompt}, {'role': 'user', 'content': user_prompt}], 
-        config
-    )
-    
-    return jsonify({'success': True, 'prompt': result['content']}) if result.get('success') else (jsonify({'success': False}), 500)
+    payload, status = gen_service.generate_video_prompt(request.json)
+    return jsonify(payload), status
 
 @app.route('/api/async/generate/video_prompt', methods=['POST'])
 def async_video_prompt():
@@ -1207,16 +1262,180 @@ def async_video_prompt():
             print(f"📝 [后台] 已更新分镜 {sid} 的视频提示词")
 
     queue.submit(
-        context_runner, app, generate_video_prompt, data, save_logic,
+        service_runner, gen_service.generate_video_prompt, data, save_logic,
         desc=f"视频提示词 ({sid})"
     )
     return jsonify({"success": True, "status": "queued"})
 
 
+# ----------------------------------------------------
+# 分镜生产流水线 (DAG)
+# 场景提示词 → 场景图 → 融图提示词 → 首帧/尾帧 → 视频
+# ----------------------------------------------------
+from pipeline import Pipeline, PipelineScheduler
+
+pipeline_scheduler = PipelineScheduler(queue, db)
+
+def _find_shot_fusion(pid, shot_id):
+    return next((f for f in db.get_fusions(pid) if f.get('shot_id') == shot_id), None)
+
+def _base_follows_scene(fusion, shot_id):
+    """底图为空、或仍是之前同步的 (该分镜生成的) 场景图时跟随场景图更新；用户另选的底图保持不变"""
+    base = fusion.get('base_image')
+    if not base or base == fusion.get('base_scene_image'): return True
+    # 记录同步来源之前创建的融图：场景图以分镜 id 为实体 id 保存 ({shot_id}_v{n}.png)
+    match = media_mgr.VERSION_PATTERN.match(os.path.basename(base.split('?')[0]))
+    return bool(match) and match.group(1) == shot_id
+
+def _ensure_shot_fusion(pid, shot_id):
+    """流水线以分镜为单位，融图任务不存在时按分镜信息自动创建，底图取场景图并随场景图重新生成而更新"""
+    shot = db.get_shot(pid, shot_id)
+    scene_image = shot.get('scene_image', '')
+    fusion = _find_shot_fusion(pid, shot_id)
+    if not fusion:
+        fusion = db.create_fusion(pid, {
+            'scene': shot.get('scene', ''), 'shot_number': shot.get('shot_number', ''),
+            'shot_id': shot_id, 'base_image': scene_image, 'base_scene_image': scene_image,
+            'scene_description': shot.get('scene_description', ''),
+            'visual_description': shot.get('visual_description', ''),
+            'dialogue': shot.get('dialogue', ''), 'audio_description': shot.get('audio_description', ''),
+            'shot_size': shot.get('shot_size', '')
+        })
+    elif scene_image and fusion.get('base_image') != scene_image and _base_follows_scene(fusion, shot_id):
+        fusion = db.update_fusion(pid, fusion['id'], {'base_image': scene_image, 'base_scene_image': scene_image})
+    return fusion
+
+def _element_mapping(fusion):
+    mapping = "\n".join(f"图{i+1}: {e.get('name', '')}" for i, e in enumerate(fusion.get('elements', [])))
+    if fusion.get('base_image'): mapping += "\n底图: Background"
+    return mapping
+
+def build_shot_pipeline(pipeline, pid, shot_id, params):
+    """
+    把 "生产一个分镜" 展开为带依赖的阶段节点
+    params: text/image/fusion/video 各自的 provider_id 与 model_name
+    """
+    project_info = db.get_project(pid) or {}
+    text_cfg = {'provider_id': params.get('text_provider_id'), 'model_name': params.get('text_model_name')}
+    image_cfg = {'provider_id': params.get('image_provider_id'), 'model_name': params.get('image_model_name')}
+    fusion_cfg = {'provider_id': params.get('fusion_provider_id') or params.get('image_provider_id'),
+                  'model_name': params.get('fusion_model_name') or params.get('image_model_name')}
+    video_cfg = {'provider_id': params.get('video_provider_id'), 'model_name': params.get('video_model_name')}
+
+    shot = lambda: db.get_shot(pid, shot_id) or {}
+    fusion = lambda: _find_shot_fusion(pid, shot_id) or {}
+    key = lambda stage: f"{shot_id}:{stage}"
+
+    def scene_prompt():
+        data = {**text_cfg, 'project_id': pid, 'scene_description': shot().get('scene_description')}
+        service_runner(gen_service.generate_scene_prompt, data,
+                       lambda res: db.update_shot(pid, shot_id, {'scene_prompt': res['prompt']}))
+
+    def scene_image():
+        data = {**image_cfg, 'project_id': pid, 'scene_id': shot_id, 'scene_prompt': shot().get('scene_prompt')}
+        service_runner(gen_service.generate_scene_image, data,
+                       lambda res: db.update_shot(pid, shot_id, {'scene_image': res['url']}))
+
+    def fusion_prompt():
+        f = _ensure_shot_fusion(pid, shot_id)
+        s = shot()
+        data = {**text_cfg, 'project_id': pid, 'element_mapping': _element_mapping(f),
+                'scene_description': s.get('scene_description'), 'shot_description': s.get('visual_description')}
+        def save_logic(res):
+            db.update_fusion(pid, f['id'], {'fusion_prompt': res['prompt'], 'end_frame_prompt': res.get('end_frame_prompt', '')})
+        service_runner(gen_service.generate_fusion_prompt, data, save_logic)
+
+    def fusion_image(field, prompt_field):
+        def run():
+            f = _ensure_shot_fusion(pid, shot_id)
+            data = {**fusion_cfg, 'project_id': pid, 'fusion_id': f.get('id'), 'fusion_prompt': f.get(prompt_field)}
+            service_runner(gen_service.generate_fusion_image, data,
+                           lambda res: db.update_fusion(pid, f['id'], {field: res['url']}))
+        return run
+
+    def fusion_video():
+        f = fusion()
+        data = {**video_cfg, 'project_id': pid, 'fusion_id': f.get('id')}
+        service_runner(gen_service.generate_fusion_video, data,
+                       lambda res: db.update_fusion(pid, f['id'], {'video_url': res['url']}))
+
+    label = f"场{shot().get('scene', '?')}-镜{shot().get('shot_number', '?')}"
+    pipeline.add_node(
+        key('scene_prompt'), scene_prompt, desc=f"{label} 场景提示词",
+        inputs=lambda: [shot().get('scene_description'), project_info.get('visual_color_system'),
+                        project_info.get('script_emotional_keywords'), text_cfg],
+        output=lambda: shot().get('scene_prompt'))
+    pipeline.add_node(
+        key('scene_image'), scene_image, deps=[key('scene_prompt')], desc=f"{label} 场景图",
+        inputs=lambda: [shot().get('scene_prompt'), image_cfg],
+        output=lambda: shot().get('scene_image'))
+    pipeline.add_node(
+        key('fusion_prompt'), fusion_prompt, deps=[key('scene_image')], desc=f"{label} 融图提示词",
+        inputs=lambda: [_element_mapping(fusion()), shot().get('scene_image'), shot().get('scene_description'),
+                        shot().get('visual_description'), project_info.get('visual_color_system'), text_cfg],
+        output=lambda: fusion().get('fusion_prompt'))
+    pipeline.add_node(
+        key('start_frame'), fusion_image('result_image', 'fusion_prompt'), deps=[key('fusion_prompt')],
+        desc=f"{label} 首帧",
+        inputs=lambda: [fusion().get('fusion_prompt'), shot().get('scene_image'), fusion().get('base_image'),
+                        fusion().get('elements'), fusion_cfg],
+        output=lambda: fusion().get('result_image'))
+    pipeline.add_node(
+        key('end_frame'), fusion_image('end_frame_image', 'end_frame_prompt'), deps=[key('fusion_prompt')],
+        desc=f"{label} 尾帧",
+        inputs=lambda: [fusion().get('end_frame_prompt'), shot().get('scene_image'), fusion().get('base_image'),
+                        fusion().get('elements'), fusion_cfg],
+        output=lambda: fusion().get('end_frame_image'))
+    pipeline.add_node(
+        key('video'), fusion_video, deps=[key('start_frame'), key('end_frame')], desc=f"{label} 视频",
+        inputs=lambda: [fusion().get('fusion_prompt'), fusion().get('result_image'), fusion().get('end_frame_image'), video_cfg],
+        output=lambda: fusion().get('video_url'))
+
+@app.route('/api/pipeline/produce_shots', methods=['POST'])
+def produce_shots():
+    """
+    一键生产分镜：每个分镜展开为依赖链，不同分镜之间并行
+    body: { project_id, shot_ids (为空则整集), text_provider_id, image_provider_id, fusion_provider_id, video_provider_id, *_model_name }
+    """
+    data = request.json
+    pid = data.get('project_id')
+    if not db.get_project(pid): return jsonify({"error": "Project not found"}), 404
+
+    shot_ids = data.get('shot_ids') or [s['id'] for s in db.get_shots(pid)]
+    shot_ids = [sid for sid in shot_ids if db.get_shot(pid, sid)]
+    if not shot_ids: return jsonify({"error": "No shots to produce"}), 400
+
+    pipeline = Pipeline(pid, desc=data.get('desc') or f"分镜生产 ({len(shot_ids)} 镜)")
+    for sid in shot_ids:
+        build_shot_pipeline(pipeline, pid, sid, data)
+    pipeline_scheduler.submit(pipeline)
+    return jsonify({"success": True, "pipeline_id": pipeline.id, "status": "queued"})
+
+@app.route('/api/pipelines', methods=['GET'])
+def get_pipelines():
+    return jsonify(pipeline_scheduler.get_list())
+
+@app.route('/api/pipelines/<pipeline_id>', methods=['GET'])
+def get_pipeline(pipeline_id):
+    pipeline = pipeline_scheduler.get(pipeline_id)
+    return jsonify(pipeline.to_dict()) if pipeline else (jsonify({"error": "Not found"}), 404)
+
+@app.route('/api/pipelines/<pipeline_id>/retry', methods=['POST'])
+def retry_pipeline(pipeline_id):
+    pipeline = pipeline_scheduler.retry(pipeline_id)
+    return jsonify(pipeline.to_dict()) if pipeline else (jsonify({"error": "Not found"}), 404)
+
 @app.route('/api/tasks', methods=['GET'])
 def get_tasks():
     return jsonify(queue.get_list())
 
+@app.route('/api/tasks/<tid>/trace', methods=['GET'])
+def get_task_trace(tid):
+    """任务的 span 树 (最近 TRACE_BUFFER_SIZE 个任务)，?format=otlp 返回 OTLP/JSON"""
+    trace = tracing.buffer.get(tid)
+    if not trace: return jsonify({"error": "Not found"}), 404
+    return jsonify(trace.to_otlp() if request.args.get('format') == 'otlp' else trace.to_dict())
+
 @app.route('/api/tasks/<tid>', methods=['DELETE'])
 def delete_task(tid):
     if tid in queue.tasks: 
@@ -0,0 +1,294 @@
+# media_gc.py
+import os
+import re
+import json
+import time
+import logging
+import threading
+from collections import Counter
+from datetime import datetime
+
+import metrics
+from media_manager import DERIVATIVE_SIZES
+
+logger = logging.getLogger("MediaGC")
+
+# 孤立媒体回收 (标记-清除)：
+# - 标记：扫描所有项目 json 文档 (分镜/融图/角色/剧本/剧集封面等)，收集其中引用的 /static/... 文件与仍存在的实体 id
+# - 清除：imgs / videos / audio 下未被引用的文件，满足保留策略之外的才删除
+#   * 仍存在的实体 (分镜/角色等) 保留最近 GC_KEEP_VERSIONS 个版本，供历史面板回退
+#   * 修改时间在 GC_MIN_AGE_HOURS 内的文件一律保留 (生成中/刚上传还没写回文档的)
+#   * 已删除实体 (包括 analysis_* 临时分析图) 的文件不受版本保留限制
+# - 顺带清理：原图已删除的缩略图、没有任何文件引用的 blob、残留的 .part / 上传临时文件
+# 分批处理并在批次之间让出 (eventlet 下不阻塞请求)；多个 gunicorn worker 通过锁文件保证同时只有一个在回收
+GC_KEEP_VERSIONS = int(os.getenv('GC_KEEP_VERSIONS', 3))
+GC_MIN_AGE_HOURS = float(os.getenv('GC_MIN_AGE_HOURS', 24))
+GC_INTERVAL_HOURS = float(os.getenv('GC_INTERVAL_HOURS', 24))   # 0 关闭定时回收，仍可通过接口手动触发
+GC_BATCH_SIZE = int(os.getenv('GC_BATCH_SIZE', 200))
+GC_STATE_FILE = "data/media_gc.json"
+GC_LOCK_FILE = "data/media_gc.lock"
+GC_LOCK_STALE_SECONDS = 6 * 3600
+
+
+
+class MediaGarbageCollector:
+    def __init__(self, db, media_mgr, state_file=GC_STATE_FILE, lock_file=GC_LOCK_FILE):
+        self.db = db
+        self.media_mgr = media_mgr
+        self.state_file = state_file
+        self.lock_file = lock_file
+        self._thread = None
+        # 文档中引用的媒体 URL：/static/imgs/xxx.png 等 (只取路径部分，忽略 ?t= 之类的查询串)
+        dirs = '|'.join(re.escape(media_mgr.dirs[t]) for t in media_mgr.INDEXED_TYPES)
+        self._url_pattern = re.compile(r'/static/(' + dirs + r')/([^"\\?#\s/]+)')
+
+    # --- 标记 ---
+    def _mark(self):
+        """
+        返回 (被引用的 (子目录, 文件名) 集合, 仍存在的实体 id 集合)；
+        任何文档读取或解析失败都抛出异常放弃本轮 (漏掉引用会误删仍在使用的文件)
+        """
+        referenced, live_ids = set(), set()
+        try:
+            for i, document in enumerate(self.db.iter_documents()):
+                self._collect(document, referenced, live_ids)
+                if i % 20 == 19: time.sleep(0)
+        except (OSError, ValueError) as e:
+            raise RuntimeError(f"媒体回收已放弃：项目文档读取失败 ({e})") from e
+        return referenced, live_ids
+
+    def _collect(self, node, referenced, live_ids):
+        """遍历文档，收集所有字符串中的媒体 URL 和 id 字段"""
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, dict):
+                eid = node.get('id')
+                # 与 _generate_versioned_filename 一致的清洗规则，才能和文件名中的实体 id 对上
+                if isinstance(eid, str): live_ids.add(re.sub(r'[^a-zA-Z0-9_-]', '', eid))
+                stack.extend(node.values())
+            elif isinstance(node, list):
+                stack.extend(node)
+            elif isinstance(node, str) and '/static/' in node:
+                referenced.update(self._url_pattern.findall(node))
+
+    # --- 清除 ---
+    def _candidates(self, referenced, live_ids, now, report):
+        """按保留策略挑出要删除的文件 [(media_type, filename, path, stat), ...]"""
+        min_age = GC_MIN_AGE_HOURS * 3600
+        saved_times = self.media_mgr.saved_times()
+        doomed = []
+        for media_type in self.media_mgr.INDEXED_TYPES:
+            sub_dir = self.media_mgr.dirs[media_type]
+            directory = self.media_mgr._get_directory(media_type)
+            entities = {}
+            for filename in os.listdir(directory):
+                path = os.path.join(directory, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if filename.startswith('.'):
+                    # 中断的上传/下载留下的临时文件
+                    if filename.endswith('.part') and now - st.st_mtime > min_age:
+                        doomed.append((media_type, filename, path, st))
+                    continue
+                report['scanned'] += 1
+                match = self.media_mgr.VERSION_PATTERN.match(filename)
+                entity_id, version = (match.group(1), int(match.group(2))) if match else (os.path.splitext(filename)[0], 0)
+                entities.setdefault(entity_id, []).append((version, filename, path, st))
+
+            for entity_id, files in entities.items():
+                files.sort(key=lambda f: f[0], reverse=True)
+                keep_latest = GC_KEEP_VERSIONS if entity_id in live_ids else 0
+                for rank, (version, filename, path, st) in enumerate(files):
+                    # 去重的文件是旧 blob 的硬链接，mtime 可能很旧，以索引记录的保存时间为准
+                    saved_at = max(st.st_mtime, saved_times.get(self.media_mgr._get_web_path(media_type, filename), 0))
+                    if (sub_dir, filename) in referenced:
+                        report['referenced'] += 1
+                    elif rank < keep_latest:
+                        report['kept_versions'] += 1
+                    elif now - saved_at < min_age:
+                        report['kept_recent'] += 1
+                    else:
+                        doomed.append((media_type, filename, path, st))
+            time.sleep(0)
+        return doomed
+
+    @staticmethod
+    def _remove(path, st, dry_run):
+        """删除一个文件，返回释放的字节数 (仍有其他硬链接时内容没有真正释放，记 0)"""
+        if not dry_run: os.remove(path)
+        return st.st_size if st.st_nlink <= 1 else 0
+
+    def _sweep_files(self, doomed, dry_run, report):
+        deleted_urls = []
+        # dry_run 估算：同一内容 (inode) 除 blob 外的链接都要删除时，内容 (连同 blob) 会被释放
+        removals = Counter((st.st_dev, st.st_ino) for *_, st in doomed)
+        for i, (media_type, filename, path, st) in enumerate(doomed):
+            try:
+                if dry_run:
+                    key = (st.st_dev, st.st_ino)
+                    if removals.pop(key, 0) >= st.st_nlink - 1: report['bytes_freed'] += st.st_size
+                else:
+                    report['bytes_freed'] += self._remove(path, st, dry_run)
+                report['deleted'] += 1
+                if not filename.startswith('.'):
+                    deleted_urls.append(self.media_mgr._get_web_path(media_type, filename))
+            except OSError as e:
+                report['errors'] += 1
+                logger.warning(f"GC failed to delete {path}: {e}")
+            if i % GC_BATCH_SIZE == GC_BATCH_SIZE - 1: time.sleep(0.01)
+        if deleted_urls and not dry_run:
+            self.media_mgr.forget_files(deleted_urls)
+
+    def _sweep_derivatives(self, doomed, now, dry_run, report):
+        """原图已删除 (或本轮将删除) 的缩略图/预览图 ({原文件名}.{kind}.webp)"""
+        image_dir = self.media_mgr._get_directory('image')
+        thumb_dir = self.media_mgr._get_directory('thumb')
+        doomed_images = {filename for media_type, filename, _, _ in doomed if media_type == 'image'}
+        for i, filename in enumerate(os.listdir(thumb_dir)):
+            path = os.path.join(thumb_dir, filename)
+            if not filename.endswith('.webp'):
+                # 生成中的临时文件 ({派生图}.{pid}.tmp)，只清理中断后残留的
+                try:
+                    if now - os.stat(path).st_mtime < GC_MIN_AGE_HOURS * 3600: continue
+                except OSError:
+                    continue
+            else:
+                source = self._derivative_source(filename)
+                if source is None: continue
+                if source not in doomed_images and os.path.exists(os.path.join(image_dir, source)): continue
+            try:
+                report['bytes_freed'] += self._remove(path, os.stat(path), dry_run)
+                report['derivatives_deleted'] += 1
+            except OSError:
+                report['errors'] += 1
+            if i % GC_BATCH_SIZE == GC_BATCH_SIZE - 1: time.sleep(0.01)
+
+    @staticmethod
+    def _derivative_source(filename):
+        """x_v1.png.thumb.webp -> x_v1.png；原图本身是 .webp 时同样只去掉 .{kind}.webp 后缀"""
+        for kind in DERIVATIVE_SIZES:
+            suffix = f".{kind}.webp"
+            if filename.endswith(suffix): return filename[:-len(suffix)]
+        return None
+
+    def _sweep_blobs(self, dry_run, report):
+        """没有任何版本化文件 (或导出草稿) 链接的 blob"""
+        root = self.media_mgr._get_directory('blob')
+        for shard in os.listdir(root):
+            shard_dir = os.path.join(root, shard)
+            if not os.path.isdir(shard_dir): continue
+            for name in os.listdir(shard_dir):
+                path = os.path.join(shard_dir, name)
+                try:
+                    st = os.stat(path)
+                    if st.st_nlink > 1: continue
+                    report['bytes_freed'] += self._remove(path, st, dry_run)
+                    report['blobs_deleted'] += 1
+                except OSError:
+                    report['errors'] += 1
+            time.sleep(0)
+
+    def _sweep_uploads(self, now, dry_run, report):
+        """进程中途退出留下的上传临时文件 (正常请求结束时会自行删除)"""
+        directory = self.media_mgr._get_directory('upload')
+        for filename in os.listdir(directory):
+            path = os.path.join(directory, filename)
+            try:
+                st = os.stat(path)
+                if now - st.st_mtime < GC_MIN_AGE_HOURS * 3600: continue
+                report['bytes_freed'] += self._remove(path, st, dry_run)
+                report['deleted'] += 1
+            except OSError:
+                report['errors'] += 1
+
+    def run(self, dry_run=False, progress_callback=None):
+        """执行一轮完整回收，返回报告 (bytes_freed 为实际释放的磁盘空间)"""
+        started = time.time()
+        report = {'started': datetime.fromtimestamp(started).isoformat(), 'dry_run': dry_run,
+                  'scanned': 0, 'referenced': 0, 'kept_versions': 0, 'kept_recent': 0,
+                  'deleted': 0, 'derivatives_deleted': 0, 'blobs_deleted': 0, 'bytes_freed': 0, 'errors': 0}
+
+        def progress(value, stage):
+            if progress_callback: progress_callback(value, stage=stage)
+
+        progress(5, 'mark')
+        referenced, live_ids = self._mark()
+        progress(30, 'scan')
+        doomed = self._candidates(referenced, live_ids, started, report)
+        progress(50, 'sweep')
+        self._sweep_files(doomed, dry_run, report)
+        progress(80, 'derivatives')
+        self._sweep_derivatives(doomed, started, dry_run, report)
+        # dry_run 时文件没有真正删除，blob 的链接数不会变化，这里统计的只是已经孤立的 blob
+        self._sweep_blobs(dry_run, report)
+        self._sweep_uploads(started, dry_run, report)
+
+        report['duration_s'] = round(time.time() - started, 2)
+        if not dry_run: metrics.MEDIA_GC_FREED_BYTES.inc(report['bytes_freed'])
+        logger.info(f"Media GC{' (dry run)' if dry_run else ''}: deleted {report['deleted']} files, "
+                    f"{report['derivatives_deleted']} derivatives, {report['blobs_deleted']} blobs, "
+                    f"freed {report['bytes_freed']} bytes in {report['duration_s']}s")
+        return report
+
+    # --- 多进程互斥 + 状态 ---
+    def _acquire(self):
+        try:
+            if time.time() - os.stat(self.lock_file).st_mtime > GC_LOCK_STALE_SECONDS:
+                os.remove(self.lock_file)   # 上次回收中途进程被杀留下的锁
+        except OSError:
+            pass
+        try:
+            os.close(os.open(self.lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            return False
+
+    def _release(self):
+        try:
+            os.remove(self.lock_file)
+        except OSError:
+            pass
+
+    def last_report(self):
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f: return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_report(self, report):
+        tmp_path = f"{self.state_file}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'last_run': time.time(), 'report': report}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.state_file)
+
+    def collect(self, dry_run=False, progress_callback=None):
+        """加锁执行一轮回收并记录结果；其他进程正在回收时返回 None"""
+        if not self._acquire():
+            logger.info("Media GC already running in another worker, skipped")
+            return None
+        try:
+            report = self.run(dry_run=dry_run, progress_callback=progress_callback)
+            if not dry_run: self._save_report(report)
+            return report
+        finally:
+            self._release()
+
+    # --- 定时回收 ---
+    def start(self, interval_hours=GC_INTERVAL_HOURS, check_seconds=600):
+        """后台线程定期检查，距上次回收超过 interval_hours 时执行一轮 (所有 worker 共享上次回收时间)"""
+        if interval_hours <= 0 or self._thread is not None: return
+
+        def loop():
+            while True:
+                time.sleep(check_seconds)
+                try:
+                    if time.time() - self.last_report().get('last_run', 0) >= interval_hours * 3600:
+                        self.collect()
+                except Exception as e:
+                    logger.error(f"Media GC failed: {e}")
+
+        self._thread = threading.Thread(target=loop, name="media-gc", daemon=True)
+        self._thread.start()
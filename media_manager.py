@@ -1,21 +1,227 @@
 import os
 import re
+import sys
 import uuid
 import mimetypes
 import logging
 import base64
+import json
+import hashlib
+import queue
+import atexit
+import threading
+import subprocess
 import requests
 from pathlib import Path
+from contextlib import contextmanager
 from urllib.parse import urlparse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
 import time
 
+import metrics
+import tracing
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None    # Windows 桌面版是单进程，进程内锁即可
+
+try:
+    from pymediainfo import MediaInfo
+    MEDIAINFO_AVAILABLE = True
+except ImportError:
+    MEDIAINFO_AVAILABLE = False
+
+MEDIA_INDEX_FILE = "data/media_index.json"
+PROBE_WORKERS = int(os.getenv('MEDIA_PROBE_WORKERS', 8))
+
+# 生成图片的 WebP 缩略图 (表格/历史列表) 与中等预览图 (点开大图)，URL 固定为
+#   /static/thumbs/{原文件名}.thumb.webp  /static/thumbs/{原文件名}.preview.webp
+# 解码/缩放是 CPU 密集操作，放在独立进程池里做，不占用 Web 进程
+DERIVATIVE_SIZES = {
+    'thumb': int(os.getenv('THUMB_SIZE', 320)),
+    'preview': int(os.getenv('PREVIEW_SIZE', 1280)),
+}
+DERIVATIVE_QUALITY = int(os.getenv('DERIVATIVE_QUALITY', 80))
+DERIVATIVE_WORKERS = int(os.getenv('DERIVATIVE_WORKERS', min(2, os.cpu_count() or 1)))
+DERIVATIVE_SOURCE_EXTS = ('.png', '.jpg', '.jpeg', '.webp', '.bmp')
+
+# 内容寻址存储：每份内容只在 static/.blobs/{sha256[:2]}/{sha256} 存一次，
+# 版本化文件 ({entity}_v{N}.ext) 是指向它的硬链接 (文件名/URL 不变)；不支持硬链接的文件系统退化为普通文件
+# file_to_base64 的结果按 inode 缓存，硬链接到同一内容的不同文件共享同一份编码
+BASE64_CACHE_BYTES = int(os.getenv('BASE64_CACHE_MB', 64)) * 1024 * 1024
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# 上传：multipart 解析时文件直接流式写入 static/.uploads 下的临时文件 (不经 Werkzeug 的内存/系统临时目录缓冲)，
+# 边写边算 sha256 并记下文件头；保存时校验大小与文件头后改名入库，不再二次读写
+UPLOAD_LIMITS = {
+    'image': int(os.getenv('UPLOAD_MAX_IMAGE_MB', 30)) * 1024 * 1024,
+    'video': int(os.getenv('UPLOAD_MAX_VIDEO_MB', 1024)) * 1024 * 1024,
+    'audio': int(os.getenv('UPLOAD_MAX_AUDIO_MB', 200)) * 1024 * 1024,
+}
+UPLOAD_FORM_OVERHEAD = 64 * 1024    # multipart 边界与普通表单字段
+UPLOAD_HEADER_BYTES = 64
+
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger("MediaManager")
 
+def _render_derivatives(src_path, targets, quality=DERIVATIVE_QUALITY):
+    """
+    (在 worker 子进程中执行) 从原图生成各尺寸的 WebP，targets: [(目标路径, 最长边), ...]，由大到小生成
+    先写临时文件再 rename，前端不会读到半张图；返回写出的字节数
+    """
+    from PIL import Image
+    written = 0
+    with Image.open(src_path) as im:
+        im.draft('RGB', (max(size for _, size in targets),) * 2)   # JPEG 可直接按比例解码，省掉大部分解码开销
+        im = im.convert('RGBA' if im.mode in ('RGBA', 'LA', 'P') else 'RGB')
+        for dest, size in sorted(targets, key=lambda t: -t[1]):
+            im.thumbnail((size, size), Image.LANCZOS)
+            tmp_path = f"{dest}.{os.getpid()}.tmp"
+            im.save(tmp_path, 'WEBP', quality=quality, method=4)
+            os.replace(tmp_path, dest)
+            written += os.path.getsize(dest)
+    return written
+
+# 可在 worker 子进程中执行的函数 (按名字调用)
+WORKER_FUNCTIONS = {'_render_derivatives': _render_derivatives}
+
+class SubprocessPool:
+    """
+    常驻子进程池 (接口同 Executor.submit)，每个 worker 是一个独立的 `python media_manager.py --worker` 进程，
+    经 stdin/stdout 逐行收发 JSON
+    不用 multiprocessing：eventlet 下 fork 出的子进程会带着父进程的全部协程 (会抢读父进程的网络连接)，
+    spawn 则会在子进程里重新执行 main.py。父进程退出时子进程读到 EOF 自行退出
+    """
+    def __init__(self, workers):
+        self._jobs = queue.Queue()
+        self._threads = [threading.Thread(target=self._run, name=f"subprocess-pool-{i}", daemon=True) for i in range(workers)]
+        for t in self._threads: t.start()
+
+    def submit(self, func, *args):
+        future = Future()
+        self._jobs.put((future, func.__name__, args))
+        return future
+
+    def _spawn(self):
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__), '--worker'],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, encoding='utf-8')
+
+    def _run(self):
+        proc = None
+        while True:
+            job = self._jobs.get()
+            if job is None: break
+            future, name, args = job
+            if not future.set_running_or_notify_cancel(): continue
+            try:
+                if proc is None or proc.poll() is not None: proc = self._spawn()
+                proc.stdin.write(json.dumps([name, args], ensure_ascii=False) + '\n')
+                proc.stdin.flush()
+                line = proc.stdout.readline()
+                if not line: raise RuntimeError(f"worker process exited with {proc.wait()}")
+                reply = json.loads(line)
+            except Exception as e:
+                # 子进程崩溃 (OOM 等)：本任务失败，下一个任务重新拉起
+                if proc is not None and proc.poll() is None: proc.kill()
+                proc = None
+                future.set_exception(e)
+                continue
+            if 'error' in reply: future.set_exception(RuntimeError(reply['error']))
+            else: future.set_result(reply['result'])
+        if proc is not None:
+            proc.stdin.close()
+            proc.wait()
+
+    def shutdown(self, wait=True):
+        for _ in self._threads: self._jobs.put(None)
+        if wait:
+            for t in self._threads: t.join()
+
+def _worker_main():
+    """子进程入口：逐行读取 [函数名, 参数]，输出 {"result": ...} 或 {"error": ...}"""
+    for line in sys.stdin:
+        try:
+            name, args = json.loads(line)
+            reply = {'result': WORKER_FUNCTIONS[name](*args)}
+        except Exception as e:
+            reply = {'error': f"{type(e).__name__}: {e}"}
+        sys.stdout.write(json.dumps(reply, ensure_ascii=False) + '\n')
+        sys.stdout.flush()
+
+def sniff_media_type(header):
+    """按文件头 (magic bytes) 判断内容类型：'image' / 'video' / 'audio'，无法识别返回 None"""
+    if header.startswith((b'\x89PNG\r\n\x1a\n', b'\xff\xd8\xff', b'GIF87a', b'GIF89a', b'BM', b'II*\x00', b'MM\x00*')):
+        return 'image'
+    if header[:4] == b'RIFF':
+        return {b'WEBP': 'image', b'AVI ': 'video', b'WAVE': 'audio'}.get(header[8:12])
+    if header[4:8] == b'ftyp':
+        # ISO 媒体文件按品牌区分：HEIF/AVIF 图片、M4A 音频，其余 (isom/mp4x/qt/3gp...) 视为视频
+        brand = header[8:12]
+        if brand in (b'heic', b'heix', b'mif1', b'msf1', b'avif'): return 'image'
+        if brand in (b'M4A ', b'M4B '): return 'audio'
+        return 'video'
+    if header.startswith((b'\x1a\x45\xdf\xa3', b'FLV', b'\x00\x00\x01\xba', b'\x00\x00\x01\xb3')):
+        return 'video'
+    if header.startswith((b'ID3', b'OggS', b'fLaC')) or header[:2] in (b'\xff\xfb', b'\xff\xf3', b'\xff\xf2', b'\xff\xf1', b'\xff\xf9'):
+        return 'audio'
+    return None
+
+class UploadStream:
+    """
+    Werkzeug multipart 解析用的文件流 (Request._get_file_stream 返回)：
+    写入即落盘到 static/.uploads/ 下的临时文件 (与媒体目录同一文件系统，入库只需改名)，同时累计 sha256 / 大小 / 文件头
+    未被 claim 的临时文件在请求结束关闭时删除
+    """
+    def __init__(self, path):
+        self.path = path
+        self.size = 0
+        self.header = b''
+        self._hash = hashlib.sha256()
+        self._file = open(path, 'w+b', buffering=COPY_CHUNK_SIZE)
+        self._claimed = False
+
+    def write(self, data):
+        if len(self.header) < UPLOAD_HEADER_BYTES:
+            self.header += bytes(data[:UPLOAD_HEADER_BYTES - len(self.header)])
+        self._hash.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    def claim(self):
+        """写完后交给调用方处理 (关闭文件，之后由调用方改名或删除)，返回临时文件路径"""
+        self._file.close()
+        self._claimed = True
+        return self.path
+
+    def close(self):
+        self._file.close()
+        if not self._claimed:
+            self._claimed = True
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def __iter__(self):
+        return iter(self._file)
+
+    def __getattr__(self, name):
+        # read / readline / seek / tell / flush 等直接转给底层文件
+        return getattr(self._file, name)
+
+@metrics.instrument(metrics.MEDIA_IO_SECONDS, methods=('save_uploaded_file', 'download_from_url', 'save_binary', 'file_to_base64', 'probe_many', 'rebuild_index', 'scan_project_files'))
+@tracing.instrument('media', methods=('download_from_url', 'save_binary', 'file_to_base64'),
+                    names={'download_from_url': 'media.download', 'save_binary': 'media.save', 'file_to_base64': 'media.base64'})
 class MediaManager:
-    def __init__(self, static_folder="."):
+    def __init__(self, static_folder=".", index_file=MEDIA_INDEX_FILE):
         self.static_folder = static_folder
+        self.index_file = index_file
         
         # [修改] 去掉 'static/' 前缀
         # 因为传入的 self.static_folder 已经是 .../static 了
@@ -25,10 +231,36 @@ class MediaManager:
             'video': "videos",     # 原: "static/videos"
             'audio': "audio",      # 原: "static/audio"
             'export': "exports",   # 保持不变 (根据截图它在 static 目录下)
-            'temp': "temp"         # 原: "static/temp"
+            'temp': "temp",        # 原: "static/temp"
+            'thumb': "thumbs",     # 缩略图/预览图 (由 imgs 下的原图派生)
+            'blob': ".blobs",      # 内容寻址存储 (版本化文件的硬链接目标)
+            'upload': ".uploads"   # 上传中的临时文件
         }
         self._ensure_dirs()
 
+        # 媒体索引: { entity_id: [ {filename, url, media_type, version, size, mtime}, ... ] }
+        # 每次保存文件时增量更新，首次启动 (索引文件不存在) 时全量扫描重建一次
+        # 读取-修改-写回 在 _index_transaction 中进行 (进程内锁 + 跨 worker 文件锁)
+        self._index_lock = threading.RLock()
+        self._index_txn_depth = 0
+        self._index_stamp = None
+        self._index = self._load_index()
+
+        # 不在索引中的文件 (exports/temp 等) 的探测结果只做内存缓存: {(path, mtime): meta}
+        self._probe_cache = {}
+
+        # 派生图进程池在首次使用时才创建 (gunicorn 每个 worker 各自一个)；_pending 为正在生成的原图路径
+        self._derivative_pool = None
+        self._derivative_lock = threading.Lock()
+        self._pending_derivatives = set()
+        # 生成失败的原图 (损坏/不支持的格式) {路径: mtime_ns}，文件不变就不再反复提交
+        self._failed_derivatives = {}
+
+        # data URI 缓存: {(dev, inode, size, mtime_ns, mime): data_uri}，按总字节数 LRU 淘汰
+        self._base64_cache = OrderedDict()
+        self._base64_cache_bytes = 0
+        self._base64_lock = threading.Lock()
+
     def _ensure_dirs(self):
         """初始化目录结构"""
         for d in self.dirs.values():
@@ -62,30 +294,31 @@ class MediaManager:
         if not safe_id: # 如果清洗后为空
             return f"{uuid.uuid4()}{extension}"
 
-        # 匹配模式: entityId_v1.png, entityId_v2.mp4
-        # 注意：这里我们只匹配当前扩展名的文件版本，不同扩展名(如png和jpg)互不影响版本号
-        # 或者可以设计为忽略扩展名版本，这里采用匹配扩展名
-        pattern = re.compile(rf"^{re.escape(safe_id)}_v(\d+){re.escape(extension)}$")
-        
-        max_version = 0
-        if os.path.exists(directory):
-            for f in os.listdir(directory):
-                match = pattern.match(f)
-                if match:
-                    try:
-                        v = int(match.group(1))
-                        if v > max_version:
-                            max_version = v
-                    except ValueError:
-                        continue
-        
+        # 版本号从媒体索引中取，不再每次 listdir 整个目录
+        # 注意：这里只统计当前扩展名的文件版本，不同扩展名(如png和jpg)互不影响版本号
+        with self._index_lock:
+            self._refresh_index()
+            versions = [v['version'] for v in self._index.get(safe_id, [])
+                        if v['filename'] == f"{safe_id}_v{v['version']}{extension}"]
+        max_version = max(versions, default=0)
+
+        # 防御：索引落后于磁盘时 (例如外部拷贝进来的文件) 跳过已存在的文件名
+        while os.path.exists(os.path.join(directory, f"{safe_id}_v{max_version + 1}{extension}")):
+            max_version += 1
+
         new_version = max_version + 1
         return f"{safe_id}_v{new_version}{extension}"
 
     def get_absolute_path(self, relative_path):
         """将Web路径转换为绝对文件系统路径"""
         if not relative_path: return None
-        
+
+        # 0. 已经是 static 目录下的绝对路径 (service 层先转换过一次)，直接返回
+        #    否则在 Linux 上会被当成 Web 路径去掉开头的 / 再拼接一次
+        static_root = os.path.abspath(self.static_folder) + os.sep
+        if os.path.isabs(relative_path) and os.path.abspath(relative_path).startswith(static_root):
+            return os.path.abspath(relative_path)
+
         # 1. 去掉路径开头可能存在的 / 或 \
         clean_path = relative_path.lstrip('/\\')
         
@@ -105,8 +338,24 @@ class MediaManager:
         # 此时：.../dist/StoryboardAI/static + imgs/xxx.jpg
         return os.path.abspath(os.path.join(self.static_folder, clean_path))
 
+    def open_upload_stream(self):
+        """新建一个上传临时文件流 (供 Flask Request._get_file_stream 使用)"""
+        return UploadStream(os.path.join(self._get_directory('upload'), f"{uuid.uuid4().hex}.part"))
+
+    def _copy_upload(self, stream, tmp_path, limit):
+        """非 UploadStream 的文件对象：分块复制到临时文件，返回 (大小, sha256, 文件头)；超出大小限制立即中止"""
+        hasher, size, header = hashlib.sha256(), 0, b''
+        with open(tmp_path, 'wb') as f:
+            for chunk in iter(lambda: stream.read(COPY_CHUNK_SIZE), b''):
+                size += len(chunk)
+                if limit and size > limit: raise ValueError(f"File too large (limit {limit // (1024 * 1024)}MB)")
+                if len(header) < UPLOAD_HEADER_BYTES: header += chunk[:UPLOAD_HEADER_BYTES - len(header)]
+                hasher.update(chunk)
+                f.write(chunk)
+        return size, hasher.hexdigest(), header
+
     def save_uploaded_file(self, file_obj, media_type='image', entity_id=None):
-        """保存 Flask 上传的文件对象"""
+        """保存 Flask 上传的文件对象 (校验大小与文件头，内容不符的拒绝)"""
         if not file_obj or not file_obj.filename:
             return None, "No file provided"
         
@@ -118,13 +367,29 @@ class MediaManager:
         directory = self._get_directory(media_type)
         filename = self._generate_versioned_filename(directory, entity_id, ext)
         save_path = os.path.join(directory, filename)
+        limit = UPLOAD_LIMITS.get(media_type)
+        tmp_path = None
         
         try:
-            file_obj.save(save_path)
+            stream = file_obj.stream
+            if isinstance(stream, UploadStream):
+                tmp_path = stream.claim()
+                size, digest, header = stream.size, stream.hexdigest(), stream.header
+            else:
+                tmp_path = self._temp_path(save_path)
+                size, digest, header = self._copy_upload(stream, tmp_path, limit)
+            if limit and size > limit:
+                raise ValueError(f"File too large (limit {limit // (1024 * 1024)}MB)")
+            if media_type in UPLOAD_LIMITS and sniff_media_type(header) != media_type:
+                raise ValueError(f"File content is not a valid {media_type}")
+            metrics.MEDIA_BYTES.inc(size, method='save_uploaded_file')
+            digest = self._commit_file(tmp_path, digest, save_path)
             logger.info(f"Saved upload: {save_path}")
+            self._index_file_saved(media_type, filename, digest)
             return self._get_web_path(media_type, filename), None
         except Exception as e:
             logger.error(f"Upload save failed: {e}")
+            if tmp_path: self._discard(tmp_path)
             return None, str(e)
 
     def download_from_url(self, url, media_type='image', entity_id=None):
@@ -147,9 +412,21 @@ class MediaManager:
             
             resp = requests.get(url, stream=True, timeout=120)
             if resp.status_code == 200:
-                with open(save_path, 'wb') as f:
-                    for chunk in resp.iter_content(1024):
-                        f.write(chunk)
+                size = 0
+                hasher = hashlib.sha256()
+                tmp_path = self._temp_path(save_path)
+                try:
+                    with open(tmp_path, 'wb') as f:
+                        for chunk in resp.iter_content(64 * 1024):
+                            f.write(chunk)
+                            hasher.update(chunk)
+                            size += len(chunk)
+                    digest = self._commit_file(tmp_path, hasher.hexdigest(), save_path)
+                except Exception:
+                    self._discard(tmp_path)
+                    raise
+                metrics.MEDIA_BYTES.inc(size, method='download_from_url')
+                self._index_file_saved(media_type, filename, digest)
                 return self._get_web_path(media_type, filename)
             else:
                 logger.error(f"Download failed with status: {resp.status_code}")
@@ -171,12 +448,17 @@ class MediaManager:
         filename = self._generate_versioned_filename(directory, entity_id, extension)
         save_path = os.path.join(directory, filename)
         
+        tmp_path = self._temp_path(save_path)
         try:
-            with open(save_path, 'wb') as f:
+            with open(tmp_path, 'wb') as f:
                 f.write(binary_data)
+            metrics.MEDIA_BYTES.inc(len(binary_data), method='save_binary')
+            digest = self._commit_file(tmp_path, hashlib.sha256(binary_data).hexdigest(), save_path)
+            self._index_file_saved(media_type, filename, digest)
             return self._get_web_path(media_type, filename)
         except Exception as e:
             logger.error(f"Binary save failed: {e}")
+            self._discard(tmp_path)
             return None
 
     def file_to_base64(self, web_path_or_local_path):
@@ -198,74 +480,489 @@ class MediaManager:
         if not mime_type: mime_type = 'application/octet-stream'
         
         try:
+            st = os.stat(local_path)
+            key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, mime_type)
+            with self._base64_lock:
+                cached = self._base64_cache.get(key)
+                if cached is not None:
+                    self._base64_cache.move_to_end(key)
+                    return cached
             with open(local_path, "rb") as f:
-                base64_data = base64.b64encode(f.read()).decode('utf-8')
-            return f"data:{mime_type};base64,{base64_data}"
+                raw = f.read()
+            metrics.MEDIA_BYTES.inc(len(raw), method='file_to_base64')
+            base64_data = base64.b64encode(raw).decode('utf-8')
+            data_uri = f"data:{mime_type};base64,{base64_data}"
+            self._cache_base64(key, data_uri)
+            return data_uri
         except Exception as e:
             logger.error(f"Base64 conversion failed: {e}")
             return None
 
-    def scan_project_files(self, entity_map):
+    def _cache_base64(self, key, data_uri):
+        if len(data_uri) > BASE64_CACHE_BYTES // 4: return   # 超大文件 (视频) 不缓存
+        with self._base64_lock:
+            if key in self._base64_cache: return
+            self._base64_cache[key] = data_uri
+            self._base64_cache_bytes += len(data_uri)
+            while self._base64_cache_bytes > BASE64_CACHE_BYTES:
+                _, old = self._base64_cache.popitem(last=False)
+                self._base64_cache_bytes -= len(old)
+
+    # --- 内容寻址存储 (Content-Addressed Store) ---
+    @staticmethod
+    def _temp_path(save_path):
+        """与目标同目录的隐藏临时文件 (rename / 硬链接不跨文件系统，索引重建会跳过)"""
+        directory, filename = os.path.split(save_path)
+        return os.path.join(directory, f".{filename}.{uuid.uuid4().hex[:8]}.part")
+
+    @staticmethod
+    def _discard(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _hash_file(path):
+        hasher = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b''):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    def _blob_path(self, digest):
+        return os.path.join(self._get_directory('blob'), digest[:2], digest)
+
+    def _commit_file(self, tmp_path, digest, save_path):
         """
-        扫描整个项目相关的历史文件
-        :param entity_map: 字典 { entity_id: { 'name': 'xxx', 'type': 'character/scene/fusion' } }
+        把写完的临时文件落到 save_path，返回内容摘要：
+        - 内容已存在：save_path 硬链接到已有 blob，丢弃临时文件 (不占新空间)
+        - 新内容：临时文件登记为 blob 后改名为 save_path (两者同一 inode)
         """
-        history_items = []
-        
-        # 需要扫描的目录类型
-        target_types = ['image', 'video', 'audio']
-        
-        for media_type in target_types:
+        blob = self._blob_path(digest)
+        try:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            try:
+                os.link(tmp_path, blob)
+            except FileExistsError:
+                size = os.path.getsize(tmp_path)
+                os.remove(tmp_path)
+                os.link(blob, tmp_path)
+                metrics.MEDIA_DEDUP_BYTES.inc(size)
+                logger.info(f"Dedup hit {digest[:12]} -> {os.path.basename(save_path)} ({size} bytes reused)")
+        except OSError as e:
+            # 不支持硬链接 (部分 Windows / 网络文件系统)：直接作为普通文件保存
+            logger.debug(f"Content store unavailable, saving plain file: {e}")
+            if not os.path.exists(tmp_path): raise
+        os.replace(tmp_path, save_path)
+        return digest
+
+    def dedupe_existing(self, progress_callback=None):
+        """
+        把已有的 imgs/videos/audio 文件纳入内容寻址存储 (重复内容改为硬链接)，返回回收的空间
+        已是 blob 硬链接的文件 (链接数 > 1) 跳过，可重复执行
+        """
+        candidates = []
+        for media_type in self.INDEXED_TYPES:
             directory = self._get_directory(media_type)
-            if not os.path.exists(directory):
-                continue
-                
-            # 获取所有文件
-            files = os.listdir(directory)
-            
-            # 匹配文件名：ID_v版本.后缀 (例如: uuid123_v1.png)
-            # 或者 ID.后缀 (无版本号的也算v0或最新)
-            version_pattern = re.compile(r"^(.+?)_v(\d+)\.(.+)$")
-            
-            for f in files:
+            for f in os.listdir(directory):
+                path = os.path.join(directory, f)
+                if f.startswith('.') or not os.path.isfile(path): continue
+                if os.stat(path).st_nlink == 1: candidates.append(path)
+
+        linked, reclaimed = 0, 0
+        for i, path in enumerate(candidates):
+            try:
+                digest = self._hash_file(path)
+                blob = self._blob_path(digest)
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                if not os.path.exists(blob):
+                    os.link(path, blob)
+                elif not os.path.samefile(blob, path):
+                    size = os.path.getsize(path)
+                    tmp_path = self._temp_path(path)
+                    os.link(blob, tmp_path)
+                    os.replace(tmp_path, path)
+                    linked += 1
+                    reclaimed += size
+            except OSError as e:
+                logger.warning(f"Dedupe skipped {path}: {e}")
+            if progress_callback and i % 50 == 0:
+                progress_callback(i * 100 / len(candidates), stage='dedupe')
+        metrics.MEDIA_DEDUP_BYTES.inc(reclaimed)
+        logger.info(f"Dedupe: scanned {len(candidates)} files, linked {linked} duplicates, reclaimed {reclaimed} bytes")
+        return {'scanned': len(candidates), 'linked': linked, 'reclaimed_bytes': reclaimed}
+
+    def storage_stats(self):
+        """
+        内容寻址存储的占用统计：logical_bytes 为所有版本化文件大小之和，physical_bytes 为 blob 实际占用，
+        reclaimed_bytes 为去重节省的空间，orphaned_bytes 为已没有任何文件引用的 blob
+        """
+        blobs, files, physical, logical, reclaimed, orphaned = 0, 0, 0, 0, 0, 0
+        root = self._get_directory('blob')
+        for shard in os.listdir(root):
+            shard_dir = os.path.join(root, shard)
+            if not os.path.isdir(shard_dir): continue
+            for name in os.listdir(shard_dir):
+                try:
+                    st = os.stat(os.path.join(shard_dir, name))
+                except OSError:
+                    continue
+                refs = st.st_nlink - 1   # 除 blob 自身外的链接数
+                blobs += 1
+                files += refs
+                physical += st.st_size
+                logical += st.st_size * refs
+                reclaimed += st.st_size * max(0, refs - 1)
+                if refs == 0: orphaned += st.st_size
+        return {'blobs': blobs, 'files': files, 'physical_bytes': physical, 'logical_bytes': logical,
+                'reclaimed_bytes': reclaimed, 'orphaned_bytes': orphaned}
+
+    # --- 媒体索引 (Media Index) ---
+    VERSION_PATTERN = re.compile(r"^(.+?)_v(\d+)\.(.+)$")
+    INDEXED_TYPES = ['image', 'video', 'audio']
+
+    def _load_index(self):
+        if os.path.exists(self.index_file):
+            try:
+                self._index_stamp = self._stat_index()
+                with open(self.index_file, 'r', encoding='utf-8') as f:
+                    return json.load(f).get('entities', {})
+            except Exception as e:
+                logger.warning(f"Media index corrupted, rebuilding: {e}")
+        return self.rebuild_index()
+
+    def _stat_index(self):
+        st = os.stat(self.index_file)
+        return st.st_mtime_ns, st.st_ino
+
+    def _refresh_index(self):
+        """多 worker 部署时索引文件可能被其他进程更新 (每次写回都是新 inode)，变化才重新加载"""
+        try:
+            stamp = self._stat_index()
+        except OSError:
+            return
+        if stamp != self._index_stamp:
+            self._index = self._load_index()
+
+    @contextmanager
+    def _index_transaction(self):
+        """
+        索引的 读取-修改-写回：进程内锁 + 跨 gunicorn worker 的文件锁 (flock)，
+        进入时先加载其他 worker 写入的最新索引，避免互相覆盖对方新增的记录；可嵌套
+        """
+        with self._index_lock:
+            if self._index_txn_depth:
+                self._index_txn_depth += 1
+                try:
+                    yield
+                finally:
+                    self._index_txn_depth -= 1
+                return
+            directory = os.path.dirname(self.index_file)
+            if directory: os.makedirs(directory, exist_ok=True)
+            with open(f"{self.index_file}.lock", 'a') as lock_file:
+                if fcntl:
+                    # 非阻塞重试，等锁时让出 (eventlet 下不卡住整个 worker)
+                    while True:
+                        try:
+                            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                            break
+                        except BlockingIOError:
+                            time.sleep(0.005)
+                self._index_txn_depth = 1
+                try:
+                    self._refresh_index()
+                    yield
+                finally:
+                    self._index_txn_depth = 0
+                    if fcntl: fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _save_index(self):
+        directory = os.path.dirname(self.index_file)
+        if directory: os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.index_file}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'entities': self._index}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.index_file)
+        self._index_stamp = self._stat_index()
+
+    def _make_index_entry(self, media_type, filename):
+        """解析文件名 ID_v版本.后缀，不带版本号的文件以整个文件名作为 ID，版本记为 9999 (当前/最新)"""
+        match = self.VERSION_PATTERN.match(filename)
+        if match:
+            entity_id, version = match.group(1), int(match.group(2))
+        else:
+            entity_id, version = os.path.splitext(filename)[0], 9999
+
+        file_stat = os.stat(os.path.join(self._get_directory(media_type), filename))
+        return entity_id, {
+            'filename': filename,
+            'url': self._get_web_path(media_type, filename),
+            'media_type': media_type,
+            'version': version,
+            'size': file_stat.st_size,
+            'mtime': file_stat.st_mtime
+        }
+
+    def _index_file_saved(self, media_type, filename, digest=None):
+        if media_type == 'image' and not filename.startswith('analysis_'):
+            self.schedule_derivatives(os.path.join(self._get_directory(media_type), filename))
+        if media_type not in self.INDEXED_TYPES: return
+        try:
+            entity_id, entry = self._make_index_entry(media_type, filename)
+            if digest: entry['sha256'] = digest
+            # 去重命中时文件是旧 blob 的硬链接，mtime 是 blob 的旧时间，保存时间单独记录
+            entry['saved_at'] = time.time()
+            with self._index_transaction():
+                versions = [v for v in self._index.get(entity_id, []) if v['url'] != entry['url']]
+                versions.append(entry)
+                self._index[entity_id] = versions
+                self._save_index()
+        except Exception as e:
+            logger.error(f"Media index update failed: {e}")
+
+    def saved_times(self):
+        """{url: 保存时间}，没有记录保存时间的旧条目用文件 mtime"""
+        with self._index_lock:
+            self._refresh_index()
+            return {v['url']: v.get('saved_at', v['mtime']) for versions in self._index.values() for v in versions}
+
+    def forget_files(self, urls):
+        """从媒体索引中移除已删除文件的记录 (索引只写一次)"""
+        urls = set(urls)
+        if not urls: return
+        with self._index_transaction():
+            for entity_id in list(self._index):
+                kept = [v for v in self._index[entity_id] if v['url'] not in urls]
+                if kept: self._index[entity_id] = kept
+                else: del self._index[entity_id]
+            self._save_index()
+
+    def rebuild_index(self):
+        """全量扫描 imgs/videos/audio 重建索引 (仅在索引缺失或损坏时执行)"""
+        logger.info("Rebuilding media index...")
+        index = {}
+        for media_type in self.INDEXED_TYPES:
+            directory = self._get_directory(media_type)
+            if not os.path.exists(directory): continue
+            for f in os.listdir(directory):
                 # 跳过隐藏文件
                 if f.startswith('.'): continue
-                
-                file_path = os.path.join(directory, f)
-                
-                # 尝试匹配带版本的
-                match = version_pattern.match(f)
-                entity_id = None
-                version = 1
-                
-                if match:
-                    entity_id = match.group(1)
-                    version = int(match.group(2))
+                try:
+                    entity_id, entry = self._make_index_entry(media_type, f)
+                except OSError:
+                    continue
+                index.setdefault(entity_id, []).append(entry)
+
+        with self._index_transaction():
+            self._index = index
+            self._save_index()
+        logger.info(f"Media index rebuilt: {sum(len(v) for v in index.values())} files")
+        return index
+
+    def is_immutable(self, relative_path):
+        """
+        static 下的相对路径 (如 imgs/xxx_v3.png) 是否为版本化媒体文件：
+        每次保存都生成新的 {entity}_v{N} 文件名，写入后内容不再变化 (缩略图随原图文件名派生，同样不变)
+        """
+        parts = relative_path.replace('\\', '/').split('/')
+        if len(parts) != 2: return False
+        immutable_dirs = {self.dirs[t] for t in self.INDEXED_TYPES + ['thumb']}
+        return parts[0] in immutable_dirs and bool(self.VERSION_PATTERN.match(parts[1]))
+
+    # --- 缩略图 / 预览图 (Derivatives) ---
+    def _derivative_path(self, src_path, kind):
+        return os.path.join(self._get_directory('thumb'), f"{os.path.basename(src_path)}.{kind}.webp")
+
+    def _derivative_source(self, url):
+        """可生成派生图的本地原图路径 (只处理 static/imgs 下的图片)，否则返回 None"""
+        if not url or url.startswith(('http', 'data:')): return None
+        path = self.get_absolute_path(url)
+        if os.path.dirname(path) != os.path.abspath(self._get_directory('image')): return None
+        if os.path.splitext(path)[1].lower() not in DERIVATIVE_SOURCE_EXTS: return None
+        return path
+
+    def _get_derivative_pool(self):
+        if self._derivative_pool is None:
+            if DERIVATIVE_WORKERS <= 0 or getattr(sys, 'frozen', False):
+                # 桌面版 (PyInstaller) 没有可单独执行的 media_manager.py，改用线程
+                self._derivative_pool = ThreadPoolExecutor(max_workers=max(1, DERIVATIVE_WORKERS), thread_name_prefix='derivatives')
+            else:
+                self._derivative_pool = SubprocessPool(DERIVATIVE_WORKERS)
+            atexit.register(self.shutdown_derivatives)
+        return self._derivative_pool
+
+    def shutdown_derivatives(self):
+        pool, self._derivative_pool = self._derivative_pool, None
+        if pool is not None: pool.shutdown(wait=True)
+
+    def schedule_derivatives(self, src_path):
+        """后台生成 src_path 的缩略图和预览图 (已在生成中或上次生成失败且文件未变的跳过)，返回 Future 或 None"""
+        try:
+            mtime_ns = os.stat(src_path).st_mtime_ns
+        except OSError:
+            return None
+        with self._derivative_lock:
+            if src_path in self._pending_derivatives: return None
+            if self._failed_derivatives.get(src_path) == mtime_ns: return None
+            self._pending_derivatives.add(src_path)
+            targets = [(self._derivative_path(src_path, kind), size) for kind, size in DERIVATIVE_SIZES.items()]
+            try:
+                future = self._get_derivative_pool().submit(_render_derivatives, src_path, targets)
+            except Exception as e:
+                self._pending_derivatives.discard(src_path)
+                logger.error(f"Derivative scheduling failed for {src_path}: {e}")
+                return None
+
+        def done(f):
+            try:
+                written = f.result()
+            except Exception as e:
+                logger.warning(f"Derivative generation failed for {src_path}: {e}")
+                with self._derivative_lock:
+                    self._pending_derivatives.discard(src_path)
+                    self._failed_derivatives[src_path] = mtime_ns
+                return
+            with self._derivative_lock:
+                self._pending_derivatives.discard(src_path)
+                self._failed_derivatives.pop(src_path, None)
+            metrics.MEDIA_BYTES.inc(written, method='derivatives')
+        future.add_done_callback(done)
+        return future
+
+    def derivatives_many(self, urls):
+        """
+        批量查询图片的派生图 {url: {'thumb': url | None, 'preview': url | None}}
+        只包含可派生的本地图片；还没有派生图的 (旧文件) 放入后台补生成，本次返回 None，前端回退到原图
+        """
+        results = {}
+        for url in set(u for u in urls if u):
+            src_path = self._derivative_source(url)
+            if not src_path: continue
+            # thumb 最后写出，存在即说明两个尺寸都已就绪
+            if os.path.exists(self._derivative_path(src_path, 'thumb')):
+                filename = os.path.basename(src_path)
+                results[url] = {kind: self._get_web_path('thumb', f"{filename}.{kind}.webp") for kind in DERIVATIVE_SIZES}
+            else:
+                results[url] = {kind: None for kind in DERIVATIVE_SIZES}
+                self.schedule_derivatives(src_path)
+        return results
+
+    # --- 媒体探测 (Media Probe) ---
+    @staticmethod
+    def _probe_file(path):
+        """用 pymediainfo 读取时长/分辨率/帧率/编码，失败返回 None"""
+        if not MEDIAINFO_AVAILABLE: return None
+        try:
+            info = MediaInfo.parse(path)
+        except Exception as e:
+            logger.warning(f"Media probe failed for {path}: {e}")
+            return None
+
+        meta = {'duration': None, 'width': None, 'height': None, 'fps': None, 'codec': None}
+        for track in info.tracks:
+            if track.track_type == 'General' and track.duration:
+                meta['duration'] = round(float(track.duration) / 1000, 3)
+            elif track.track_type in ('Video', 'Image') and meta['width'] is None:
+                meta['width'] = track.width
+                meta['height'] = track.height
+                meta['codec'] = track.format
+                if track.frame_rate:
+                    meta['fps'] = float(track.frame_rate)
+                if track.duration and not meta['duration']:
+                    meta['duration'] = round(float(track.duration) / 1000, 3)
+        return meta
+
+    def _find_index_entry(self, path):
+        filename = os.path.basename(path)
+        match = self.VERSION_PATTERN.match(filename)
+        entity_id = match.group(1) if match else os.path.splitext(filename)[0]
+        for entry in self._index.get(entity_id, []):
+            if entry['filename'] == filename and self.get_absolute_path(entry['url']) == path:
+                return entry
+        return None
+
+    def probe_many(self, urls):
+        """
+        批量探测媒体元数据 {url: {duration, width, height, fps, codec} | None}
+        结果按 路径+mtime 缓存在媒体索引中，文件变化才重新探测；未命中的文件并行探测，索引只写一次
+        探测失败 (损坏/不支持的文件) 同样按 mtime 缓存，不会每次请求都重新探测
+        """
+        results = {}
+        misses = []
+        with self._index_lock:
+            self._refresh_index()
+            for url in set(u for u in urls if u):
+                path = self.get_absolute_path(urlparse(url).path if url.startswith('http') else url)
+                try:
+                    mtime = os.stat(path).st_mtime
+                except (OSError, TypeError):
+                    results[url] = None
+                    continue
+                entry = self._find_index_entry(path)
+                cached = entry.get('probe') if entry else self._probe_cache.get((path, mtime))
+                if cached and cached.get('mtime') == mtime:
+                    results[url] = None if cached.get('failed') else {k: v for k, v in cached.items() if k != 'mtime'}
                 else:
-                    # 尝试匹配不带版本的 (作为当前版本)
-                    base_name = os.path.splitext(f)[0]
-                    # 简单的清理逻辑，如果 ID 包含非法字符可能需要更复杂的匹配，这里假设 ID 比较纯净
-                    if base_name in entity_map:
-                        entity_id = base_name
-                        version = 9999 # 标记为当前/最新
-                
-                # 如果这个文件的 ID 属于当前项目
-                if entity_id and entity_id in entity_map:
-                    entity_info = entity_map[entity_id]
-                    file_stat = os.stat(file_path)
-                    
-                    history_items.append({
-                        'filename': f,
-                        'url': self._get_web_path(media_type, f),
-                        'entity_id': entity_id,
-                        'entity_name': entity_info.get('name', '未知'),
-                        'entity_type': entity_info.get('type', 'unknown'),
-                        'media_type': media_type,
-                        'version': version,
-                        'timestamp': file_stat.st_mtime, # 修改时间
-                        'date_str': time.strftime('%Y-%m-%d %H:%M', time.localtime(file_stat.st_mtime))
-                    })
-        
+                    misses.append((url, path, mtime))
+
+        if not misses: return results
+
+        with ThreadPoolExecutor(max_workers=min(PROBE_WORKERS, len(misses))) as pool:
+            probed = list(pool.map(lambda m: self._probe_file(m[1]), misses))
+
+        with self._index_transaction():
+            index_changed = False
+            for (url, path, mtime), meta in zip(misses, probed):
+                results[url] = meta
+                if meta is None and not MEDIAINFO_AVAILABLE: continue   # 没装 pymediainfo 不算探测失败，装上后要能重新探测
+                cached = dict(meta, mtime=mtime) if meta is not None else {'failed': True, 'mtime': mtime}
+                entry = self._find_index_entry(path)
+                if entry:
+                    entry['probe'] = cached
+                    index_changed = True
+                else:
+                    self._probe_cache[(path, mtime)] = cached
+            if index_changed:
+                self._save_index()
+        return results
+
+    def probe(self, url):
+        return self.probe_many([url]).get(url)
+
+    def scan_project_files(self, entity_map):
+        """
+        从媒体索引中查询整个项目相关的历史文件
+        :param entity_map: 字典 { entity_id: { 'name': 'xxx', 'type': 'character/scene/fusion' } }
+        """
+        history_items = []
+
+        with self._index_lock:
+            self._refresh_index()
+            matched = [(eid, list(self._index.get(eid, []))) for eid in entity_map]
+
+        for entity_id, versions in matched:
+            entity_info = entity_map[entity_id]
+            for v in versions:
+                saved_at = v.get('saved_at', v['mtime'])
+                history_items.append({
+                    'filename': v['filename'],
+                    'url': v['url'],
+                    'entity_id': entity_id,
+                    'entity_name': entity_info.get('name', '未知'),
+                    'entity_type': entity_info.get('type', 'unknown'),
+                    'media_type': v['media_type'],
+                    'version': v['version'],
+                    'size': v['size'],
+                    'timestamp': saved_at, # 保存时间
+                    'date_str': time.strftime('%Y-%m-%d %H:%M', time.localtime(saved_at))
+                })
+
         # 按时间倒序排列（最新的在前面）
         history_items.sort(key=lambda x: x['timestamp'], reverse=True)
-        return history_items
\ No newline at end of file
+        return history_items
+
+
+if __name__ == '__main__' and '--worker' in sys.argv:
+    _worker_main()
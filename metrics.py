@@ -0,0 +1,372 @@
+# metrics.py
+import os
+import json
+import time
+import atexit
+import inspect
+import threading
+from bisect import bisect_left
+from functools import wraps
+
+# 轻量指标子系统 (计数器 / 直方图)，以 Prometheus 文本格式在 /metrics 输出
+# - 标签组合在装饰时预先绑定，热路径上只有两次 perf_counter + 几次累加，不加锁
+#   (eventlet 协程之间不会在累加中途切换；原生线程下极少数并发累加可能丢一次计数，对统计可以接受)
+# - 多进程 (gunicorn -w N)：每个 worker 每 METRICS_FLUSH_SECONDS 秒把自己的指标快照写到 METRICS_DIR/{pid}.json，
+#   /metrics 把本进程的实时值与其他 worker 的快照按标签求和，抓取落到哪个 worker 结果都一样，计数器不会来回跳
+#   * 已退出 worker 的快照继续计入 (计数器不回退)，超过 METRICS_RETENTION_HOURS 未更新的才删除 (在 Prometheus 看来是一次重置)
+#   * GaugeFunc 是瞬时值，只合并仍在刷新的 worker (快照在 3 个刷新周期内更新过)
+#   * METRICS_DIR 为空时只输出当前进程的指标
+# - METRICS_ENABLED=0 时装饰器直接返回原函数
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '1') != '0'
+METRICS_DIR = os.getenv('METRICS_DIR', 'data/metrics')
+METRICS_FLUSH_SECONDS = float(os.getenv('METRICS_FLUSH_SECONDS', 5))
+METRICS_RETENTION_HOURS = float(os.getenv('METRICS_RETENTION_HOURS', 7 * 24))
+
+# 默认桶：覆盖本地 JSON 读写 (毫秒级) 到视频生成轮询 (数分钟)
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra: pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'): return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def labels(self, **labels):
+        """按标签取子指标 (同一组标签返回同一个对象，可在模块加载时预先绑定)"""
+        key = tuple(str(labels.get(n, '')) for n in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def snapshot(self):
+        """可 JSON 序列化的子指标值 [[标签值列表, 值], ...]"""
+        return [[list(key), self._dump_child(child)] for key, child in list(self._children.items())]
+
+    def render(self, snapshots=()):
+        """snapshots: 其他进程的快照 [{指标名: snapshot()}]，与本进程的值按标签求和后输出"""
+        children = {}
+        for values in [self.snapshot()] + [s.get(self.name) or [] for s, _ in snapshots]:
+            for key, value in values:
+                key = tuple(key)
+                child = children.get(key)
+                if child is None: child = children[key] = self._new_child()
+                self._merge_child(child, value)
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        # 预先绑定但从未记录过的标签组合不输出，避免刷出大量 0 值序列
+        for key, child in sorted(children.items()):
+            if child.count if hasattr(child, 'count') else child.value:
+                lines.extend(self._render_child(key, child))
+        return lines
+
+
+class _CounterChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1, **labels):
+        self.labels(**labels).inc(amount)
+
+    @staticmethod
+    def _dump_child(child):
+        return child.value
+
+    @staticmethod
+    def _merge_child(child, value):
+        child.value += value
+
+    def _render_child(self, key, child):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(child.value)}"]
+
+
+class _HistogramChild:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)   # 非累积计数，输出时再累加
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value, **labels):
+        self.labels(**labels).observe(value)
+
+    @staticmethod
+    def _dump_child(child):
+        return [list(child.counts), child.sum]
+
+    @staticmethod
+    def _merge_child(child, value):
+        counts, total = value
+        if len(counts) != len(child.counts): return   # 桶定义不一致 (升级过程中新旧代码并存)，跳过
+        for i, n in enumerate(counts): child.counts[i] += n
+        child.sum += total
+        child.count += sum(counts)
+
+    def _render_child(self, key, child):
+        # count 取桶计数之和，保证与 +Inf 桶一致
+        counts, total = list(child.counts), child.sum
+        count = sum(counts)
+        lines, cumulative = [], 0
+        for bound, n in zip(self.buckets + (float('inf'),), counts):
+            cumulative += n
+            le = 'le="' + _format_value(float(bound)) + '"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class GaugeFunc(_Metric):
+    """抓取时才计算的瞬时值，func() 返回 {标签值元组: 数值}"""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames, func):
+        super().__init__(name, documentation, labelnames)
+        self.func = func
+
+    def snapshot(self):
+        try:
+            return [[list(key), value] for key, value in self.func().items()]
+        except Exception:
+            return []
+
+    def render(self, snapshots=()):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        values = {}
+        for items in [self.snapshot()] + [s.get(self.name) or [] for s, live in snapshots if live]:
+            for key, value in items:
+                values[tuple(key)] = values.get(tuple(key), 0) + value
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class timer:
+    """计时上下文管理器：with timer(histogram, stage='download'): ..."""
+    __slots__ = ('child', 'started')
+
+    def __init__(self, histogram, **labels):
+        self.child = histogram.labels(**labels)
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.perf_counter() - self.started)
+        return False
+
+
+def timed(histogram, outcomes=None, **labels):
+    """
+    计时装饰器，耗时记入 histogram{labels}
+    :param outcomes: 可选 Counter (标签需多一个 outcome)，按返回的结果字典记 success / failure，异常记 error
+    """
+    def decorator(func):
+        if not METRICS_ENABLED: return func
+        child = histogram.labels(**labels)
+        perf_counter = time.perf_counter
+
+        if outcomes is None:
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                started = perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    child.observe(perf_counter() - started)
+            return wrapper
+
+        ok, failed, error = (outcomes.labels(outcome=o, **labels) for o in ('success', 'failure', 'error'))
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            started = perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                error.inc()
+                raise
+            finally:
+                child.observe(perf_counter() - started)
+            (failed if isinstance(result, dict) and not result.get('success') else ok).inc()
+            return result
+        return wrapper
+    return decorator
+
+
+def instrument(histogram, methods=None, include=(), outcomes=None, **labels):
+    """
+    类装饰器：为方法批量加 timed，标签 method=方法名
+    默认覆盖所有公开方法 (加上 include 中的私有方法)；生成器方法 (流式接口) 跳过，其耗时由调用方统计
+    """
+    def decorator(cls):
+        names = list(methods or [n for n in vars(cls) if not n.startswith('_')]) + list(include)
+        for name in names:
+            raw = vars(cls).get(name)
+            is_static = isinstance(raw, staticmethod)
+            func = raw.__func__ if isinstance(raw, (staticmethod, classmethod)) else raw
+            if not inspect.isfunction(func) or inspect.isgeneratorfunction(func): continue
+            if isinstance(raw, classmethod): continue
+            wrapped = timed(histogram, outcomes=outcomes, method=name, **labels)(func)
+            setattr(cls, name, staticmethod(wrapped) if is_static else wrapped)
+        return cls
+    return decorator
+
+
+def _snapshot_path(pid):
+    return os.path.join(METRICS_DIR, f"{pid}.json")
+
+
+def flush():
+    """把本进程的指标快照写入 METRICS_DIR (先写临时文件再替换，读取方不会读到半个文件)"""
+    if not METRICS_DIR: return
+    with _registry_lock:
+        metrics = list(_registry)
+    data = {m.name: m.snapshot() for m in metrics}
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = _snapshot_path(os.getpid())
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(path + '.tmp', path)
+
+
+def _read_snapshots():
+    """其他进程的快照 [(指标字典, 是否仍在刷新)]；顺带删除超过保留期的快照"""
+    if not METRICS_DIR: return []
+    try:
+        names = os.listdir(METRICS_DIR)
+    except OSError:
+        return []
+    own = f"{os.getpid()}.json"
+    now = time.time()
+    snapshots = []
+    for name in names:
+        if name == own or not name.endswith('.json'): continue
+        path = os.path.join(METRICS_DIR, name)
+        try:
+            age = now - os.stat(path).st_mtime
+            if age > METRICS_RETENTION_HOURS * 3600:
+                os.remove(path)
+                continue
+            with open(path, 'r', encoding='utf-8') as f:
+                snapshots.append((json.load(f), age < 3 * METRICS_FLUSH_SECONDS))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+_flusher = None
+
+
+def start_multiprocess():
+    """启动定期写快照的后台线程 (每个 worker 调用一次；eventlet 下为协程)"""
+    global _flusher
+    if not METRICS_DIR or _flusher is not None: return
+
+    def loop():
+        while True:
+            try:
+                flush()
+            except Exception:
+                pass
+            time.sleep(METRICS_FLUSH_SECONDS)
+
+    _flusher = threading.Thread(target=loop, name="metrics-flush", daemon=True)
+    _flusher.start()
+    atexit.register(flush)
+
+
+def render():
+    """所有已注册指标的 Prometheus 文本 (text/plain; version=0.0.4)，合并所有 worker 的快照"""
+    with _registry_lock:
+        metrics = list(_registry)
+    snapshots = _read_snapshots()
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render(snapshots))
+    return '\n'.join(lines) + '\n'
+
+
+# ============================================================
+#  各模块共用的指标定义
+# ============================================================
+
+HTTP_REQUEST_SECONDS = Histogram('http_request_duration_seconds', 'HTTP request latency (until response headers)', ('method', 'endpoint'))
+HTTP_REQUESTS = Counter('http_requests_total', 'HTTP requests', ('method', 'endpoint', 'status'))
+
+DATA_MANAGER_SECONDS = Histogram('datamanager_call_duration_seconds', 'DataManager method latency', ('method',))
+DATA_MANAGER_LOCK_WAIT_SECONDS = Histogram('datamanager_lock_wait_seconds', 'Time spent waiting for the DataManager write lock', ('method',))
+
+GENERATION_SECONDS = Histogram('generation_duration_seconds', 'run_*_generation latency (prompt engineering + provider call)', ('kind',))
+GENERATION_STAGE_SECONDS = Histogram('generation_stage_duration_seconds', 'Latency of individual generation stages', ('stage',))
+PROVIDER_CALL_SECONDS = Histogram('provider_call_duration_seconds', 'Provider handler call latency (submit, polling, download)', ('provider', 'method'))
+PROVIDER_CALLS = Counter('provider_calls_total', 'Provider handler calls by outcome', ('provider', 'method', 'outcome'))
+
+MEDIA_IO_SECONDS = Histogram('media_io_duration_seconds', 'MediaManager I/O latency', ('method',))
+MEDIA_BYTES = Counter('media_bytes_total', 'Bytes written/read by MediaManager', ('method',))
+MEDIA_DEDUP_BYTES = Counter('media_dedup_bytes_total', 'Bytes not written because identical content was already stored')
+MEDIA_GC_FREED_BYTES = Counter('media_gc_freed_bytes_total', 'Disk space released by the orphaned media collector')
+
+TASK_WAIT_SECONDS = Histogram('task_queue_wait_seconds', 'Time tasks spend queued before a worker picks them up')
+TASK_RUN_SECONDS = Histogram('task_queue_run_seconds', 'Task execution time', ('status',))
+TASK_STAGE_SECONDS = Histogram('task_stage_duration_seconds', 'Background task stages (service call / save callback)', ('stage',))
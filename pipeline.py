@@ -0,0 +1,222 @@
+# pipeline.py
+import os
+import uuid
+import time
+import json
+import hashlib
+import logging
+import threading
+
+import task_queue
+
+logger = logging.getLogger("Pipeline")
+
+# 节点状态
+PENDING = 'pending'      # 等待依赖完成
+QUEUED = 'queued'        # 已提交到 TaskQueue
+RUNNING = 'running'
+SUCCESS = 'success'
+SKIPPED = 'skipped'      # 输入未变化且已有产物，直接跳过
+FAILED = 'failed'
+BLOCKED = 'blocked'      # 上游失败，无法执行
+
+DONE_STATES = (SUCCESS, SKIPPED)
+
+# 节点失败后重试前的等待秒数 (第 n 次重试等待 n 倍)，避免服务商的瞬时错误被立即重复触发
+PIPELINE_RETRY_DELAY = float(os.getenv('PIPELINE_RETRY_DELAY', 5))
+
+
+def fingerprint(*parts):
+    """对节点输入做稳定哈希，用于判断输入是否变化"""
+    raw = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class PipelineNode:
+    """
+    流水线中的一个阶段
+    - func: 实际执行逻辑 (失败时抛异常)
+    - inputs: 返回输入快照的函数，用于计算指纹
+    - output: 返回当前产物的函数，产物为空时即使指纹一致也会重新执行
+    """
+    def __init__(self, key, func, deps=None, inputs=None, output=None, desc=None, max_retries=1):
+        self.key = key
+        self.func = func
+        self.deps = list(deps or [])
+        self.inputs = inputs
+        self.output = output
+        self.desc = desc or key
+        self.max_retries = max_retries
+        self.status = PENDING
+        self.attempts = 0
+        self.error = None
+        self.task_id = None
+
+    def to_dict(self):
+        return {
+            "key": self.key, "desc": self.desc, "deps": self.deps,
+            "status": self.status, "attempts": self.attempts,
+            "error": self.error, "task_id": self.task_id
+        }
+
+
+class Pipeline:
+    def __init__(self, project_id, desc="生产流水线"):
+        self.id = str(uuid.uuid4())
+        self.project_id = project_id
+        self.desc = desc
+        self.created_at = time.strftime('%H:%M:%S')
+        self.nodes = {}
+
+    def add_node(self, key, func, **kwargs):
+        if key in self.nodes:
+            raise ValueError(f"Duplicate pipeline node: {key}")
+        node = PipelineNode(key, func, **kwargs)
+        self.nodes[key] = node
+        return node
+
+    @property
+    def status(self):
+        states = [n.status for n in self.nodes.values()]
+        if all(s in DONE_STATES for s in states): return 'success'
+        if any(s in (QUEUED, RUNNING) for s in states): return 'processing'
+        if any(s in (FAILED, BLOCKED) for s in states): return 'failed'
+        return 'pending'
+
+    def to_dict(self):
+        return {
+            "id": self.id, "project_id": self.project_id, "desc": self.desc,
+            "created_at": self.created_at, "status": self.status,
+            "nodes": [n.to_dict() for n in self.nodes.values()]
+        }
+
+
+class PipelineScheduler:
+    """
+    基于 TaskQueue 的 DAG 调度器：
+    依赖满足的节点才会提交到队列，互不依赖的节点 (如不同分镜) 并行执行；
+    输入指纹未变化的节点直接跳过；失败只重试失败节点本身。
+    """
+    def __init__(self, queue, db):
+        self.queue = queue
+        self.db = db
+        self.pipelines = {}
+        self._lock = threading.RLock()
+
+    def submit(self, pipeline):
+        self._validate(pipeline)
+        with self._lock:
+            self.pipelines[pipeline.id] = pipeline
+        self._schedule(pipeline)
+        return pipeline.id
+
+    def retry(self, pipeline_id):
+        """仅把失败/被阻塞的节点重新置为待执行，已成功的节点保持不变"""
+        pipeline = self.pipelines.get(pipeline_id)
+        if not pipeline: return None
+        with self._lock:
+            for node in pipeline.nodes.values():
+                if node.status in (FAILED, BLOCKED):
+                    node.status = PENDING
+                    node.attempts = 0
+                    node.error = None
+        self._schedule(pipeline)
+        return pipeline
+
+    def get(self, pipeline_id):
+        return self.pipelines.get(pipeline_id)
+
+    def get_list(self):
+        return sorted([p.to_dict() for p in self.pipelines.values()], key=lambda x: x['created_at'], reverse=True)
+
+    def _validate(self, pipeline):
+        # 检查依赖存在且无环
+        visiting, visited = set(), set()
+        def visit(key):
+            if key in visited: return
+            if key in visiting: raise ValueError(f"Pipeline cycle detected at: {key}")
+            if key not in pipeline.nodes: raise ValueError(f"Unknown pipeline dependency: {key}")
+            visiting.add(key)
+            for dep in pipeline.nodes[key].deps: visit(dep)
+            visiting.discard(key)
+            visited.add(key)
+        for key in pipeline.nodes: visit(key)
+
+    def _schedule(self, pipeline):
+        ready = []
+        with self._lock:
+            changed = True
+            while changed:
+                changed = False
+                for node in pipeline.nodes.values():
+                    if node.status != PENDING: continue
+                    dep_states = [pipeline.nodes[d].status for d in node.deps]
+                    if any(s in (FAILED, BLOCKED) for s in dep_states):
+                        node.status = BLOCKED
+                        changed = True
+                    elif all(s in DONE_STATES for s in dep_states):
+                        node.status = QUEUED
+                        ready.append(node)
+        for node in ready:
+            node.task_id = self.queue.submit(self._run_node, pipeline, node, desc=f"{pipeline.desc} · {node.desc}")
+        self._emit_update(pipeline)
+
+    def _run_node(self, pipeline, node):
+        with self._lock:
+            node.status = RUNNING
+            node.attempts += 1
+        self._emit_update(pipeline)
+        retry_delay = None
+        try:
+            fp = fingerprint(node.key, node.inputs()) if node.inputs else None
+            state = self.db.get_pipeline_state(pipeline.project_id) if fp else {}
+            if fp and state.get(node.key) == fp and (node.output is None or node.output()):
+                logger.info(f"Pipeline {pipeline.id} node {node.key} unchanged, skipped")
+                with self._lock:
+                    node.status = SKIPPED
+                return
+            node.func()
+            if fp:
+                # 产物写入后输入可能被本阶段更新 (例如新建融图)，以执行后的输入为准
+                self.db.set_stage_fingerprint(pipeline.project_id, node.key, fingerprint(node.key, node.inputs()))
+            with self._lock:
+                node.status = SUCCESS
+                node.error = None
+        except Exception as e:
+            with self._lock:
+                node.error = str(e)
+                if node.attempts <= node.max_retries:
+                    # 还有重试次数：本次任务正常结束 (不在任务列表里报失败)，延迟后重新提交
+                    node.status = QUEUED
+                    retry_delay = PIPELINE_RETRY_DELAY * node.attempts
+                else:
+                    node.status = FAILED
+            if retry_delay is None:
+                logger.error(f"Pipeline {pipeline.id} node {node.key} failed: {e}")
+                raise
+            logger.warning(f"Pipeline {pipeline.id} node {node.key} failed (attempt {node.attempts}), "
+                           f"retrying in {retry_delay:g}s: {e}")
+        finally:
+            if retry_delay is None:
+                self._schedule(pipeline)
+            else:
+                self._emit_update(pipeline)
+                self._retry_later(pipeline, node, retry_delay)
+
+    def _retry_later(self, pipeline, node, delay):
+        def resubmit():
+            with self._lock:
+                if node.status != QUEUED: return
+                node.status = PENDING
+            self._schedule(pipeline)
+        timer = threading.Timer(delay, resubmit)
+        timer.daemon = True
+        timer.start()
+
+    def _emit_update(self, pipeline):
+        sio = task_queue.socketio_instance
+        if sio:
+            try:
+                sio.emit('pipeline_update', pipeline.to_dict(), namespace='/')
+            except Exception as e:
+                logger.error(f"Socket emit failed: {e}")
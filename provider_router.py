@@ -0,0 +1,202 @@
+# provider_router.py
+import os
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FutureTimeout
+
+import tracing
+
+logger = logging.getLogger("ProviderRouter")
+
+# 能力类型 (settings.json 中 routing 的键)
+CAPABILITIES = ('text', 'image', 'video', 'fusion', 'voice')
+
+# 滚动统计窗口 (最近 N 次调用)
+ROUTER_WINDOW = int(os.getenv('PROVIDER_STATS_WINDOW', 50))
+# 连续失败达到该次数后熔断，冷却期内排到候选列表末尾 (仍作为最后的兜底)
+ROUTER_FAILURE_THRESHOLD = int(os.getenv('PROVIDER_FAILURE_THRESHOLD', 3))
+ROUTER_COOLDOWN = float(os.getenv('PROVIDER_COOLDOWN', 60))
+# 单次尝试的超时 (秒)，超时视为失败并切换到下一个 provider
+# 图片/视频不设外层超时：重复提交会产生额外费用和多余版本，由各 handler 自身的轮询超时兜底
+ATTEMPT_TIMEOUTS = {'text': float(os.getenv('PROVIDER_TEXT_TIMEOUT', 120))}
+# 文本请求对冲：主 provider 超过其 p95 延迟仍未返回时，向下一个 provider 再发一次，取先成功的结果
+HEDGE_TEXT = os.getenv('PROVIDER_HEDGE_TEXT', '0') == '1'
+HEDGE_MIN_SAMPLES = 5
+HEDGE_DEFAULT_DELAY = float(os.getenv('PROVIDER_HEDGE_DEFAULT_DELAY', 10))
+
+
+def provider_key(config):
+    return config.get('id') or config.get('type') or 'mock'
+
+
+class ProviderStats:
+    """单个 provider 在某一能力上的滚动统计 (延迟 / 错误率 / 连续失败)"""
+    def __init__(self, window=ROUTER_WINDOW):
+        self.samples = deque(maxlen=window)   # (ok, latency_seconds)
+        self.calls = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.last_failure = 0.0
+
+    def record(self, ok, latency):
+        self.samples.append((ok, latency))
+        self.calls += 1
+        if ok:
+            self.consecutive_failures = 0
+        else:
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.last_failure = time.time()
+
+    def percentile(self, q):
+        """成功调用的延迟分位数，样本为空时返回 None"""
+        latencies = sorted(lat for ok, lat in list(self.samples) if ok)
+        if not latencies: return None
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    @property
+    def error_rate(self):
+        samples = list(self.samples)
+        if not samples: return 0.0
+        return sum(1 for ok, _ in samples if not ok) / len(samples)
+
+    def tripped(self, threshold=ROUTER_FAILURE_THRESHOLD, cooldown=ROUTER_COOLDOWN):
+        return self.consecutive_failures >= threshold and time.time() - self.last_failure < cooldown
+
+    def snapshot(self):
+        p50, p95 = self.percentile(0.5), self.percentile(0.95)
+        return {
+            'calls': self.calls,
+            'failures': self.failures,
+            'window': len(self.samples),
+            'error_rate': round(self.error_rate, 4),
+            'p50_ms': int(p50 * 1000) if p50 is not None else None,
+            'p95_ms': int(p95 * 1000) if p95 is not None else None,
+            'consecutive_failures': self.consecutive_failures,
+            'tripped': self.tripped(),
+        }
+
+
+class ProviderRouter:
+    """
+    Provider 路由层 (位于 run_*_generation 之上)
+    - 每种能力接受一个有序的 provider 配置列表，依次尝试，出错/超时自动切换到下一个
+    - 按 (能力, provider) 记录滚动延迟与错误率，连续失败的 provider 在冷却期内排到最后
+    - 文本请求可选对冲 (hedge)
+    统计只在当前进程内存中 (gunicorn 每个 worker 各自统计)
+    """
+    def __init__(self, hedge_text=HEDGE_TEXT):
+        self.hedge_text = hedge_text
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _get_stats(self, capability, config):
+        key = (capability, provider_key(config))
+        with self._lock:
+            if key not in self._stats:
+                self._stats[key] = ProviderStats()
+            return self._stats[key]
+
+    def order(self, capability, configs):
+        """保持配置顺序，熔断中的 provider 挪到末尾"""
+        return sorted(configs, key=lambda c: self._get_stats(capability, c).tripped())
+
+    def _attempt(self, capability, config, call, timeout=None):
+        started = time.time()
+        with tracing.span('router.attempt', capability=capability, provider=provider_key(config)) as span:
+            try:
+                if timeout:
+                    executor = ThreadPoolExecutor(max_workers=1)
+                    try:
+                        result = executor.submit(tracing.propagate(call), config).result(timeout=timeout)
+                    finally:
+                        executor.shutdown(wait=False)
+                else:
+                    result = call(config)
+            except FutureTimeout:
+                result = {'success': False, 'error_msg': f"Provider timeout ({timeout}s)", 'timeout': True}
+            except Exception as e:
+                logger.error(f"[Router] {capability}/{provider_key(config)} raised: {e}")
+                result = {'success': False, 'error_msg': str(e)}
+
+            if not isinstance(result, dict):
+                result = {'success': False, 'error_msg': f"Unexpected result: {result!r}"}
+            if not result.get('success'): span.fail(result.get('error_msg'))
+        # 命中缓存的结果不代表 provider 的真实延迟
+        if not result.get('cached'):
+            stats = self._get_stats(capability, config)
+            with self._lock:
+                stats.record(bool(result.get('success')), time.time() - started)
+        return result
+
+    def hedge_delay(self, capability, config):
+        """对冲等待时间：主 provider 的 p95 延迟，样本不足时用默认值"""
+        stats = self._get_stats(capability, config)
+        p95 = stats.percentile(0.95) if sum(1 for ok, _ in list(stats.samples) if ok) >= HEDGE_MIN_SAMPLES else None
+        return max(0.2, p95 if p95 is not None else HEDGE_DEFAULT_DELAY)
+
+    def call(self, capability, configs, call, hedge=None, timeout=None):
+        """
+        按顺序尝试 configs 直到成功
+        :param call: call(config) -> handler 风格的结果字典 ({'success': ..., ...})；
+                     失败结果带 committed=True 时不再切换 (例如流式输出已经推送给客户端)
+        :param hedge: 是否对冲，默认仅文本能力且 PROVIDER_HEDGE_TEXT=1 时启用
+        :param timeout: 单次尝试超时，默认取 ATTEMPT_TIMEOUTS
+        :return: 第一个成功的结果 (附带 provider_id)，全部失败时返回最后一个失败结果
+        """
+        candidates = self.order(capability, configs or [{'type': 'mock'}])
+        timeout = timeout if timeout is not None else ATTEMPT_TIMEOUTS.get(capability)
+        if hedge is None: hedge = self.hedge_text and capability == 'text'
+
+        result = None
+        if hedge and len(candidates) > 1:
+            result = self._hedged(capability, candidates[0], candidates[1], call, timeout)
+            if result.get('success'): return result
+            candidates = candidates[2:]
+
+        for config in candidates:
+            if result is not None:
+                logger.warning(f"[Router] {capability} failover -> {provider_key(config)} (previous error: {result.get('error_msg')})")
+            result = self._attempt(capability, config, call, timeout)
+            result.setdefault('provider_id', config.get('id'))
+            if result.get('success') or result.get('committed'): return result
+        return result
+
+    def _hedged(self, capability, primary, secondary, call, timeout):
+        """先发主 provider，超过 p95 仍未返回再发备选，取先成功的一个 (慢的那个在后台结束，只计入统计)"""
+        executor = ThreadPoolExecutor(max_workers=2)
+        try:
+            futures = {executor.submit(tracing.propagate(self._attempt), capability, primary, call): primary}
+            done, _ = wait(futures, timeout=self.hedge_delay(capability, primary))
+            if not done or not next(iter(done)).result().get('success'):
+                if not done:
+                    logger.info(f"[Router] {capability} hedging {provider_key(primary)} -> {provider_key(secondary)}")
+                futures[executor.submit(tracing.propagate(self._attempt), capability, secondary, call)] = secondary
+
+            deadline = time.time() + timeout if timeout else None
+            pending, result = set(futures), None
+            while pending:
+                done, pending = wait(pending, timeout=max(0, deadline - time.time()) if deadline else None, return_when=FIRST_COMPLETED)
+                if not done:
+                    result = {'success': False, 'error_msg': f"Provider timeout ({timeout}s)", 'timeout': True}
+                    break
+                for future in done:
+                    result = future.result()
+                    result.setdefault('provider_id', futures[future].get('id'))
+                    if result.get('success'): return result
+            return result
+        finally:
+            executor.shutdown(wait=False)
+
+    def get_stats(self):
+        with self._lock:
+            items = list(self._stats.items())
+        stats = {}
+        for (capability, key), s in items:
+            stats.setdefault(capability, {})[key] = s.snapshot()
+        return stats
+
+
+router = ProviderRouter()
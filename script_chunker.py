@@ -0,0 +1,82 @@
+# script_chunker.py
+import os
+import re
+
+# 单个分块的最大字符数 (约等于一次 LLM 调用能稳定处理的剧本长度)
+ANALYZE_CHUNK_CHARS = int(os.getenv('ANALYZE_CHUNK_CHARS', 6000))
+
+# 场景标题：第X场 / 场景X / 第X幕 / INT. / EXT. / 内景 / 外景 / 日外 / 夜内 / 【场景】/ 1-2 / Markdown 标题
+SCENE_HEADING = re.compile(
+    r"^\s*(?:"
+    r"第\s*[0-9一二三四五六七八九十百千零〇两]+\s*[场幕集]"
+    r"|场景\s*[0-9一二三四五六七八九十百千零〇两]+"
+    r"|(?:INT|EXT|I/E)[\.\s]"
+    r"|[内外]景"
+    r"|[日夜晨昏][内外][\s\.。、：:]"
+    r"|【[^】]*场[^】]*】"
+    r"|\d+\s*-\s*\d+\s"
+    r"|#{1,3}\s*\S"
+    r")",
+    re.IGNORECASE
+)
+
+
+def split_scenes(text):
+    """按场景标题切分剧本，返回场景文本列表 (标题前的内容并入第一场)"""
+    scenes = []
+    current = []
+    for line in (text or '').splitlines(keepends=True):
+        if SCENE_HEADING.match(line) and any(l.strip() for l in current):
+            scenes.append(''.join(current))
+            current = []
+        current.append(line)
+    if any(l.strip() for l in current):
+        scenes.append(''.join(current))
+    return scenes
+
+
+def chunk_script(text, max_chars=ANALYZE_CHUNK_CHARS):
+    """
+    场景感知分块：只在场景边界处切分，把相邻场景合并到不超过 max_chars 的块中
+    (单场超长时独占一块，不在场景中间截断)
+    :return: [{'index', 'text', 'scene_offset', 'scene_count'}]，scene_offset 为该块之前的场景数
+    """
+    chunks = []
+    buf, buf_len, scene_offset, buf_scenes = [], 0, 0, 0
+    for scene in split_scenes(text):
+        if buf and buf_len + len(scene) > max_chars:
+            chunks.append({'index': len(chunks), 'text': ''.join(buf), 'scene_offset': scene_offset, 'scene_count': buf_scenes})
+            scene_offset += buf_scenes
+            buf, buf_len, buf_scenes = [], 0, 0
+        buf.append(scene)
+        buf_len += len(scene)
+        buf_scenes += 1
+    if buf:
+        chunks.append({'index': len(chunks), 'text': ''.join(buf), 'scene_offset': scene_offset, 'scene_count': buf_scenes})
+    return chunks
+
+
+def merge_shots(chunk_shots):
+    """
+    按块顺序合并分镜并重新编号 (结果只取决于输入，与各块完成顺序无关)
+    - 场号：按出现顺序全局连续编号，块内相同场号归为同一场，不同块之间不会撞号
+    - 镜号：每场内从 1 开始连续编号
+    :param chunk_shots: 按块顺序排列的分镜列表
+    """
+    merged = []
+    next_scene = 1
+    for shots in chunk_shots:
+        scene_map = {}
+        for shot in shots or []:
+            label = str(shot.get('scene', '')).strip() or '?'
+            if label not in scene_map:
+                scene_map[label] = next_scene
+                next_scene += 1
+            shot['scene'] = str(scene_map[label])
+            merged.append(shot)
+
+    counters = {}
+    for shot in merged:
+        counters[shot['scene']] = counters.get(shot['scene'], 0) + 1
+        shot['shot_number'] = str(counters[shot['scene']])
+    return merged
@@ -1,14 +1,20 @@
 # task_queue.py
+import os
 import uuid
 import time
 import logging
+import threading
 from concurrent.futures import ThreadPoolExecutor
 
+import metrics
+import tracing
+
 # 引入 Flask 的 current_app (虽然线程里用不了，但作为类型提示)
 # 关键：不要在这里直接 import socketio 实例，避免循环引用
 
 logger = logging.getLogger("TaskQueue")
 socketio_instance = None # 全局变量存储
+_current = threading.local() # 当前线程正在执行的任务
 
 def init_socketio(sio):
     """接收 main.py 传来的 socketio 对象"""
@@ -28,25 +34,55 @@ class TaskQueue:
             "desc": kwargs.pop('desc', 'AI任务'),
             "progress": 0
         }
+        root = tracing.start_trace('task', key=task_id, desc=self.tasks[task_id]["desc"])
+        self.tasks[task_id]["trace_id"] = root.trace.trace_id
         self._emit_update() # 提交时广播
-        self.executor.submit(self._runner, task_id, worker_func, args, kwargs)
+        self.executor.submit(self._runner, task_id, worker_func, args, kwargs, time.perf_counter(), root)
         return task_id
 
-    def _runner(self, task_id, func, args, kwargs):
+    def _runner(self, task_id, func, args, kwargs, submitted, root):
+        started = time.perf_counter()
+        metrics.TASK_WAIT_SECONDS.observe(started - submitted)
         self.tasks[task_id]["status"] = "processing"
         self._emit_update() # 开始时广播
         
-        try:
-            func(*args, **kwargs)
-            self.tasks[task_id]["status"] = "success"
-            self.tasks[task_id]["progress"] = 100
-        except Exception as e:
-            logger.error(f"Task {task_id} failed: {e}")
-            self.tasks[task_id]["status"] = "failed"
-            self.tasks[task_id]["error"] = str(e)
+        _current.task_id = task_id
+        error = None
+        with tracing.activate(root):
+            tracing.record_span('queue.wait', root.start, time.time())
+            try:
+                func(*args, **kwargs)
+                self.tasks[task_id]["status"] = "success"
+                self.tasks[task_id]["progress"] = 100
+            except Exception as e:
+                error = e
+                logger.error(f"Task {task_id} failed: {e}")
+                self.tasks[task_id]["status"] = "failed"
+                self.tasks[task_id]["error"] = str(e)
+            finally:
+                _current.task_id = None
+                metrics.TASK_RUN_SECONDS.observe(time.perf_counter() - started, status=self.tasks[task_id]["status"])
+        tracing.end_trace(root, error)
         
         self._emit_update() # 结束时广播
 
+    def report_progress(self, progress, **info):
+        """
+        在任务函数内部上报进度 (0-100)，可附带阶段信息 (stage 等)
+        只有整数进度或阶段变化时才广播，避免刷屏
+        """
+        task = self.tasks.get(getattr(_current, 'task_id', None))
+        if not task: return
+        progress = max(0, min(99, int(progress)))
+        changed = progress != task.get("progress") or info.get("stage") != task.get("stage")
+        task["progress"] = progress
+        task.update(info)
+        if changed:
+            self._emit_update()
+
+    def get(self, task_id):
+        return self.tasks.get(task_id)
+
     def _emit_update(self):
         """
         移除 broadcast=True 参数，因为在新版 Flask-SocketIO 中，
@@ -69,4 +105,13 @@ class TaskQueue:
     def get_list(self):
         return sorted(self.tasks.values(), key=lambda x: x['created_at'], reverse=True)
 
-queue = TaskQueue()
\ No newline at end of file
+def _task_counts():
+    counts = {}
+    for task in list(queue.tasks.values()):
+        key = (task.get("status"),)
+        counts[key] = counts.get(key, 0) + 1
+    return counts
+
+# 并发数可通过环境变量调整，流水线批量生产时可适当调大
+queue = TaskQueue(max_workers=int(os.getenv('TASK_QUEUE_WORKERS', 2)))
+metrics.GaugeFunc('task_queue_tasks', 'Tasks currently tracked by the queue, by status', ('status',), _task_counts)
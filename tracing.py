@@ -0,0 +1,308 @@
+# tracing.py
+import os
+import json
+import time
+import uuid
+import inspect
+import logging
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+logger = logging.getLogger("Tracing")
+
+# 每个后台任务一棵 span 树 (排队等待 / 提示词工程 / base64 / provider 提交 / 每次轮询 / 下载 / 保存)
+# - span 上下文保存在线程局部变量中 (eventlet 下即每个协程)，不在任务里时 span() 为空操作
+# - 完成的 trace 存在进程内的环形缓冲区中，超出容量淘汰最旧的
+# - 设置 TRACE_EXPORT_DIR 后，每个 trace 结束时额外写出一份 OTLP JSON 文件
+TRACE_BUFFER_SIZE = int(os.getenv('TRACE_BUFFER_SIZE', 500))
+# 单个 trace 的 span 上限 (视频轮询可能持续数百次)，超出后只计数不记录
+TRACE_MAX_SPANS = int(os.getenv('TRACE_MAX_SPANS', 1000))
+TRACE_EXPORT_DIR = os.getenv('TRACE_EXPORT_DIR', '')
+
+_local = threading.local()
+
+
+def _new_id(nbytes):
+    return uuid.uuid4().hex[:nbytes * 2]
+
+
+class Span:
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'start', 'end', 'attributes', 'status', 'error')
+
+    def __init__(self, trace, name, parent_id=None, start=None, attributes=None):
+        self.trace = trace
+        self.span_id = _new_id(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.start = start if start is not None else time.time()
+        self.end = None
+        self.attributes = dict(attributes or {})
+        self.status = 'ok'
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def fail(self, error):
+        self.status = 'error'
+        self.error = str(error)[:500]
+
+    def finish(self, end=None):
+        if self.end is None:
+            self.end = end if end is not None else time.time()
+            self.trace.add(self)
+
+    def to_dict(self):
+        end = self.end
+        return {
+            'span_id': self.span_id, 'parent_id': self.parent_id, 'name': self.name,
+            'start': self.start, 'end': end,
+            'duration_ms': round((end - self.start) * 1000, 1) if end else None,
+            'attributes': self.attributes, 'status': self.status, 'error': self.error,
+        }
+
+
+class Trace:
+    def __init__(self, name, key=None, attributes=None):
+        self.trace_id = _new_id(16)
+        self.key = key
+        self.spans = []
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self.root = Span(self, name, attributes=attributes)
+
+    def add(self, span):
+        with self._lock:
+            if len(self.spans) < TRACE_MAX_SPANS or span is self.root:
+                self.spans.append(span)
+            else:
+                self.dropped += 1
+
+    def to_dict(self):
+        with self._lock:
+            spans = list(self.spans)
+        if self.root.end is None: spans.append(self.root)   # 进行中的任务也能查看
+        spans.sort(key=lambda s: s.start)
+        items = [s.to_dict() for s in spans]
+        by_id = {item['span_id']: dict(item, children=[]) for item in items}
+        roots = []
+        for item in items:
+            node = by_id[item['span_id']]
+            parent = by_id.get(item['parent_id'])
+            (parent['children'] if parent else roots).append(node)
+        return {
+            'trace_id': self.trace_id, 'task_id': self.key, 'name': self.root.name,
+            'status': self.root.status if self.root.end else 'running',
+            'duration_ms': self.root.to_dict()['duration_ms'],
+            'dropped_spans': self.dropped, 'spans': items, 'tree': roots,
+        }
+
+    def to_otlp(self):
+        """OTLP/JSON (ExportTraceServiceRequest) 格式，可直接导入 Jaeger / Tempo 等"""
+        def value(v):
+            if isinstance(v, bool): return {'boolValue': v}
+            if isinstance(v, int): return {'intValue': str(v)}
+            if isinstance(v, float): return {'doubleValue': v}
+            return {'stringValue': str(v)}
+
+        with self._lock:
+            spans = list(self.spans)
+        if self.root.end is None: spans.append(self.root)
+        otlp_spans = []
+        for s in spans:
+            attributes = dict(s.attributes, **({'task.id': self.key} if s is self.root and self.key else {}))
+            otlp_spans.append({
+                'traceId': self.trace_id, 'spanId': s.span_id, 'parentSpanId': s.parent_id or '',
+                'name': s.name, 'kind': 1,
+                'startTimeUnixNano': str(int(s.start * 1e9)),
+                'endTimeUnixNano': str(int((s.end or time.time()) * 1e9)),
+                'attributes': [{'key': k, 'value': value(v)} for k, v in attributes.items()],
+                'status': {'code': 2, 'message': s.error or ''} if s.status == 'error' else {'code': 1},
+            })
+        return {'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': 'storyboard-ai'}}]},
+            'scopeSpans': [{'scope': {'name': 'tracing'}, 'spans': otlp_spans}],
+        }]}
+
+
+class TraceBuffer:
+    """最近 N 个 trace 的环形缓冲区，可按 trace_id 或任务 id 查找"""
+    def __init__(self, capacity=TRACE_BUFFER_SIZE):
+        self.capacity = capacity
+        self._traces = OrderedDict()
+        self._by_key = {}
+        self._lock = threading.Lock()
+
+    def put(self, trace):
+        with self._lock:
+            self._traces[trace.trace_id] = trace
+            if trace.key: self._by_key[trace.key] = trace.trace_id
+            while len(self._traces) > self.capacity:
+                _, old = self._traces.popitem(last=False)
+                if old.key and self._by_key.get(old.key) == old.trace_id:
+                    del self._by_key[old.key]
+
+    def get(self, trace_id_or_key):
+        with self._lock:
+            trace_id = self._by_key.get(trace_id_or_key, trace_id_or_key)
+            return self._traces.get(trace_id)
+
+
+buffer = TraceBuffer()
+
+
+# ============================================================
+#  上下文
+# ============================================================
+
+def current_span():
+    return getattr(_local, 'span', None)
+
+
+def _activate(span):
+    previous = getattr(_local, 'span', None)
+    _local.span = span
+    return previous
+
+
+def start_trace(name, key=None, **attributes):
+    """创建一个新 trace (不激活)，返回根 span；在执行线程里用 activate(root) 进入"""
+    trace = Trace(name, key=key, attributes=attributes)
+    buffer.put(trace)
+    return trace.root
+
+
+def end_trace(root, error=None):
+    if error is not None: root.fail(error)
+    root.finish()
+    if TRACE_EXPORT_DIR:
+        try:
+            os.makedirs(TRACE_EXPORT_DIR, exist_ok=True)
+            with open(os.path.join(TRACE_EXPORT_DIR, f"{root.trace.trace_id}.json"), 'w', encoding='utf-8') as f:
+                json.dump(root.trace.to_otlp(), f, ensure_ascii=False)
+        except Exception as e:
+            logger.error(f"Trace export failed: {e}")
+
+
+class activate:
+    """with activate(span): 在当前线程中把 span 设为当前上下文 (用于跨线程传递)"""
+    __slots__ = ('span', 'previous')
+
+    def __init__(self, span):
+        self.span = span
+
+    def __enter__(self):
+        self.previous = _activate(self.span)
+        return self.span
+
+    def __exit__(self, *exc):
+        _local.span = self.previous
+        return False
+
+
+class span:
+    """
+    子 span 上下文管理器，当前不在 trace 中时为空操作
+    with span('media.download', url=url) as s: ... ; s.set(bytes=n)
+    """
+    __slots__ = ('name', 'attributes', 'span', 'previous')
+
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        parent = getattr(_local, 'span', None)
+        if parent is None:
+            self.span = None
+            return _NOOP
+        self.span = Span(parent.trace, self.name, parent_id=parent.span_id, attributes=self.attributes)
+        self.previous = _activate(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.span is None: return False
+        if exc is not None: self.span.fail(exc)
+        _local.span = self.previous
+        self.span.finish()
+        return False
+
+
+class _NoopSpan:
+    def set(self, **attributes): pass
+    def fail(self, error): pass
+
+_NOOP = _NoopSpan()
+
+
+def record_span(name, start, end, **attributes):
+    """补记一个已经结束的 span (例如锁等待)，挂在当前 span 下"""
+    parent = getattr(_local, 'span', None)
+    if parent is None: return
+    s = Span(parent.trace, name, parent_id=parent.span_id, start=start, attributes=attributes)
+    s.finish(end)
+
+
+def traced(name, **attributes):
+    """函数装饰器版的 span()，返回结果字典 success=False 时标记为 error"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if getattr(_local, 'span', None) is None:
+                return func(*args, **kwargs)
+            with span(name, **attributes) as s:
+                result = func(*args, **kwargs)
+                if isinstance(result, dict) and result.get('success') is False:
+                    s.fail(result.get('error_msg') or 'failed')
+                return result
+        return wrapper
+    return decorator
+
+
+def instrument(prefix, methods=None, include=(), names=None):
+    """
+    类装饰器：为方法批量加 traced，span 名为 "{prefix}.{方法名}" (可用 names 覆盖)
+    默认覆盖所有公开方法 (加上 include 中的私有方法)，生成器方法跳过
+    """
+    def decorator(cls):
+        for name in list(methods or [n for n in vars(cls) if not n.startswith('_')]) + list(include):
+            raw = vars(cls).get(name)
+            if isinstance(raw, classmethod): continue
+            is_static = isinstance(raw, staticmethod)
+            func = raw.__func__ if is_static else raw
+            if not inspect.isfunction(func) or inspect.isgeneratorfunction(func): continue
+            wrapped = traced((names or {}).get(name) or f"{prefix}.{name}")(func)
+            setattr(cls, name, staticmethod(wrapped) if is_static else wrapped)
+        return cls
+    return decorator
+
+
+def propagate(func):
+    """把当前 span 上下文带到其他线程 (线程池 submit 前包装)"""
+    parent = current_span()
+    if parent is None: return func
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with activate(parent):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+# ============================================================
+#  日志关联
+# ============================================================
+
+def install_log_context():
+    """日志记录附带 trace_ctx 字段 ("[trace=... span=...] " 或空串)，格式串中用 %(trace_ctx)s 输出"""
+    factory = logging.getLogRecordFactory()
+    if getattr(factory, '_trace_ctx', False): return
+
+    def record_factory(*args, **kwargs):
+        record = factory(*args, **kwargs)
+        s = getattr(_local, 'span', None)
+        record.trace_ctx = f"[trace={s.trace.trace_id} span={s.span_id}] " if s is not None else ""
+        return record
+    record_factory._trace_ctx = True
+    logging.setLogRecordFactory(record_factory)
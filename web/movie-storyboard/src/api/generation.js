@@ -1,4 +1,5 @@
 import request from '@/api/index'
+import { useTaskStore } from '@/stores/taskStore'
 
 // ==========================================
 // 配置与模型
@@ -33,6 +34,29 @@ export const analyzeScript = (data) => {
   return request.post('/generate/analyze_script', data)
 }
 
+// 流式剧本分析：每解析出一个分镜就通过 Socket.IO 回调 onShot(shot, index)，最终仍返回完整结果
+// 长剧本会被分块并行分析，每完成一块回调 onProgress(chunksDone, chunksTotal)
+// 返回 { shots, partial }，partial 为 true 表示响应被截断，只拿到了部分分镜
+export const analyzeScriptStream = async (data, onShot, onProgress) => {
+  const taskStore = useTaskStore()
+  taskStore.initSocket()
+  const streamId = Math.random().toString(36).slice(2)
+  const shotHandler = (msg) => {
+    if (msg.stream_id === streamId && onShot) onShot(msg.shot, msg.index)
+  }
+  const progressHandler = (msg) => {
+    if (msg.stream_id === streamId && onProgress) onProgress(msg.chunks_done, msg.chunks_total)
+  }
+  taskStore.socket.on('analyze_script_shot', shotHandler)
+  taskStore.socket.on('analyze_script_progress', progressHandler)
+  try {
+    return await request.post('/generate/analyze_script', { ...data, stream_id: streamId })
+  } finally {
+    taskStore.socket.off('analyze_script_shot', shotHandler)
+    taskStore.socket.off('analyze_script_progress', progressHandler)
+  }
+}
+
 // 剧本续写
 export const scriptContinuation = (data) => {
   // data: { context_text, project_info, provider_id, model_name }
@@ -125,6 +149,25 @@ export const generateVideoPrompt = (data) => {
   return request.post('/async/generate/video_prompt', data)
 }
 
+// ==========================================
+// 分镜生产流水线 (Pipeline)
+// ==========================================
+
+// 一键生产分镜 (场景提示词 → 场景图 → 融图提示词 → 首尾帧 → 视频)
+export const produceShots = (data) => {
+  // data: { project_id, shot_ids?, text_provider_id, image_provider_id, fusion_provider_id, video_provider_id, *_model_name }
+  return request.post('/pipeline/produce_shots', data)
+}
+
+export const getPipeline = (pipelineId) => {
+  return request.get(`/pipelines/${pipelineId}`)
+}
+
+// 仅重试失败的阶段
+export const retryPipeline = (pipelineId) => {
+  return request.post(`/pipelines/${pipelineId}/retry`)
+}
+
 // ==========================================
 // 文件上传 (Uploads)
 // ==========================================
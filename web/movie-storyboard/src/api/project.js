@@ -49,16 +49,20 @@ export const deleteProject = (id) => {
   return request.delete(`/projects/${id}`)
 }
 
-export const getProjectHistory = (id) => {
-  return request.get(`/projects/${id}/history`)
+// params 可选 { page, page_size }，带 page 时返回 { items, total, page, page_size }
+export const getProjectHistory = (id, params) => {
+  return request.get(`/projects/${id}/history`, { params })
 }
 
 // 导出剪映草稿
+// 提交导出任务 (后台打包)，项目未变化时直接返回 ready
 export const exportJianyingDraft = (projectId) => {
-  // 注意：下载文件需要特殊处理，通常返回 blob
-  return request.post(`/projects/${projectId}/export/jianying`, {}, {
-    responseType: 'blob'
-  })
+  return request.post(`/projects/${projectId}/export/jianying`)
+}
+
+// 查询导出进度: { status, progress, stage, ready, download_url }
+export const getJianyingExportStatus = (projectId) => {
+  return request.get(`/projects/${projectId}/export/jianying`)
 }
 
 // ==========================================
@@ -109,10 +113,14 @@ export const createShot = (projectId, data) => {
   return request.post(`/projects/${projectId}/shots`, data)
 }
 
-export const batchCreateShots = (projectId, shots) => {
-  // 假设后端支持 POST /projects/:id/shots/batch_create 
-  // 或者你可以在前端循环调用 createShot，但批量接口更高效
-  return request.post(`/projects/${projectId}/shots/batch_create`, { shots })
+// 批量创建分镜 (一次写入)，insertIndex 可选：从该位置开始连续插入
+export const batchCreateShots = (projectId, shots, insertIndex) => {
+  return request.post(`/projects/${projectId}/shots/batch`, { shots, insert_index: insertIndex })
+}
+
+// 批量更新分镜: updates = [{ id, ...字段 }]
+export const batchUpdateShots = (projectId, updates) => {
+  return request.patch(`/projects/${projectId}/shots/batch`, { updates })
 }
 
 export const updateShot = (projectId, shotId, data) => {